@@ -33,8 +33,12 @@ def FTSfits(ftsname):
 
 def resample(w, f, dv=100):
     '''
-    dv: Sampling step for uniform log(lambda) [m/s]
+    dv: Sampling step for uniform log(lambda) [m/s]. None returns the FTS as is (uj, iod_j are None),
+        e.g. to resample only windows with LogGrid.
     '''
+    if dv is None:
+        return w, f, None, None
+
     # define a supersampled log(wavelength) space with knot index j
     u = np.log(w)
     uj = np.arange(u[0], u[-1], dv/c)
@@ -43,3 +47,42 @@ def resample(w, f, dv=100):
     return w, f, uj, iod_j
 
 
+class LogGrid:
+    '''
+    The supersampled log(wavelength) grid np.arange(u0, u1, step), evaluated on windows.
+
+    The nodes have the identical values as np.arange, which computes them as u0 + i*delta
+    with delta = (u0+step) - u0. So windows can be built without the full grid.
+
+    Example
+    -------
+    >>> u = np.log([20000., 25000.])
+    >>> grid = LogGrid(u[0], u[-1], 100/c)
+    >>> full = np.arange(u[0], u[-1], 100/c)
+    >>> grid.n == full.size
+    True
+    >>> i0, i1 = grid.index(np.log(21000.)), grid.index(np.log(21001.))
+    >>> (i0, i1) == tuple(np.searchsorted(full, np.log([21000., 21001.])))
+    True
+    >>> np.array_equal(grid.nodes(i0, i1), full[i0:i1])
+    True
+    '''
+    def __init__(self, u0, u1, step):
+        self.u0 = u0
+        self.delta = (u0+step) - u0
+        self.n = max(int(np.ceil((u1-u0)/step)), 0)
+
+    def node(self, i):
+        return self.u0 + i*self.delta
+
+    def nodes(self, i0, i1):
+        return self.u0 + np.arange(i0, i1)*self.delta
+
+    def index(self, x):
+        '''Number of nodes below x (as np.searchsorted on the full grid).'''
+        i = int(np.clip(np.ceil((x-self.u0)/self.delta), 0, self.n))
+        while i > 0 and self.node(i-1) >= x:
+            i -= 1
+        while i < self.n and self.node(i) < x:
+            i += 1
+        return i
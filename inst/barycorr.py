@@ -0,0 +1,78 @@
+#! /usr/bin/env python3
+# Licensed under a GPLv3 style license - see LICENSE
+
+# Barycentric correction, memoised per observation.
+
+import astropy.units as u
+import numpy as np
+from astropy.coordinates import SkyCoord
+from astropy.time import Time
+
+_memo = {}   # (target, midtime, location): (berv, bjd)
+
+
+def _targkey(targ):
+    # the values of the coordinates and motions (e.g. ra, dec, distance, pm_ra_cosdec, pm_dec);
+    # nan (e.g. an unknown parallax from Targ) as None, since nan != nan
+    data = targ.frame.data
+    values = [(c, float(getattr(r, c).value), str(getattr(r, c).unit)) for r in (data, *data.differentials.values()) for c in r.components]
+    values = [(c, None if np.isnan(v) else v, unit) for c, v, unit in values]
+    return targ.frame.name, str(targ.obstime), *values
+
+
+def _key(targ, midtime, location):
+    return _targkey(targ), float(midtime.jd1), float(midtime.jd2), midtime.scale, tuple(location.get_itrs().cartesian.xyz.to_value(u.m))
+
+
+def barycorr(targ, midtime, location):
+    '''
+    Barycentric correction of an observation.
+
+    The result is memoised, so the calls for the other orders of an observation are free.
+
+    Parameters
+    ----------
+    targ : SkyCoord
+    midtime : Time
+    location : EarthLocation
+
+    Returns
+    -------
+    berv : Barycentric velocity correction [km/s].
+    bjd : Time in TDB.
+    '''
+    key = _key(targ, midtime, location)
+    if key not in _memo:
+        berv = targ.radial_velocity_correction(obstime=midtime, location=location)
+        _memo[key] = float(berv.to(u.km/u.s).value), midtime.tdb
+    return _memo[key]
+
+
+def prepare(targs, midtimes, location):
+    '''
+    Compute the barycentric corrections of many observations in one vectorised call.
+
+    The results are memoised for barycorr.
+
+    Example
+    -------
+    >>> from astropy.coordinates import EarthLocation
+    >>> loc = EarthLocation.from_geodetic(lat=-24.6268*u.deg, lon=-70.4045*u.deg, height=2648*u.m)
+    >>> targ = SkyCoord(ra=10*u.deg, dec=-20*u.deg)
+    >>> times = [Time('2022-03-25T01:00:00'), Time('2022-08-06T02:00:00')]
+    >>> prepare([targ, targ], times, loc)
+    >>> berv, bjd = barycorr(targ, times[1], loc)
+    >>> print(f'{berv:.6f}', bjd.scale)
+    20.276008 tdb
+    '''
+    todo = [(targ, midtime) for targ, midtime in zip(targs, midtimes) if _key(targ, midtime, location) not in _memo]
+    if not todo:
+        return
+    targs, midtimes = zip(*todo)
+    times = Time(midtimes)
+    # a single target or one coordinate per observation
+    coords = targs[0] if len(set(map(_targkey, targs))) == 1 else SkyCoord(targs)
+    berv = coords.radial_velocity_correction(obstime=times, location=location).to(u.km/u.s).value
+    bjd = times.tdb
+    for i, (targ, midtime) in enumerate(todo):
+        _memo[_key(targ, midtime, location)] = float(berv[i]), bjd[i]
@@ -9,6 +9,7 @@ from astropy.coordinates import SkyCoord, EarthLocation
 import astropy.units as u
 
 from .airtovac import airtovac
+from .barycorr import barycorr
 
 from .FTS_resample import resample, FTSfits
 from pause import pause
@@ -19,33 +20,15 @@ oset = '0:1'
 
 ip_guess = {'s': 300_000/200_000/ (2*np.sqrt(2*np.log(2))) }   # convert FHWM resolution to sigma
 
-def Spectrum(filename, order=None, targ=None, chksize=4000):
-    with open(filename) as myfile:
-        hdr = [next(myfile) for x in range(21)]
-    # PX#   WAVELENGTH          FLUX           ERROR         MASK (0/1/6)
-    x, w, f, e_f, m = np.genfromtxt(filename, skip_header=21).T
-    w = airtovac(w)
-    if 1:
-        # stitching
-        ax = 0*w + 1    # default pixel size
-        ax[576] = 0.963
-        ax[4+512*1] = 0.986
-        ax[4+512*2-1] = 0.981
-        ax[4+512*2] = 0.961
-        ax[4+512*3-1] = 0.993
-        ax[4+512*4] = 0.987
-        ax[4+512*5] = 0.992
-        ax[4+512*6-1] = 0.986
-        ax[4+512*7] = 0.971
-        x = np.cumsum(ax) - 1
-
-    if order is not None:
-        order = slice(order*chksize, (order+1)*chksize)
-        x, w, f, e_f, m = x[order], w[order], f[order], e_f[order], m[order]
+def Obsinfo(filename, hdr=None):
+    '''
+    Target coordinates (None: not in the file) and mid-exposure time of an observation.
 
-    b = 1 * np.isnan(f) # bad pixel map
-    #b[f>1.5] |= 2 # large flux
-    b[2120:2310] |= 4  # grating ghost on spectrum, CES.2000-08-13T073047.811, stationary?
+    Only the 21 header lines are read. hdr is a list of already read header lines.
+    '''
+    if hdr is None:
+        with open(filename) as myfile:
+            hdr = [next(myfile) for x in range(21)]
 
     dateobs = hdr[2].split()[-1]
     exptime = float(hdr[4].split()[-1])
@@ -63,10 +46,53 @@ def Spectrum(filename, order=None, targ=None, chksize=4000):
     #SkyCoord.from_name('M31', frame='icrs')
     # sc = SkyCoord(ra=ra, dec=de, unit=(u.hourangle, u.deg), pm_ra_cosdec=pmra*u.mas/u.yr, pm_dec=pmde*u.mas/u.yr)
     midtime = Time(dateobs, format='isot', scale='utc') + exptime/2 * u.s
-    berv = targ.radial_velocity_correction(obstime=midtime, location=lasilla)
-    berv = berv.to(u.km/u.s).value
-    bjd = midtime.tdb
-    return x, w, f, e_f, b, bjd, berv
+    return None, midtime
+
+
+def Spectrum(filename, order=None, targ=None, chksize=4000):
+    pixel, wave, spec, err, flag_pixel, bjd, berv = Spectra(filename, [order], targ=targ, chksize=chksize)
+    return pixel[0], wave[0], spec[0], err[0], flag_pixel[0], bjd, berv
+
+
+def Spectra(filename, orders=None, targ=None, chksize=4000):
+    '''
+    Read several orders (chunks of chksize pixels) of an observation at once.
+
+    The text file is parsed once.
+    Returns pixel, wave, spec, err, flag_pixel as lists with the array of each order
+    (the orders may differ in length), and bjd and berv.
+    orders=None (or the order None) gives the full spectrum as one order.
+    '''
+    with open(filename) as myfile:
+        hdr = [next(myfile) for x in range(21)]
+        # PX#   WAVELENGTH          FLUX           ERROR         MASK (0/1/6)
+        x, w, f, e_f, m = np.genfromtxt(myfile).T
+    w = airtovac(w)
+    if 1:
+        # stitching
+        ax = 0*w + 1    # default pixel size
+        ax[576] = 0.963
+        ax[4+512*1] = 0.986
+        ax[4+512*2-1] = 0.981
+        ax[4+512*2] = 0.961
+        ax[4+512*3-1] = 0.993
+        ax[4+512*4] = 0.987
+        ax[4+512*5] = 0.992
+        ax[4+512*6-1] = 0.986
+        ax[4+512*7] = 0.971
+        x = np.cumsum(ax) - 1
+
+    xs, ws, fs, es, bs = [], [], [], [], []
+    for order in orders or [None]:
+        o = slice(None) if order is None else slice(order*chksize, (order+1)*chksize)
+        b = 1 * np.isnan(f[o]) # bad pixel map
+        #b[f>1.5] |= 2 # large flux
+        b[2120:2310] |= 4  # grating ghost on spectrum, CES.2000-08-13T073047.811, stationary?
+        xs.append(x[o]); ws.append(w[o]); fs.append(f[o]); es.append(e_f[o]); bs.append(b)
+
+    _, midtime = Obsinfo(filename, hdr)
+    berv, bjd = barycorr(targ, midtime, lasilla)
+    return xs, ws, fs, es, bs, bjd, berv
 
 def Tpl(tplname, order=None, targ=None):
     if tplname.endswith('.dat'):
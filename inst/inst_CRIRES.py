@@ -13,6 +13,7 @@ from astropy.constants import c
 
 from .readmultispec import readmultispec
 from .airtovac import airtovac
+from .barycorr import barycorr
 
 from .FTS_resample import resample, FTSfits
 
@@ -39,12 +40,82 @@ oset = '1:19'
 
 ip_guess = {'s': 1.5}
 
+# header keywords for the catalogue (utils.catalog)
+header_keys = {'setting': 'ESO INS WLEN ID', 'exptime': 'ESO DET SEQ1 DIT'}
+
 def Spectrum(filename='', order=None, targ=None):
+    pixel, wave, spec, err, flag_pixel, bjd, berv = Spectra(filename, [order], targ=targ)
+    return pixel[0], wave[0], spec[0], err[0], flag_pixel[0], bjd, berv
+
+
+_blaze = {}   # (setting, order_drs, detector): blaze
+
+def Blaze(setting, order_drs, detector):
+    '''
+    Own blaze function of an order (CRIRES+ definition) and detector.
+
+    The blaze functions of a setting are read once per process from lib/CRIRES/blaze_own.fits.
+    '''
+    if (setting, order_drs, detector) not in _blaze:
+        # the file is read with astropy, also when PyCPL is used for the data
+        tbl = fits.getdata(path+'blaze_own.fits', extname=setting)
+        for name in tbl.names:
+            o, d, _ = name.split('_')   # e.g. 07_01_BLAZE
+            _blaze[setting, int(o), int(d)] = tbl[name].astype(float)
+    return _blaze[setting, order_drs, detector]
+
 
-    order_drs, detector = divmod(order-1, 3)
-    order_drs = 7 - order_drs	# order number (CRIRES+ definition)
-    detector += 1			# detector number (1,2,3)
-    
+def Colnames(filename, hdu=None):
+    '''Column names of the detector tables (from the headers only).'''
+    if pycpl:
+        return {detector: [p.value for p in PropertyList.load_regexp(filename, detector, "^TTYPE", False)] for detector in (1, 2, 3)}
+    if hdu is None:
+        with fits.open(filename) as hdu:
+            return Colnames(filename, hdu)
+    return {detector: hdu[detector].columns.names for detector in (1, 2, 3)}
+
+
+def Columns(filename, names, hdu=None):
+    '''
+    Read selected columns of the detector tables in one pass.
+
+    Only the requested columns are loaded, not the full tables.
+
+    Parameters
+    ----------
+    names : dict
+        Column names for each detector, e.g. {1: ['07_01_SPEC', '07_01_ERR', '07_01_WL']}.
+    hdu : HDUList, optional
+        Already opened file (astropy). It is closed afterwards.
+
+    Returns
+    -------
+    dict with the columns as arrays; the keys are (detector, name).
+    '''
+    cols = {}
+    if pycpl:
+        for detector, selcol in names.items():
+            nrow = PropertyList.load(filename, detector)["NAXIS2"].value
+            tbl = Table.load_window(filename, detector, True, list(selcol), 0, nrow)
+            for name in selcol:
+                cols[detector, name] = np.array(tbl[name])
+    else:
+        if hdu is None:
+            hdu = fits.open(filename, ignore_blank=True)
+        with hdu:
+            for detector, selcol in names.items():
+                data = hdu[detector].data
+                for name in selcol:
+                    cols[detector, name] = np.array(data.field(name))
+    return cols
+
+
+def Obsinfo(filename, hdu=None):
+    '''
+    Target coordinates, setting, calibrations and mid-exposure time of an observation.
+
+    Only the primary header is read. hdu is an already opened file (astropy).
+    '''
     exptime = 0
 
     if pycpl:
@@ -72,13 +143,8 @@ def Spectrum(filename='', order=None, targ=None):
             exptime = hdr["ESO DET SEQ1 DIT"].value
             exptime = (exptime*nods*ndit) / 2.0           
 
-        tbl = Table.load(filename, detector)
-        spec = np.array(tbl["0"+str(order_drs)+"_01_SPEC"])
-        err = np.array(tbl["0"+str(order_drs)+"_01_ERR"])
-
     else:
-        hdu = fits.open(filename, ignore_blank=True)
-        hdr = hdu[0].header
+        hdr = hdu[0].header if hdu else fits.getheader(filename)
         ra = hdr.get('RA', np.nan)
         de = hdr.get('DEC', np.nan)
         setting = hdr['ESO INS WLEN ID']
@@ -98,41 +164,79 @@ def Spectrum(filename='', order=None, targ=None):
             exptime = hdr.get('ESO DET SEQ1 DIT', 0)
             exptime = (exptime*nods*ndit) / 2.0
 
-        err = hdu[detector].data["0"+str(order_drs)+"_01_ERR"]
-        spec = hdu[detector].data["0"+str(order_drs)+"_01_SPEC"]
-
-    pixel = np.arange(spec.size)
-
     targdrs = SkyCoord(ra=ra*u.deg, dec=de*u.deg)
-    if not targ: targ = targdrs
     midtime = Time(dateobs, format='isot', scale='utc') + exptime * u.s
-    berv = targ.radial_velocity_correction(obstime=midtime, location=crires)
-    berv = berv.to(u.km/u.s).value
-    bjd = midtime.tdb
-   
-    # currently running tests with wavesolution from DRS pipeline
-    # DRS is giving better results for some orders
-    # this may can be removed in the near future
-    if 0: #str(setting) in ('K2148', 'K2166', 'K2192'):
-	    # using an own wavelength solution instead of the one created by DRS
-        file_wls = np.genfromtxt(path+'wavesolution_own/wave_solution_'+str(setting)+'.dat', dtype=None, names=True).view(np.recarray)
-        coeff_wls = [file_wls.b1[order-1], file_wls.b2[order-1], file_wls.b3[order-1]]
-        wave = np.poly1d(coeff_wls[::-1])(pixel)
+    return targdrs, setting, cal, midtime
+
+
+def Spectra(filename='', orders=None, targ=None):
+    '''
+    Read several orders of an observation at once.
+
+    The header is read once and only the needed columns of the detector tables in one pass;
+    the blaze once per process.
+    Returns pixel, wave, spec, err, flag_pixel as (n_orders, n_pix) arrays, and bjd and berv.
+    orders=None reads all orders of the file.
+    '''
+    hdu = None if pycpl else fits.open(filename, ignore_blank=True)
+    try:
+        targdrs, setting, cal, midtime = Obsinfo(filename, hdu)
+
+        if orders is None:
+            # data spread over 3 detectors, each having 6 or 7 orders
+            orders = sorted((7-int(cc.split('_')[0]))*3 + detector for detector, ccs in Colnames(filename, hdu).items() for cc in ccs if cc.endswith('_SPEC'))
+            orders = [o for o in orders if o > 0]
+
+        # the needed columns of all detectors in one pass
+        names = {}
+        for order in orders:
+            order_drs, detector = divmod(order-1, 3)
+            names.setdefault(detector+1, []).extend("0%d_01_%s" % (7-order_drs, x) for x in ('SPEC', 'ERR', 'WL'))
+        cols = Columns(filename, names, hdu)
+    finally:
+        # also when the header is broken (Columns closes it otherwise)
+        if hdu is not None:
+            hdu.close()
+    column = lambda detector, name: cols[detector, name]
 
-    else:
-        if pycpl:
-            wave = np.array(tbl["0"+str(order_drs)+"_01_WL"]) *10
+    if not targ: targ = targdrs
+    berv, bjd = barycorr(targ, midtime, crires)
+
+    # check if data are already blaze corrected by DRS pipeline
+    # otherwise use own blaze correction generated from 1D FLAT spectra 
+    # not yet tested for all settings
+    blazed = 'CAL_FLAT_EXTRACT_1D' in str(cal)
+
+    waves, specs, errs = [], [], []
+    for order in orders:
+        order_drs, detector = divmod(order-1, 3)
+        order_drs = 7 - order_drs	# order number (CRIRES+ definition)
+        detector += 1			# detector number (1,2,3)
+
+        spec = column(detector, "0"+str(order_drs)+"_01_SPEC")
+        err = column(detector, "0"+str(order_drs)+"_01_ERR")
+        pixel = np.arange(spec.size)
+
+        # currently running tests with wavesolution from DRS pipeline
+        # DRS is giving better results for some orders
+        # this may can be removed in the near future
+        if 0: #str(setting) in ('K2148', 'K2166', 'K2192'):
+            # using an own wavelength solution instead of the one created by DRS
+            file_wls = np.genfromtxt(path+'wavesolution_own/wave_solution_'+str(setting)+'.dat', dtype=None, names=True).view(np.recarray)
+            coeff_wls = [file_wls.b1[order-1], file_wls.b2[order-1], file_wls.b3[order-1]]
+            wave = np.poly1d(coeff_wls[::-1])(pixel)
         else:
-            wave = (hdu[detector].data["0"+str(order_drs)+"_01_WL"]) * 10
-            
-    if 'CAL_FLAT_EXTRACT_1D' not in str(cal):
-        # check if data are already blaze corrected by DRS pipeline
-        # otherwise use own blaze correction generated from 1D FLAT spectra 
-        # not yet tested for all settings
-        hdu = fits.open(path+'blaze_own.fits', ignore_blank=True)       
-        blaze = hdu[setting].data["0"+str(order_drs)+"_0"+str(detector)+"_BLAZE"]        
-        spec /= blaze
+            wave = column(detector, "0"+str(order_drs)+"_01_WL") * 10
+
+        if not blazed:
+            spec = spec / Blaze(str(setting), order_drs, detector)
+
+        waves.append(wave)
+        specs.append(spec)
+        errs.append(err)
 
+    wave, spec, err = np.array(waves), np.array(specs), np.array(errs)
+    pixel = np.tile(np.arange(spec.shape[1]), (len(spec), 1))
     flag_pixel = 1 * np.isnan(spec)		# bad pixel map
 
     return pixel, wave, spec, err, flag_pixel, bjd, berv
@@ -29,7 +29,23 @@ oset = '40:170'
 
 ip_guess = {'s': 1.5}
 
+# header keywords for the catalogue (utils.catalog)
+header_keys = {'setting': 'ESO INS MODE'}
+
 def Spectrum(filename='', order=None, targ=None):
+    pixel, wave, spec, err, flag_pixel, bjd, berv = Spectra(filename, None if order is None else [order], targ=targ)
+    if order is None:
+        return pixel, wave, spec, err, flag_pixel, bjd, berv
+    return pixel[0], wave[0], spec[0], err[0], flag_pixel[0], bjd, berv
+
+
+def Spectra(filename='', orders=None, targ=None):
+    '''
+    Read several orders of an observation at once.
+
+    Returns pixel, wave, spec, err, flag_pixel as (n_orders, n_pix) arrays, and bjd and berv.
+    orders=None reads all orders.
+    '''
 
     hdu = fits.open(filename, ignore_blank=True)
     hdr = hdu[0].header
@@ -39,15 +55,16 @@ def Spectrum(filename='', order=None, targ=None):
     dateobs = hdr['DATE-OBS']
     berv = hdr['ESO QC BERV']
 
-    spec = hdu['SCIDATA'].data[order]
-    wave = hdu['WAVEDATA_VAC_BARY'].data[order]
-    err = hdu['ERRDATA'].data[order]
+    orders = slice(None) if orders is None else orders
+    spec = hdu['SCIDATA'].data[orders]
+    wave = hdu['WAVEDATA_VAC_BARY'].data[orders]
+    err = hdu['ERRDATA'].data[orders]
         
     # wavelengths are already berv corrected
     # leads to problems in the telluric corrections for large berv
     wave *= 1-berv/3e5
 
-    pixel = np.arange(spec.size)
+    pixel = np.tile(np.arange(spec.shape[-1]), (len(spec), 1))
 
   #  targdrs = SkyCoord(ra=ra*u.deg, dec=de*u.deg)
    # if not targ: targ = targdrs
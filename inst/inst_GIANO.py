@@ -23,6 +23,19 @@ oset = '32:82'
 ip_guess = {'s': 300_000/67_000/ (2*np.sqrt(2*np.log(2))) }   
 
 def Spectrum(filename='', order=None, targ=None):
+    pixel, wave, spec, err, flag_pixel, bjd, berv = Spectra(filename, None if order is None else [order], targ=targ)
+    if order is None:
+        return pixel, wave, spec, err, flag_pixel, bjd, berv
+    return pixel[0], wave[0], spec[0], err[0], flag_pixel[0], bjd, berv
+
+
+def Spectra(filename='', orders=None, targ=None):
+    '''
+    Read several orders of an observation at once.
+
+    Returns pixel, wave, spec, err, flag_pixel as (n_orders, n_pix) arrays, and bjd and berv.
+    orders=None reads all orders.
+    '''
     hdu = fits.open(filename, ignore_blank=True)
     hdr = hdu[0].header
 
@@ -35,11 +48,11 @@ def Spectrum(filename='', order=None, targ=None):
 
     data = hdu[1].data
 
-    if order is not None:
-         wave, spec = data['WAVE'][order-32][::-1]*10, data['FLUX'][order-32][::-1]
+    orders = slice(None) if orders is None else np.asarray(orders)-32
+    wave, spec = data['WAVE'][orders][:, ::-1]*10, data['FLUX'][orders][:, ::-1]
 
-    pixel = np.arange(spec.size) 
-    err = np.zeros(spec.size)+0.1
+    pixel = np.tile(np.arange(spec.shape[-1]), (len(spec), 1))
+    err = np.zeros(spec.shape)+0.1
     flag_pixel = 1 * np.isnan(spec) # bad pixel map
 
     return pixel, wave, spec, err, flag_pixel, bjd, berv
@@ -11,6 +11,7 @@ from astropy.constants import c
 
 from .readmultispec import readmultispec
 from .airtovac import airtovac
+from .barycorr import barycorr
 
 from .FTS_resample import resample, FTSfits
 
@@ -23,25 +24,39 @@ iset = '500:2000'
 
 ip_guess = {'s': 300_000/87_000/ (2*np.sqrt(2*np.log(2))) }   # convert FHWM resolution to sigma
 
-def Spectrum(filename, order=None, targ=None):
-    if order is not None:
-         filename = filename.replace('_flux.fits.gz', '')[:-2]+"%02i_flux.fits.gz" % order
+# header keywords for the catalogue (utils.catalog)
+header_keys = {'date': 'DATE_BEG'}
 
-    hdu = fits.open(filename, ignore_blank=True)
-    hdr = hdu[0].header
+def Obsinfo(filename, hdr=None):
+    '''
+    Target coordinates and mid-exposure time of an observation.
+
+    Only the primary header (of the given order file) is read. hdr is an already read header.
+    '''
+    if hdr is None:
+        hdr = fits.getheader(filename)
 
     dateobs = hdr['DATE_BEG']   # ~ DATE-OBS+UTC
     exptime = hdr['EXPTIME']
     ra = hdr['RA']
     de = hdr['DEC']
-    iod_in = hdr['IODIN']
 
     targdrs = SkyCoord(ra=ra, dec=de, unit=(u.deg,u.deg))
-    if not targ: targ = targdrs
     midtime = Time(dateobs, format='isot', scale='utc') + exptime * u.s
-    berv = targ.radial_velocity_correction(obstime=midtime, location=keck)
-    berv = berv.to(u.km/u.s).value
-    bjd = midtime.tdb
+    return targdrs, midtime
+
+
+def Spectrum(filename, order=None, targ=None):
+    if order is not None:
+         filename = filename.replace('_flux.fits.gz', '')[:-2]+"%02i_flux.fits.gz" % order
+
+    hdu = fits.open(filename, ignore_blank=True)
+    hdr = hdu[0].header
+    iod_in = hdr['IODIN']
+
+    targdrs, midtime = Obsinfo(filename, hdr)
+    if not targ: targ = targdrs
+    berv, bjd = barycorr(targ, midtime, keck)
 
     d = hdu[1].data
     w, f, e = d['wave'], d['Flux'], d['Error']
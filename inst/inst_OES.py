@@ -11,6 +11,7 @@ from astropy.constants import c
 
 from .readmultispec import readmultispec
 from .airtovac import airtovac
+from .barycorr import barycorr
 
 from .FTS_resample import resample, FTSfits
 
@@ -23,33 +24,56 @@ oset = '1:30'
 ip_guess = {'s': 300_000/67_000/ (2*np.sqrt(2*np.log(2))) }   # convert FHWM resolution to sigma
 
 def Spectrum(filename='', order=None, targ=None):
-    hdu = fits.open(filename, ignore_blank=True)[0]
-    hdr = hdu.header
+    pixel, wave, spec, err, flag_pixel, bjd, berv = Spectra(filename, None if order is None else [order], targ=targ)
+    if order is None:
+        return pixel, wave, spec, err, flag_pixel, bjd, berv
+    return pixel[0], wave[0], spec[0], err[0], flag_pixel[0], bjd, berv
+
+
+def Obsinfo(filename, hdr=None):
+    '''
+    Target coordinates (None: not in the header) and mid-exposure time of an observation.
+
+    Only the primary header is read. hdr is an already read header.
+    '''
+    if hdr is None:
+        hdr = fits.getheader(filename)
 
     dateobs = hdr['DATE-OBS']+ 'T' + hdr['UT']
     exptime = hdr['EXPTIME']
 
     midtime = Time(dateobs, format='isot', scale='utc') + exptime * u.s
+   # targdrs = SkyCoord(ra=ra*u.hour, dec=de*u.deg)
+    return None, midtime
+
+
+def Spectra(filename='', orders=None, targ=None):
+    '''
+    Read several orders of an observation at once.
+
+    Returns pixel, wave, spec, err, flag_pixel as (n_orders, n_pix) arrays, and bjd and berv.
+    orders=None reads all orders.
+    '''
+    hdu = fits.open(filename, ignore_blank=True)[0]
+    _, midtime = Obsinfo(filename, hdu.header)
     bjd = midtime.tdb
 
-   # targdrs = SkyCoord(ra=ra*u.hour, dec=de*u.deg)
     if not targ: 
         #targ = targdrs
         berv = 0
     else:
-        berv = targ.radial_velocity_correction(obstime=midtime, location=oes)
-        berv = berv.to(u.km/u.s).value
+        berv, _ = barycorr(targ, midtime, oes)
 
     spec = hdu.data
     spec /= np.nanmean(spec)
     gg = readmultispec(filename, reform=True, quiet=True)
     wave = gg['wavelen']
     wave = airtovac(wave)
-    if order is not None:
-         wave, spec= wave[order], spec[order]
+    if orders is not None:
+         wave, spec= wave[orders], spec[orders]
 
-    pixel = np.arange(spec.size) 
-    err = np.ones(spec.size)*0.1
+    pixel = np.tile(np.arange(spec.shape[-1]), (len(spec), 1))
+    err = np.ones(spec.shape)*0.1
     flag_pixel = 1 * np.isnan(spec) # bad pixel map
  #   b[f>1.5] |= 4 # large flux
 
@@ -12,6 +12,7 @@ from astropy.constants import c
 
 from .readmultispec import readmultispec
 from .airtovac import airtovac
+from .barycorr import barycorr
 
 from .FTS_resample import resample, FTSfits
 
@@ -26,8 +27,20 @@ iset = '380:1700'
 ip_guess = {'s': 300_000/67_000/ (2*np.sqrt(2*np.log(2))) }   
 
 def Spectrum(filename='data/TLS/other/BETA_GEM.fits', order=None, targ=None):
-    hdu = fits.open(filename, ignore_blank=True)[0]
-    hdr = hdu.header
+    pixel, wave, spec, err, flag_pixel, bjd, berv = Spectra(filename, None if order is None else [order], targ=targ)
+    if order is None:
+        return pixel, wave, spec, err, flag_pixel, bjd, berv
+    return pixel[0], wave[0], spec[0], err[0], flag_pixel[0], bjd, berv
+
+
+def Obsinfo(filename, hdr=None):
+    '''
+    Target coordinates and mid-exposure time of an observation.
+
+    Only the primary header is read. hdr is an already read header.
+    '''
+    if hdr is None:
+        hdr = fits.getheader(filename)
 
     dateobs = hdr.get('DATE-OBS', hdr.get('FRAME'))
     exptime = hdr.get('EXP_TIME', hdr.get('EXPOSURE'))   # 20211018_guenther_TCEcell_0063.fits EXPOSURE (no exptime)
@@ -49,22 +62,32 @@ def Spectrum(filename='data/TLS/other/BETA_GEM.fits', order=None, targ=None):
         exptime *= -1.
 
     targdrs = SkyCoord(ra=ra*u.hour, dec=de*u.deg)
-    if not targ: targ = targdrs
     midtime = Time(dateobs, format='isot', scale='utc') + exptime/2. * u.s
+    return targdrs, midtime
+
+
+def Spectra(filename='data/TLS/other/BETA_GEM.fits', orders=None, targ=None):
+    '''
+    Read several orders of an observation at once.
+
+    Returns pixel, wave, spec, err, flag_pixel as (n_orders, n_pix) arrays, and bjd and berv.
+    orders=None reads all orders.
+    '''
+    hdu = fits.open(filename, ignore_blank=True)[0]
+    targdrs, midtime = Obsinfo(filename, hdu.header)
+    if not targ: targ = targdrs
     
-    berv = targ.radial_velocity_correction(obstime=midtime, location=tls)
-    berv = berv.to(u.km/u.s).value
-    bjd = midtime.tdb
+    berv, bjd = barycorr(targ, midtime, tls)
 
     spec = hdu.data
     gg = readmultispec(filename, reform=True, quiet=True)
     wave = gg['wavelen']
     wave = airtovac(wave)
-    if order is not None:
-         wave, spec = wave[order], spec[order]
+    if orders is not None:
+         wave, spec = wave[orders], spec[orders]
 
-    pixel = np.arange(spec.size) 
-    err = np.zeros(spec.size)+0.1
+    pixel = np.tile(np.arange(spec.shape[-1]), (len(spec), 1))
+    err = np.zeros(spec.shape)+0.1
     flag_pixel = 1 * np.isnan(spec) # bad pixel map
     #b[spec>1.] |= 4   # large flux, only for normalised spectra, use kapsig instead
     flag_pixel[(5300<wave) & (wave<5343)] |= 256  # only for HARPS s1d template (this order misses)
@@ -73,7 +96,7 @@ def Spectrum(filename='data/TLS/other/BETA_GEM.fits', order=None, targ=None):
 
     return pixel, wave, spec, err, flag_pixel, bjd, berv
 
-def Tpl(tplname, order=None, targ=None):
+def Tpl(tplname, order=None, targ=None, window=None):
     '''Tpl should return barycentric corrected wavelengths'''
     if tplname.endswith('_tpl.model'):
         # echelle template
@@ -89,7 +112,8 @@ def Tpl(tplname, order=None, targ=None):
             wave = np.exp(wave)
     elif tplname.endswith('PHOENIX-ACES-AGSS-COND-2011-HiRes.fits'):
         from . import phoenix
-        wave, spec = phoenix.read(tplname)
+        # only the range window=(wmin, wmax) is read, if given
+        wave, spec = phoenix.read(tplname, *window) if window else phoenix.read(tplname)
     elif tplname.endswith('.model') or tplname.endswith('.fits'):
         # echelle template
         pixel, wave, spec, err, flag_pixel, bjd, berv = Spectrum(tplname, order=order, targ=targ)
@@ -2,14 +2,16 @@
 # Licensed under a GPLv3 style license - see LICENSE
 
 import numpy as np
+import itertools
 from astropy.io import fits
 from astropy.time import Time
-from astropy.coordinates import SkyCoord, EarthLocation
+from astropy.coordinates import EarthLocation
 import astropy.units as u
 from astropy.constants import c
 
 from .readmultispec import readmultispec
 from .airtovac import airtovac
+from .barycorr import barycorr
 
 from .FTS_resample import resample, FTSfits
 
@@ -24,60 +26,91 @@ ip_guess['ag'] = ip_guess['agr'] = [ip_guess['s'], -1.1]
 
 from pause import *
 def Spectrum(filename, order=None, targ=None):
-    offset = 0
-    with open(filename) as hdu:
-        while 1:
-            line = next(hdu)
-            if line.startswith(' 10001'): break
-            offset += 1
-            if 'ObsDate' in line: date = line.split()[-1]
-            #if 'ObsTime' in line: ut = line.split()[-1]  # no seconds!
-            if 'ObsTime' in line: ut = float(line.split()[4])
-            if 'ExpTime' in line:
-                exptime = float(line.split()[-1])
+    pixel, wave, spec, err, flag_pixel, bjd, berv = Spectra(filename, [order], targ=targ)
+    return pixel[0], wave[0], spec[0], err[0], flag_pixel[0], bjd, berv
+
+
+def Obsinfo(filename, hdr=None):
+    '''
+    Target coordinates (None: not in the file) and mid-exposure time of an observation.
+
+    Only the header lines are read. hdr is a list of already read header lines.
+    '''
+    if hdr is None:
+        with open(filename) as f:
+            hdr = list(itertools.takewhile(lambda line: not line.startswith(' 10001'), f))
+    for line in hdr:
+        if 'ObsDate' in line: date = line.split()[-1]
+        #if 'ObsTime' in line: ut = line.split()[-1]  # no seconds!
+        if 'ObsTime' in line: ut = float(line.split()[4])
+        if 'ExpTime' in line:
+            exptime = float(line.split()[-1])
 
     hh = int(ut)
     mm = int((ut-hh)*60)
     ss = ((ut-hh)*60-mm) * 60
     dateobs = "%s-%s-%sT%s:%s:%s"% (date[-4:], date[2:4], date[:2], hh, mm, ss)
 
-    ra = 0.0
-    de = 0.0
-
-    targdrs = SkyCoord(ra=ra, dec=de, unit=(u.deg,u.deg))
-    if not targ: targ = targdrs
     midtime = Time(dateobs, format='isot', scale='utc') + exptime/2 * u.s
-    targ.obstime = midtime
+    return None, midtime
+
 
-    sa = 0
-    if targ.sa:
-        sa = targ.sa * (midtime-Time('J2000.0')).to_value('yr') * u.m/u.s  # [m/s]
+def Spectra(filename, orders=None, targ=None):
+    '''
+    Read several orders of an observation at once.
 
-    targ = targ.apply_space_motion(new_obstime=midtime)
-    berv = targ.radial_velocity_correction(location=paranal)
-    berv = (berv-sa).to(u.km/u.s).value
+    The header and the order blocks (4096 rows each) are parsed in one pass over the file,
+    up to the last requested order.
+    Returns pixel, wave, spec, err, flag_pixel as lists with the array of each order
+    (the orders may differ in length), and bjd and berv.
+    orders=None reads all orders.
+    '''
+    with open(filename) as hdu:
+        hdr = []
+        while 1:
+            line = next(hdu)
+            if line.startswith(' 10001'): break
+            hdr.append(line)
+        # the data rows from the first one
+        max_rows = None if orders is None else 4096*(max(orders)+1)
+        d = np.genfromtxt(itertools.chain([line], hdu), dtype='i,f,f,f,i', names='ordpix,wave,flux,e_flux,flag', max_rows=max_rows)
+
+    _, midtime = Obsinfo(filename, hdr)
     bjd = midtime.tdb
- 
-    d = np.genfromtxt(filename, skip_header=offset+4096*order, dtype='i,f,f,f,i', names='ordpix,wave,flux,e_flux,flag', max_rows=4096)
-    w, f, e = d['wave'], d['flux'], d['e_flux']
-    w = airtovac(w)
-
-    # fix start guess for some nights (quick hack for the custom reduction)
-    if '24052000' in filename: w *= (1-1/3e5)
-    if '06082002' in filename: w *= (1+2/3e5)
-    if '11072002' in filename: w *= (1+2/3e5)
-    if '18092002' in filename: w *= (1+2/3e5)
-    if '19092002' in filename: w *= (1+2/3e5)
-
-    x = np.arange(f.size)
-    b = 1 * np.isnan(f) # bad pixel map
-    b[~(e>0)] |= 1      # exclude zero error
-    if order == 22: b[:1600] |= 2 # bad region
-    if order == 25: b[2800:] |= 2 # bad region
-    #b[f>1.5] |= 2 # large flux
-    #b[(5300<w) & (w<5343)] |= 4  # only for HARPS s1d template (this order misses)
-
-    return x, w, f, e, b, bjd, berv
+
+    if not targ:
+        # the file has no coordinates
+        berv = 0
+    else:
+        berv, bjd = barycorr(targ, midtime, paranal)
+        sa = getattr(targ, 'sa', 0)
+        if sa:
+            # secular acceleration [m/s]
+            berv -= sa * (midtime-Time('J2000.0')).to_value('yr') / 1000
+
+    xs, ws, fs, es, bs = [], [], [], [], []
+    for order in range(len(d)//4096) if orders is None else orders:
+        do = d[4096*order: 4096*(order+1)]
+        w, f, e = do['wave'], do['flux'], do['e_flux']
+        w = airtovac(w)
+
+        # fix start guess for some nights (quick hack for the custom reduction)
+        if '24052000' in filename: w *= (1-1/3e5)
+        if '06082002' in filename: w *= (1+2/3e5)
+        if '11072002' in filename: w *= (1+2/3e5)
+        if '18092002' in filename: w *= (1+2/3e5)
+        if '19092002' in filename: w *= (1+2/3e5)
+
+        x = np.arange(f.size)
+        b = 1 * np.isnan(f) # bad pixel map
+        b[~(e>0)] |= 1      # exclude zero error
+        if order == 22: b[:1600] |= 2 # bad region
+        if order == 25: b[2800:] |= 2 # bad region
+        #b[f>1.5] |= 2 # large flux
+        #b[(5300<w) & (w<5343)] |= 4  # only for HARPS s1d template (this order misses)
+        xs.append(x); ws.append(w); fs.append(f); es.append(e); bs.append(b)
+
+    return xs, ws, fs, es, bs, bjd, berv
 
 def Tpl(tplname, order=None, targ=None):
     '''Tpl should return barycentric corrected wavelengths'''
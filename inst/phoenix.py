@@ -1,26 +1,111 @@
 #! /usr/bin/env python3
 # Licensed under a GPLv3 style license - see LICENSE
 
+from collections import OrderedDict
 import os
+
+import numpy as np
 from astropy.io import fits
 
+WAVENAME = 'WAVE_PHOENIX-ACES-AGSS-COND-2011.fits'
+
+
+def filename(teff, logg, feh=0.):
+    '''
+    Name of a PHOENIX HiRes model.
+
+    Example:
+    --------
+    >>> filename(5100, 4.5)
+    'lte05100-4.50-0.0.PHOENIX-ACES-AGSS-COND-2011-HiRes.fits'
+    '''
+    return f"lte{int(teff):05d}-{logg:.2f}{'-0.0' if feh == 0 else f'{feh:+.1f}'}.PHOENIX-ACES-AGSS-COND-2011-HiRes.fits"
+
+
+class Phoenix:
+    '''
+    Cache of PHOENIX models.
+
+    The wave grid of a directory is read once, the fluxes are memory mapped,
+    and wavelength windows are cut with searchsorted. Several models can be
+    held at once (e.g. for a Teff, logg, [Fe/H] grid scan); beyond maxmodels
+    the least recently used is closed.
+
+    Example:
+    --------
+    >>> phoe = Phoenix('PHOENIX-ACES-AGSS-COND-2011')
+    >>> grid = phoe.grid([5000, 5100], [4.5], [0.0, -0.5], wmin=5000, wmax=6000)
+    >>> wave, flux = grid[5100, 4.5, 0.0]
+    '''
+    def __init__(self, directory='', maxmodels=32):
+        self.directory = directory
+        self.maxmodels = maxmodels
+        self.waves = {}   # wave file: wave
+        self.fluxes = OrderedDict()   # model file: (hdulist, flux)
+
+    def path(self, teff, logg, feh=0.):
+        '''The model file in the directory or in its subdirectory Z-0.0 etc.'''
+        name = filename(teff, logg, feh)
+        zdir = 'Z' + name[13:17]
+        for path in (os.path.join(self.directory, name), os.path.join(self.directory, zdir, name)):
+            if os.path.exists(path):
+                return path
+        return os.path.join(self.directory, name)
+
+    def wave(self, fitsphoe):
+        '''The wave grid (from the wave file in the directory of the model or above).'''
+        dirname = os.path.dirname(fitsphoe)
+        wavename = os.path.join(dirname, WAVENAME)
+        if not os.path.exists(wavename) and os.path.basename(dirname).startswith('Z'):
+            # server layout: <dir>/WAVE..., <dir>/Z-0.0/lte...
+            wavename = os.path.join(os.path.dirname(dirname), WAVENAME)
+        if wavename not in self.waves:
+            with fits.open(wavename) as hdulist:
+                # native byte order, searchsorted would convert the big-endian grid on each call
+                self.waves[wavename] = hdulist[0].data.astype(float)
+        return self.waves[wavename]
+
+    def flux(self, fitsphoe):
+        '''The memory mapped flux.'''
+        if fitsphoe in self.fluxes:
+            self.fluxes.move_to_end(fitsphoe)
+        else:
+            print('read phoenix', fitsphoe)
+            hdulist = fits.open(fitsphoe, memmap=True)
+            self.fluxes[fitsphoe] = hdulist, hdulist[0].data
+            while len(self.fluxes) > self.maxmodels:
+                hdulist, _ = self.fluxes.popitem(last=False)[1]
+                hdulist.close()
+        return self.fluxes[fitsphoe][1]
+
+    def window(self, fitsphoe, wmin=3500, wmax=8000):
+        '''The model in the range wmin < wave < wmax.'''
+        wave = self.wave(fitsphoe)
+        i0, i1 = np.searchsorted(wave, wmin, side='right'), np.searchsorted(wave, wmax, side='left')
+        return wave[i0:i1], np.array(self.flux(fitsphoe)[i0:i1])
+
+    def grid(self, teffs, loggs, fehs=(0.,), wmin=3500, wmax=8000):
+        '''The windows {(teff, logg, feh): (wave, flux)} of a model grid.'''
+        return {(teff, logg, feh): self.window(self.path(teff, logg, feh), wmin, wmax)
+                for teff in teffs for logg in loggs for feh in fehs}
+
+
+cache = Phoenix()
+
+
 def read(fitsphoe, wmin=3500, wmax=8000):
     '''
     Example:
     --------
     >>> read('lte05100-4.50-0.0.PHOENIX-ACES-AGSS-COND-2011-HiRes.fits')
 
-    The wave file must be in the same directory.
+    The wave file must be in the same directory (or above the Z-0.0 etc. subdirectories).
 
     Phoenix spectra might be used to get absolute RVs, Teff, logg and [Fe/H].
     Also a vsini broadening would be needed (see https://github.com/mzechmeister/serval/blob/a348b4ca77e57b0e9e626f8c9fb147f080cc2418/src/serval.py#L228).
     Of course, the precision with depend on the model (mis-)match of the Phoenix spectra.
-    '''
-    print('read phoenix', fitsphoe)
-    with fits.open(fitsphoe) as hdulist:
-        flux = hdulist[0].data
-    with fits.open(os.path.join(os.path.dirname(fitsphoe), 'WAVE_PHOENIX-ACES-AGSS-COND-2011.fits')) as hdulist:
-        wave = hdulist[0].data
-    imap = (wmin<wave) & (wave<wmax)
-    return wave[imap], flux[imap]
 
+    The wave grid and the memory mapped flux are kept (see Phoenix), so that
+    the calls for the other orders are cheap.
+    '''
+    return cache.window(fitsphoe, wmin, wmax)
@@ -0,0 +1,73 @@
+#! /usr/bin/env python3
+## Licensed under a GPLv3 style license - see LICENSE
+
+# Benchmark of the CRIRES readers: all orders of the test observations
+# read per order with full tables, and at once with the column-selective reader,
+# for the astropy and (if installed) the PyCPL back end.
+#
+#    python tests/bench_crires.py [files] [-n repeats]
+
+import argparse
+import glob
+import importlib
+import os
+import sys
+import time
+
+import numpy as np
+
+directory = os.path.dirname(os.path.realpath(__file__)) + os.sep
+sys.path.insert(0, directory + '..')
+
+Inst = importlib.import_module('inst.inst_CRIRES')
+
+
+def colnames(order):
+    order_drs, detector = divmod(order-1, 3)
+    return detector+1, ["0%d_01_%s" % (7-order_drs, x) for x in ('SPEC', 'ERR', 'WL')]
+
+
+def per_order(filename, orders):
+    '''The former reader: the full detector table for each order.'''
+    for order in orders:
+        detector, names = colnames(order)
+        if Inst.pycpl:
+            tbl = Inst.Table.load(filename, detector)
+            [np.array(tbl[name]) for name in names]
+        else:
+            with Inst.fits.open(filename, ignore_blank=True) as hdu:
+                [np.array(hdu[detector].data[name]) for name in names]
+
+
+def selective(filename, orders):
+    '''The needed columns of all detectors in one pass.'''
+    names = {}
+    for order in orders:
+        detector, cols = colnames(order)
+        names.setdefault(detector, []).extend(cols)
+    Inst.Columns(filename, names)
+
+
+def bench(func, filenames, orders, n):
+    t = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        for filename in filenames:
+            func(filename, orders)
+        t.append(time.perf_counter() - t0)
+    return min(t) / len(filenames)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='CRIRES reader benchmark')
+    parser.add_argument('files', nargs='*', default=sorted(glob.glob(directory+'test_data/SGC_*.fits')))
+    parser.add_argument('-n', help='Repeats (the best is reported).', default=5, type=int)
+    args = parser.parse_args()
+
+    orders = list(range(1, 19))
+    backends = [0, 1] if Inst.pycpl else [0]
+    print('back end  per order [ms]  selective [ms]  speedup')
+    for Inst.pycpl in backends:
+        t_order = bench(per_order, args.files, orders, args.n)
+        t_sel = bench(selective, args.files, orders, args.n)
+        print(f"{['astropy', 'PyCPL'][Inst.pycpl]:8s}  {1000*t_order:14.1f}  {1000*t_sel:14.1f}  {t_order/t_sel:7.1f}")
@@ -0,0 +1,140 @@
+#! /usr/bin/env python3
+## Licensed under a GPLv3 style license - see LICENSE
+
+# Benchmark of the forward model on a synthetic chunk (see test_model.py):
+# the Jacobian by finite differences (one model call per parameter) and
+# analytic, and the fits with both, with and without variable projection
+# (with the number of model and Jacobian evaluations, and the share of
+# reused effective spectra), the IP convolution direct and by FFT, and the
+# model evaluation dense and sparse for several chunk sizes and used pixels.
+#
+#    python tests/bench_model.py [-n repeats]
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+directory = os.path.dirname(os.path.realpath(__file__)) + os.sep
+sys.path.insert(0, directory)
+
+from test_model import setup, params
+import utils.model
+from utils.model import model, memo_stats, poly
+
+
+def bench(func, n):
+    t = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        res = func()
+        t.append(time.perf_counter() - t0)
+    return min(t), res
+
+
+def convolution(S_mod, kernels, Sj, taps):
+    # IP convolution with the switch to the FFT at taps
+    saved, utils.model.FFT_TAPS = utils.model.FFT_TAPS, taps
+    try:
+        S_mod._conv(kernels, Sj)
+    finally:
+        utils.model.FFT_TAPS = saved
+
+
+def chunk_model(pixel, par, **kwargs):
+    # the model on the grid of the chunk (as cut by viper)
+    S_mod = setup(**kwargs)
+    lnwave = np.log(poly(pixel[[0, -1]]-S_mod.xcen, par.wave))
+    j0, j1 = np.searchsorted(S_mod.lnwave_j, lnwave) + [-S_mod.IP_hs-10, S_mod.IP_hs+10]
+    s = slice(j0, j1)
+    return model(S_mod.S_star, S_mod.lnwave_j[s], S_mod.spec_cell_j[s], S_mod.fluxes_molec[:, s], S_mod.IP, IP_hs=S_mod.IP_hs, xcen=S_mod.xcen, **kwargs)
+
+
+def evaluate(S_mod, pixel, par):
+    S_mod.memo.clear()
+    S_mod(pixel, **par)
+
+
+def finite_differences(S_mod, pixel, par, keys):
+    # forward differences as curve_fit
+    S_mod.memo.clear()
+    f0 = S_mod(pixel, **par)
+    for key in keys:
+        h = 1e-6 * (abs(par[key]) or 1)
+        S_mod(pixel, **(par + {key: par[key]+h})) - f0
+
+
+class counted(model):
+    # model counting its evaluations
+    nfev = njev = 0
+
+    def __call__(self, *args, **kwargs):
+        self.nfev += 1
+        return super().__call__(*args, **kwargs)
+
+    def jacobian(self, *args, **kwargs):
+        self.njev += 1
+        return super().jacobian(*args, **kwargs)
+
+
+def fit(S_mod, pixel, spec_obs, guess):
+    S_mod.__class__ = counted
+    hits = memo_stats['hits']
+    par, _ = S_mod.fit(pixel, spec_obs, guess, sig=np.ones_like(spec_obs))
+    return par, S_mod.nfev, S_mod.njev, memo_stats['hits'] - hits
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='forward model benchmark')
+    parser.add_argument('-n', help='Repeats (the best is reported).', default=5, type=int)
+    args = parser.parse_args()
+
+    pixel = np.arange(100, 1900, 1.)
+    cases = {'g': ('g', params()), 'g+ipB': ('g', params(ipB=[(0.9, np.inf)])), 'ag': ('ag', params(ip=[(2.5, np.inf), (1., np.inf)]))}
+    methods = {'FD': {}, 'jac': {'jac': True}, 'varpro': {'varpro': True}, 'varpro+jac': {'varpro': True, 'jac': True}}
+
+    print('IP      params  Jacobian FD [ms]  analytic [ms]')
+    for name, (ip, par) in cases.items():
+        keys = [*par.vary()]
+        S_mod = setup(ip)
+        t_fd, _ = bench(lambda: finite_differences(S_mod, pixel, par, keys), args.n)
+        t_jac, _ = bench(lambda: S_mod.jacobian(pixel, keys, **par), args.n)
+        print(f'{name:6s}  {len(keys):6d}  {1000*t_fd:16.1f}  {1000*t_jac:13.1f}')
+
+    print()
+    print('IP      fit         time [ms]  nfev  njev  reused  rv-rv_true [m/s]')
+    for name, (ip, par) in cases.items():
+        spec_obs = setup(ip)(pixel, **par)
+        guess = par + {'rv': 1.0, ('ip', 0): 2.3, ('atm', 0): 0.7, ('wave', 0): 5005.001, ('norm', 0): 900}
+        for method, opt in methods.items():
+            t, (p, nfev, njev, hits) = bench(lambda: fit(setup(ip, **opt), pixel, spec_obs, guess), 1)
+            print(f'{name:6s}  {method:10s}  {1000*t:9.0f}  {nfev:4d}  {njev:4d}  {100*hits/nfev:5.0f}%  {1000*(p.rv-par.rv):16.2g}')
+
+    print()
+    print('iphs  IPs  direct [ms]  FFT [ms]')
+    for iphs in (50, 100, 150, 300):
+        S_mod = setup(IP_hs=iphs)
+        Sj = S_mod.S_star(S_mod.lnwave_j) * S_mod.spec_cell_j
+        for ipB in ([], [0.9]):
+            kernels = S_mod._kernels([2.5], ipB)
+            t_direct, _ = bench(lambda: convolution(S_mod, kernels, Sj, 10**6), args.n)
+            t_fft, _ = bench(lambda: convolution(S_mod, kernels, Sj, 0), args.n)
+            print(f'{iphs:4d}  {len(kernels):3d}  {1000*t_direct:11.2f}  {1000*t_fft:8.2f}')
+
+    print()
+    print('pixels  used  grid  dense [ms]  sparse [ms]  convolution only: dense  sparse [ms]')
+    par = params(wave=[(5010, np.inf), (0.02, np.inf), (0, np.inf)])   # 1.2 km/s per pixel
+    for npix in (1800, 900, 450):
+        for used in (1, 3):   # all pixels, every third (e.g. clipped)
+            pixel = np.arange(1000-npix//2, 1000+npix//2, used, dtype=float)
+            S_dense, S_sparse = chunk_model(pixel, par), chunk_model(pixel, par, sparse=True)
+            t_dense, _ = bench(lambda: evaluate(S_dense, pixel, par), args.n)
+            t_sparse, _ = bench(lambda: evaluate(S_sparse, pixel, par), args.n)
+            kernels = S_dense._kernels([2.5], [])
+            Sj = S_dense.S_star(S_dense.lnwave_j) * S_dense.spec_cell_j
+            lnwave_obs = np.log(poly(pixel-S_dense.xcen, par.wave))
+            t_conv_dense, _ = bench(lambda: S_dense._sample(kernels, Sj, lnwave_obs), args.n)
+            t_conv_sparse, _ = bench(lambda: S_sparse._sample(kernels, Sj, lnwave_obs), args.n)
+            print(f'{npix:6d}  {len(pixel):4d}  {S_dense.lnwave_j.size:4d}  {1000*t_dense:10.2f}  {1000*t_sparse:11.2f}  {1000*t_conv_dense:23.2f}  {1000*t_conv_sparse:6.2f}')
@@ -0,0 +1,226 @@
+## Licensed under a GPLv3 style license - see LICENSE
+
+import os
+import shutil
+import sys
+
+import astropy.units as u
+import numpy as np
+from astropy.coordinates import EarthLocation, SkyCoord
+from astropy.time import Time
+
+directory = os.path.dirname(os.path.realpath(__file__)) + os.sep
+sys.path.insert(0, directory + '..')
+
+import inst.inst_CRIRES as Inst
+import inst.inst_TLS as TLS
+from astropy.io import fits
+from inst import barycorr, phoenix
+from utils.cache import FitCache, hashkey
+from utils.catalog import Catalog
+from utils.journal import Journal
+from utils.obscache import ObsCache
+from utils.param import Params
+from utils.tplstore import TplStore
+
+obsname = directory + 'test_data/SGC_220325_1.fits'
+
+
+def copy_obs(tmp_path):
+    # a private copy, so that its modification time can be changed
+    return shutil.copy(obsname, str(tmp_path))
+
+
+def test_fitcache_lru(tmp_path):
+    # room for two entries
+    cache = FitCache(str(tmp_path), maxsize=1000/2**20)
+    a, b, c = map(hashkey, 'abc')
+    for t, key in enumerate([a, b]):
+        cache.put(key, bytes(400))
+        os.utime(cache.path(key), (1000*(t+1),)*2)
+    # a hit refreshes a, so that b is the least recently used
+    assert cache.get(a) == bytes(400)
+    cache.put(c, bytes(400))
+    assert cache.get(b) is None
+    assert cache.get(a) == cache.get(c) == bytes(400)
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def result(rv):
+    par = Params(rv=(rv, 0.1), norm=[(2, 0.2)])
+    return rv, 0.1, 2459000.5, 3.2, par, np.eye(2), 0.8
+
+
+def test_journal_truncated(tmp_path):
+    filename = str(tmp_path / 'test.journal')
+    jn = Journal(filename, header={'oset': '7,12'})
+    jn.add(('a.fits', 7, 0), result(1.5), {(7, 1): np.arange(3.)}, None)
+    jn.add(('a.fits', 12, 0), result(2.5), {}, None)
+    jn.close()
+    # a run killed while writing the last record
+    with open(filename, 'r+') as f:
+        f.truncate(os.path.getsize(filename) - 20)
+
+    jn = Journal(filename, header={'oset': '7,12'}, resume=True)
+    assert [*jn.done] == [('a.fits', 7, 0)]
+    res, products, err = jn[('a.fits', 7, 0)]
+    assert res[4].rv.value == 1.5 and err is None
+    np.testing.assert_array_equal(products[7, 1], np.arange(3.))
+    # the record after the truncated line is readable again
+    jn.add(('a.fits', 12, 0), result(3.5), {}, None)
+    jn.close()
+    jn = Journal(filename, header={'oset': '7,12'}, resume=True)
+    assert jn[('a.fits', 12, 0)][0][0] == 3.5
+    jn.close()
+
+
+def test_journal_failed(tmp_path):
+    filename = str(tmp_path / 'test.journal')
+    jn = Journal(filename, header={})
+    # transient failures are tried again, chunks over budget are not
+    jn.add(('a.fits', 7, 0), None, {}, "OSError('read error')")
+    jn.add(('a.fits', 12, 0), (np.nan, np.nan, 2459000.5, 3.2, None, None, np.nan), {}, 'BudgetExceeded()')
+    jn.close()
+    jn = Journal(filename, header={}, resume=True)
+    assert ('a.fits', 7, 0) not in jn
+    assert jn[('a.fits', 12, 0)][2] == 'BudgetExceeded()'
+    jn.close()
+
+
+def test_journal_options(tmp_path):
+    # other options start a new journal
+    filename = str(tmp_path / 'test.journal')
+    jn = Journal(filename, header={'oset': '7,12'})
+    jn.add(('a.fits', 7, 0), result(1.5), {}, None)
+    jn.close()
+    jn = Journal(filename, header={'oset': '7'}, resume=True)
+    assert not jn.done
+    jn.close()
+    with open(filename) as f:
+        assert f.read() == '{"header": {"oset": "7"}}\n'
+
+
+def test_obscache(tmp_path):
+    obs = copy_obs(tmp_path)
+    cache = ObsCache(str(tmp_path / 'obs'))
+    assert cache.load(Inst, obs, [7, 12]) is None
+    cache.build(Inst, obs, [7, 12])
+    res = cache.load(Inst, obs, [12, 7])
+    ref = Inst.Spectra(obs, [12, 7])
+    for x, y in zip(res[:5], ref[:5]):
+        for x_o, y_o in zip(x, y):
+            np.testing.assert_array_equal(x_o, y_o)
+            assert x_o.dtype == y_o.dtype
+    assert res[5] == ref[5] and res[6] == ref[6]
+    # orders not in the entry
+    assert cache.load(Inst, obs, [13]) is None
+    # the wrapped Spectrum reads single orders from the entry
+    np.testing.assert_array_equal(cache.wrap(Inst)(obs, order=7)[2], Inst.Spectrum(obs, order=7)[2])
+
+
+def test_obscache_ragged(tmp_path):
+    # orders of different length are padded in the entry and cut again
+    obs = copy_obs(tmp_path)
+    class Short:
+        __name__ = 'inst_Short'
+        __file__ = Inst.__file__
+        def Spectrum(filename, order=None, targ=None):
+            return tuple(x[:100*order] for x in Inst.Spectrum(filename, order=order)[:5]) + (2459000.5, 1.5)
+    cache = ObsCache(str(tmp_path / 'obs'))
+    cache.build(Short, obs, [7, 12])
+    pixel, wave, spec, err, flag, bjd, berv = cache.load(Short, obs, [12, 7])
+    assert [x.size for x in spec] == [1200, 700]
+    np.testing.assert_array_equal(flag[1], Short.Spectrum(obs, order=7)[4])
+    assert (bjd, berv) == (2459000.5, 1.5)
+
+
+def test_obscache_outdated(tmp_path):
+    obs = copy_obs(tmp_path)
+    cache = ObsCache(str(tmp_path / 'obs'))
+    cache.build(Inst, obs, [7])
+    st = os.stat(obs)
+    os.utime(obs, ns=(st.st_atime_ns, st.st_mtime_ns+10**9))
+    assert cache.load(Inst, obs, [7]) is None
+    cache.clear()
+    assert cache.entries() == []
+
+
+def test_tplstore(tmp_path):
+    store = str(tmp_path / 'tpl')
+    tpl = TplStore(Inst.Tpl, obsname, oversampling=2, directory=store).load([7, 12])
+    assert os.listdir(store) == [os.path.basename(TplStore(Inst.Tpl, obsname, oversampling=2, directory=store).filename)]
+
+    def no_read(*args, **kwargs):
+        raise AssertionError('template read again')
+    no_read.__module__ = Inst.Tpl.__module__   # same key
+
+    # the second session reads the store only
+    tpl2 = TplStore(no_read, obsname, oversampling=2, directory=store).load([12, 7])
+    for o in (7, 12):
+        for x, y in zip(tpl[o], tpl2[o]):
+            np.testing.assert_array_equal(x, y)
+    wave, spec, lnwave = tpl[12]
+    assert wave.size == 2 * Inst.Tpl(obsname, order=12)[0].size
+    np.testing.assert_array_equal(lnwave, np.log(wave))
+
+
+def test_tplstore_phoenix(tmp_path):
+    # a PHOENIX model is read and stored only in the window of the orders
+    wave = np.arange(3000., 9000., 0.01)
+    fits.PrimaryHDU(wave).writeto(tmp_path / phoenix.WAVENAME)
+    tplname = str(tmp_path / phoenix.filename(5100, 4.5))
+    fits.PrimaryHDU(np.sin(wave).astype(np.float32)).writeto(tplname)
+    store = TplStore(TLS.Tpl, tplname, window=(5000, 5100), directory=str(tmp_path / 'tpl'))
+    assert store.kwargs == {'window': (5000., 5100.)}
+    wave_tpl, spec_tpl, lnwave = store.load([18, 19])[19]
+    np.testing.assert_array_equal(wave_tpl, wave[(5000 < wave) & (wave < 5100)])
+    np.testing.assert_array_equal(spec_tpl, np.sin(wave_tpl).astype(np.float32))
+    with np.load(store.filename) as f:
+        assert f['wave_18'].size == wave_tpl.size
+    phoenix.cache.fluxes.pop(tplname)[0].close()
+
+    # readers without the parameter are cut afterwards (with a sample beyond each end)
+    wave7 = Inst.Tpl(obsname, order=7)[0]
+    wmin, wmax = wave7[100], wave7[-100]
+    wave_tpl = TplStore(Inst.Tpl, obsname, window=(wmin, wmax)).load([7])[7][0]
+    np.testing.assert_array_equal(wave_tpl, wave7[99:-99])
+
+
+def test_tplstore_memory(tmp_path):
+    # without a directory nothing is written
+    obs = copy_obs(tmp_path)
+    TplStore(Inst.Tpl, obs).load([7])
+    assert os.listdir(tmp_path) == [os.path.basename(obs)]
+
+
+def test_catalog_vanished(tmp_path):
+    obs = copy_obs(tmp_path)
+    cat = Catalog(str(tmp_path / 'headers.sqlite'))
+    assert cat.select([obs], 'CRIRES', "catg like 'OBS_NODDING%'") == [obs]
+    # removed after the glob: skipped and left out of the catalogue
+    os.remove(obs)
+    assert cat.select([obs], 'CRIRES', '1') == []
+    assert list(cat.db.execute('SELECT count(*) FROM obs')) == [(0,)]
+    cat.close()
+
+
+def test_barycorr_memo():
+    # targets that repr shows alike have their own entries
+    loc = EarthLocation.from_geodetic(lat=-24.6268*u.deg, lon=-70.4045*u.deg, height=2648*u.m)
+    t = Time('2022-03-25T01:00:00')
+    a = SkyCoord(ra=10*u.deg, dec=-20*u.deg, distance=3*u.pc)
+    b = SkyCoord(ra=10.000000001*u.deg, dec=-20*u.deg, distance=3*u.pc)
+    assert repr(a) == repr(b)
+    barycorr.prepare([a, b], [t, t], loc)
+    assert barycorr._key(a, t, loc) != barycorr._key(b, t, loc)
+    assert barycorr._key(a, t, loc) in barycorr._memo and barycorr._key(b, t, loc) in barycorr._memo
+    assert barycorr.barycorr(SkyCoord(ra=10*u.deg, dec=-20*u.deg, distance=3*u.pc), t, loc) is barycorr._memo[barycorr._key(a, t, loc)]
+
+    # unknown distance and proper motion (nan) are memoised, too
+    nan = lambda: SkyCoord(ra=10*u.deg, dec=-20*u.deg, distance=np.nan*u.pc, pm_ra_cosdec=np.nan*u.mas/u.yr, pm_dec=1*u.mas/u.yr)
+    assert barycorr._key(nan(), t, loc) == barycorr._key(nan(), t, loc)
+    size = len(barycorr._memo)
+    barycorr.prepare([nan(), nan()], [t, Time('2022-08-06T02:00:00')], loc)
+    assert len(barycorr._memo) == size + 2
+    assert barycorr.barycorr(nan(), t, loc) is barycorr._memo[barycorr._key(nan(), t, loc)]
+    assert len(barycorr._memo) == size + 2
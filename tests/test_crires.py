@@ -0,0 +1,48 @@
+## Licensed under a GPLv3 style license - see LICENSE
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+directory = os.path.dirname(os.path.realpath(__file__)) + os.sep
+sys.path.insert(0, directory + '..')
+
+import inst.inst_CRIRES as Inst
+
+obsname = directory + 'test_data/SGC_220325_1.fits'
+
+
+def test_pycpl(monkeypatch):
+    # the PyCPL reader gives the same as astropy
+    pytest.importorskip('cpl')
+    assert Inst.pycpl
+    colnames = Inst.Colnames(obsname)
+    names = {1: colnames[1][:3], 3: colnames[3][-2:]}
+    cols = Inst.Columns(obsname, names)
+    info = Inst.Obsinfo(obsname)
+    spectra = Inst.Spectra(obsname)
+
+    monkeypatch.setattr(Inst, 'pycpl', 0)
+    assert colnames == Inst.Colnames(obsname)
+    for key, col in Inst.Columns(obsname, names).items():
+        np.testing.assert_array_equal(cols[key], col)
+    targdrs, setting, cal, midtime = Inst.Obsinfo(obsname)
+    assert (info[0].ra, info[0].dec, str(info[1]), str(info[3])) == (targdrs.ra, targdrs.dec, str(setting), str(midtime))
+    for x, y in zip(spectra, Inst.Spectra(obsname)):
+        np.testing.assert_array_equal(x, y)
+
+
+def test_spectra_closes(monkeypatch):
+    # the file is closed also when the header cannot be read
+    opened = []
+    fits_open = Inst.fits.open
+    monkeypatch.setattr(Inst, 'pycpl', 0)
+    monkeypatch.setattr(Inst.fits, 'open', lambda *args, **kwargs: opened.append(fits_open(*args, **kwargs)) or opened[-1])
+    def broken(filename, hdu=None):
+        raise KeyError('ESO INS WLEN ID')
+    monkeypatch.setattr(Inst, 'Obsinfo', broken)
+    with pytest.raises(KeyError):
+        Inst.Spectra(obsname, [7])
+    assert len(opened) == 1 and opened[0]._file.closed
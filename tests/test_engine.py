@@ -0,0 +1,83 @@
+## Licensed under a GPLv3 style license - see LICENSE
+
+import os
+import sys
+
+import numpy as np
+
+directory = os.path.dirname(os.path.realpath(__file__)) + os.sep
+sys.path.insert(0, directory + '..')
+
+from utils import engine
+from utils.prefetch import Prefetch
+from utils.refdata import RefData
+
+
+def square(x):
+    return x * x, os.getpid()
+
+
+def test_imap_order():
+    # the results come in task order, also when fed longest-first
+    tasks = list(range(20))
+    cost = [(7*k) % 11 for k in tasks]
+    for jobs in (1, 3):
+        res = list(engine.imap(square, tasks, jobs=jobs, cost=cost))
+        assert [r for r, pid in res] == [k*k for k in tasks]
+
+
+def test_imap_workers():
+    res = list(engine.imap(square, range(8), jobs=2))
+    assert os.getpid() not in {pid for r, pid in res}
+    res = list(engine.imap(square, range(8), jobs=1))
+    assert {pid for r, pid in res} == {os.getpid()}
+
+
+def test_imap_callback():
+    # the callback sees each result once, with the index of its task
+    seen = {}
+    res = list(engine.imap(square, [3, 1, 2], jobs=2, cost=[1, 3, 2], callback=seen.__setitem__))
+    assert seen == dict(enumerate(res))
+
+
+def test_njobs():
+    assert engine.njobs(2) == 2
+    assert engine.njobs(0) == os.cpu_count()
+    assert engine.njobs(-os.cpu_count()) == 1
+
+
+def test_prefetch():
+    loaded = []
+    def load(key):
+        loaded.append(key)
+        return 2 * key
+    pre = Prefetch(load, 'abcd', ahead=2)
+    assert [pre[k] for k in 'abcd'] == ['aa', 'bb', 'cc', 'dd']
+    # each key is loaded once; at most the current and the next two are held
+    assert sorted(loaded) == list('abcd')
+    assert list(pre.futures) == ['d']
+    # a key out of sequence is loaded alone
+    assert pre['x'] == 'xx' and list(pre.futures) == ['x']
+    pre.close()
+    assert pre.pool is None and pre.futures == {}
+
+
+def test_refdata():
+    refdata = RefData()
+    try:
+        x = refdata.share('x', np.arange(10.))
+        d = refdata.share_dict('d', {7: np.ones(3), 12: np.zeros(2, dtype=int)})
+        assert not x.flags.writeable
+        assert refdata.nbytes >= x.nbytes + 3*8 + 2*d[12].itemsize
+        arrays = RefData.attach(refdata.spec())
+        np.testing.assert_array_equal(arrays['x'], x)
+        assert arrays['d[12]'].dtype == d[12].dtype
+        # attached arrays map the same block
+        np.ndarray(10, buffer=refdata.blocks['x'][0].buf)[3] = -1
+        assert arrays['x'][3] == x[3] == -1
+        # forked workers read the shared arrays
+        res = list(engine.imap(lambda i: (x[i], os.getpid()), range(4), jobs=2))
+        assert [v for v, pid in res] == [0, 1, 2, -1]
+    finally:
+        refdata.unlink()
+    assert refdata.blocks == {}
@@ -0,0 +1,140 @@
+## Licensed under a GPLv3 style license - see LICENSE
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+directory = os.path.dirname(os.path.realpath(__file__)) + os.sep
+sys.path.insert(0, directory + '..')
+
+import utils.model
+from utils.model import model, IPs, c, pade
+from utils.param import Params
+
+
+def lines(u, centers, depth=0.5, width=2e-5):
+    # absorption lines in log-wavelength
+    return 1 - depth * np.exp(-0.5*((u[:, np.newaxis]-centers)/width)**2).sum(axis=1)
+
+
+def setup(ip='g', IP_hs=50, **kwargs):
+    # synthetic chunk around 5000 A, 100 m/s sampling
+    rng = np.random.default_rng(42)
+    dx = 0.1 / c
+    lnwave_j = np.log(4990) + dx * np.arange(25000)
+    u0, u1 = lnwave_j[[0, -1]]
+    # template sampled at 0.5 km/s and interpolated as in viper
+    lnwave_tpl = np.arange(u0-0.01, u1+0.01, 0.5/c)
+    spec_tpl = lines(lnwave_tpl, rng.uniform(u0, u1, 80))
+    S_star = lambda u: np.interp(u, lnwave_tpl, spec_tpl)
+    spec_cell_j = lines(lnwave_j, rng.uniform(u0, u1, 150), depth=0.3, width=1e-5)
+    fluxes_molec = np.array([lines(lnwave_j, rng.uniform(u0, u1, 20), depth=0.4), lines(lnwave_j, rng.uniform(u0, u1, 20), depth=0.2)])
+    fluxes_molec[1, :50] = np.nan   # missing values are skipped in the product
+    return model(S_star, lnwave_j, spec_cell_j, fluxes_molec, IPs[ip], IP_hs=IP_hs, xcen=1000, **kwargs)
+
+
+def params(**kwargs):
+    par = Params(rv=(1.3, np.inf), norm=[(1000, np.inf), (0.01, np.inf), (-1e-5, np.inf)], wave=[(5005, np.inf), (0.006, np.inf), (1e-8, np.inf)],
+                 ip=[(2.5, np.inf)], atm=[(0.8, np.inf), (1.2, np.inf), (0.33, np.inf)], bkg=[(0.02, np.inf)])
+    par.update(kwargs)
+    return par
+
+
+def step(key, value):
+    # small against the 100 m/s grid, since the model is piecewise linear
+    if key[0] == 'wave':
+        return 1e-7 / 1000.**key[1]   # 1e-7 A at x ~ 1000
+    if key in ('rv', ('atm', 2)):
+        return 1e-5   # 1 cm/s
+    return 1e-6 * (abs(value) or 1)
+
+
+def numeric(S_mod, pixel, par, keys):
+    # central differences of the full model
+    J = np.empty((len(pixel), len(keys)))
+    for n, key in enumerate(keys):
+        h = step(key, par[key])
+        f = [S_mod(pixel, **(par + {key: par[key]+s*h})) for s in (1, -1)]
+        J[:, n] = (f[0]-f[1]) / (2*h)
+    return J
+
+
+class test_model(unittest.TestCase):
+    pixel = np.arange(100, 1900, 1.)
+
+    def assertJacobian(self, S_mod, par):
+        keys = [*par.vary()]
+        J = S_mod.jacobian(self.pixel, keys, **par)
+        J_num = numeric(S_mod, self.pixel, par, keys)
+        for n, key in enumerate(keys):
+            err = np.linalg.norm(J[:, n]-J_num[:, n]) / np.linalg.norm(J_num[:, n])
+            self.assertLess(err, 1e-3, key)
+
+    def test_jacobian(self):
+        self.assertJacobian(setup(), params())
+
+    def test_jacobian_ipB(self):
+        self.assertJacobian(setup(), params(ipB=[(0.9, np.inf)]))
+
+    def test_jacobian_ip(self):
+        self.assertJacobian(setup('ag'), params(ip=[(2.5, np.inf), (1., np.inf)]))
+
+    def test_jacobian_pade(self):
+        S_mod = setup()
+        S_mod.func_norm = lambda x, par_norm: pade(x, par_norm[:2], par_norm[2:])
+        self.assertJacobian(S_mod, params(norm=[(1000, np.inf), (0.01, np.inf), (5e-7, np.inf)]))
+
+    def test_fit(self):
+        # the fit with the Jacobian finds the same parameters
+        par = params()
+        spec_obs = setup()(self.pixel, **par)
+        guess = par + {'rv': 1.0, ('ip', 0): 2.3, ('atm', 0): 0.7, ('wave', 0): 5005.001}
+        sig = np.ones_like(spec_obs)
+        p_fd, _ = setup().fit(self.pixel, spec_obs, guess, sig=sig)
+        p_jac, e_jac = setup(jac=True).fit(self.pixel, spec_obs, guess, sig=sig)
+        self.assertAlmostEqual(p_jac.rv, par.rv, places=6)
+        self.assertAlmostEqual(p_jac.rv, p_fd.rv, places=6)
+        self.assertEqual(e_jac.shape, (len(par.vary()),)*2)
+
+    def test_varpro(self):
+        # the variable projection finds the same parameters and covariance
+        par = params()
+        rng = np.random.default_rng(1)
+        spec_obs = setup()(self.pixel, **par)
+        spec_obs += rng.normal(0, 2, spec_obs.size)
+        sig = np.full_like(spec_obs, 2.)
+        guess = par + {'rv': 1.0, ('ip', 0): 2.3, ('norm', 0): 900}
+        p_full, e_full = setup().fit(self.pixel, spec_obs, guess, sig=sig)
+        for jac in (False, True):
+            p_vp, e_vp = setup(varpro=True, jac=jac).fit(self.pixel, spec_obs, guess, sig=sig)
+            for key in par.vary():
+                self.assertLess(abs(p_vp[key]-p_full[key]), 0.01*p_full[key].unc, key)
+            np.testing.assert_allclose(np.sqrt(np.diag(e_vp)), np.sqrt(np.diag(e_full)), rtol=1e-2)
+
+    def test_fft(self):
+        # a wide IP is convolved by FFT with the same result
+        S_mod = setup(IP_hs=300)
+        for par in (params(), params(ipB=[(0.9, np.inf)])):
+            S_fft = S_mod(self.pixel, **par)
+            taps, utils.model.FFT_TAPS = utils.model.FFT_TAPS, 10**6
+            try:
+                S_mod.memo.clear()
+                S_direct = S_mod(self.pixel, **par)
+            finally:
+                utils.model.FFT_TAPS = taps
+            np.testing.assert_allclose(S_fft, S_direct, rtol=1e-12)
+        self.assertJacobian(setup(IP_hs=300), params(ipB=[(0.9, np.inf)]))
+
+    def test_sparse(self):
+        # the convolution at the bracketing grid points only gives the same model
+        for par in (params(), params(ipB=[(0.9, np.inf)])):
+            pixel = self.pixel[::3]   # e.g. clipped pixels
+            np.testing.assert_allclose(setup(sparse=True)(pixel, **par), setup()(pixel, **par), rtol=1e-12)
+            keys = [*par.vary()]
+            np.testing.assert_allclose(setup(sparse=True).jacobian(pixel, keys, **par), setup().jacobian(pixel, keys, **par), rtol=1e-8, atol=1e-8)
+
+
+if __name__ == '__main__':
+    unittest.main()
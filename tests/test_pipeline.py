@@ -0,0 +1,227 @@
+## Licensed under a GPLv3 style license - see LICENSE
+
+import json
+import os
+import shutil
+import sys
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer
+
+import numpy as np
+import pytest
+
+directory = os.path.dirname(os.path.realpath(__file__)) + os.sep
+sys.path.insert(0, directory + '..')
+
+import viper
+from utils.service import Service, Handler, fit
+
+# two observations, two orders and two chunks; the fake cell keeps it fast
+ARGS = [directory+'test_data/SGC*', directory+'test_compare/test_tpl.fits', '-inst', 'CRIRES', '-fts', 'None',
+        '-deg_norm', '2', '-deg_wave', '2', '-deg_bkg', '1', '-telluric', 'add', '-kapsig', '0', '4.5', '-oset', '7,12', '-chunks', '2']
+
+
+def run_viper(tmp_path, tag, *options):
+    '''Run viper in tmp_path and return the .rvo.dat and .par.dat output.'''
+    tag = str(tmp_path / tag)
+    viper.run(ARGS + ['-tag', tag, *options])
+    with open(tag+'.rvo.dat') as rvo, open(tag+'.par.dat') as par:
+        return rvo.read(), par.read()
+
+
+def assert_same_output(out, ref):
+    # byte-identical .rvo.dat and .par.dat (the timing lines go to stdout only)
+    assert out == ref
+
+
+def test_jobs(tmp_path, monkeypatch):
+    # the parallel run writes the same output as the serial one
+    monkeypatch.chdir(tmp_path)
+    serial = run_viper(tmp_path, 'serial')
+    parallel = run_viper(tmp_path, 'parallel', '-jobs', '2')
+    assert_same_output(parallel, serial)
+    assert len(serial[0].splitlines()) == 3
+
+
+def test_jobs_prefetch(tmp_path, monkeypatch):
+    # with an observation per worker, each worker reads its observation once, all orders at a time
+    monkeypatch.chdir(tmp_path)
+    reads = tmp_path / 'reads'
+    read_obs = viper.Pipeline.read_obs
+    def logged(self, obsname):
+        with open(reads, 'a') as f:
+            print(os.getpid(), os.path.basename(obsname), file=f)
+        return read_obs(self, obsname)
+    monkeypatch.setattr(viper.Pipeline, 'read_obs', logged)
+    run_viper(tmp_path, 'parallel', '-jobs', '2')
+    rows = reads.read_text().splitlines()[1:]   # the first read is the one of the windows
+    assert sorted(row.split()[1] for row in rows) == ['SGC_220325_1.fits', 'SGC_220806_1.fits']
+    assert str(os.getpid()) not in {row.split()[0] for row in rows}
+
+
+def test_par_failed(tmp_path, monkeypatch):
+    # the column failed is written only with a budget
+    monkeypatch.chdir(tmp_path)
+    rvo, par = run_viper(tmp_path, 'plain')
+    head, row = par.splitlines()[:2]
+    assert head.split()[-1] == 'prms' and len(row.split()) == len(head.split())
+    rvo, par = run_viper(tmp_path, 'budget', '-maxfev', '100000')
+    head, row = par.splitlines()[:2]
+    assert head.split()[-2:] == ['prms', 'failed'] and row.split()[-1] == '0'
+
+
+def test_read_obs(monkeypatch):
+    # a failing Spectra falls back to single orders; a bad order fails alone
+    pipe = viper.Pipeline(ARGS)
+    obsname = pipe.obsnames[1]
+    ref = pipe.read_obs(obsname)
+    Spectra = pipe.Inst.Spectra
+    def all_or_one(obsname, orders, targ=None):
+        if len(orders) > 1:
+            raise ValueError('ragged')
+        return Spectra(obsname, orders, targ=targ)
+    Spectrum = pipe.Spectrum
+    def bad12(obsname, order=None, targ=None):
+        if order == 12:
+            raise OSError('bad order')
+        return Spectrum(obsname, order=order, targ=targ)
+    monkeypatch.setattr(pipe.Inst, 'Spectra', all_or_one)
+    monkeypatch.setattr(pipe, 'Spectrum', bad12)
+    spectra = pipe.read_obs(obsname)
+    pipe.close()
+    assert list(spectra) == [7]
+    for x, y in zip(spectra[7], ref[7]):
+        np.testing.assert_array_equal(x, y)
+
+
+def test_select_where(tmp_path):
+    catalog = str(tmp_path / 'headers.sqlite')
+    select = lambda where: [os.path.basename(x) for x in viper.select_obs(ARGS[0], where=where, inst='CRIRES', catalog=catalog)]
+    assert select('') == select('1') == ['SGC_220325_1.fits', 'SGC_220806_1.fits']
+    assert select("date > '2022-06'") == ['SGC_220806_1.fits']
+    assert select("setting = 'none'") == []
+
+
+def count_fits(monkeypatch):
+    # the chunks fitted in this process
+    fitted = []
+    fit_chunk = viper.Pipeline.fit_chunk
+    def counted(self, order, chunk, obsname, **kwargs):
+        fitted.append((obsname, order, chunk))
+        return fit_chunk(self, order, chunk, obsname, **kwargs)
+    monkeypatch.setattr(viper.Pipeline, 'fit_chunk', counted)
+    return fitted
+
+
+def test_resume(tmp_path, monkeypatch):
+    # a run killed while journaling the fourth chunk continues with it
+    monkeypatch.chdir(tmp_path)
+    full = run_viper(tmp_path, 'full')
+    with open(tmp_path / 'full.journal') as f:
+        lines = f.readlines()
+    assert len(lines) == 1 + 8
+    with open(tmp_path / 'part.journal', 'w') as f:
+        f.writelines(lines[:4])
+        f.write(lines[4][:len(lines[4])//2])
+
+    fitted = count_fits(monkeypatch)
+    part = run_viper(tmp_path, 'part', '-resume')
+    assert len(fitted) == 5
+    assert_same_output(part, full)
+
+
+def test_fitcache(tmp_path, monkeypatch):
+    # a second run takes all chunks from the cache; other code misses
+    monkeypatch.chdir(tmp_path)
+    fitted = count_fits(monkeypatch)
+    first = run_viper(tmp_path, 'first', '-cache', 'fits')
+    assert len(fitted) == 8
+    second = run_viper(tmp_path, 'second', '-cache', 'fits')
+    assert len(fitted) == 8
+    assert second == first
+
+    filehash = viper.filehash
+    monkeypatch.setattr(viper, 'filehash', lambda f: filehash(f) + ('*' if f.endswith('model.py') else ''))
+    run_viper(tmp_path, 'third', '-cache', 'fits')
+    assert len(fitted) == 16
+
+
+def stop_watch(monkeypatch, polls):
+    # the watch is stopped (as with ctrl-c) at the poll number polls
+    count = []
+    def sleep(seconds):
+        count.append(seconds)
+        if len(count) == polls:
+            raise KeyboardInterrupt
+    monkeypatch.setattr(viper.time, 'sleep', sleep)
+
+
+def test_watch_restart(tmp_path, monkeypatch):
+    # a restarted watch rebuilds the rows of the journaled observations and fits only the new one
+    monkeypatch.chdir(tmp_path)
+    full = run_viper(tmp_path, 'full')
+    os.mkdir(tmp_path / 'obs')
+    args = [str(tmp_path / 'obs' / 'SGC*'), *ARGS[1:], '-tag', str(tmp_path / 'watch'), '-watch', '1']
+    fitted = count_fits(monkeypatch)
+
+    shutil.copy(directory+'test_data/SGC_220325_1.fits', tmp_path / 'obs')
+    stop_watch(monkeypatch, 2)   # waiting for complete files, then no new ones
+    viper.run(args)
+    assert len(fitted) == 4
+
+    # killed: the output is lost, the journal remains
+    os.remove(tmp_path / 'watch.rvo.dat')
+    os.remove(tmp_path / 'watch.par.dat')
+    shutil.copy(directory+'test_data/SGC_220806_1.fits', tmp_path / 'obs')
+    stop_watch(monkeypatch, 2)
+    viper.run(args)
+    assert len(fitted) == 8
+    assert {os.path.basename(obs) for obs, o, ch in fitted[4:]} == {'SGC_220806_1.fits'}
+    with open(tmp_path / 'watch.rvo.dat') as rvo, open(tmp_path / 'watch.par.dat') as par:
+        assert_same_output((rvo.read(), par.read()), full)
+
+
+@pytest.fixture
+def service(tmp_path, monkeypatch):
+    # a service on a free port; the jobs run in a thread of the test
+    monkeypatch.chdir(tmp_path)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.service = Service()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    jobs = threading.Thread(target=server.service.serve)
+    jobs.start()
+    yield 'http://127.0.0.1:%d' % server.server_address[1]
+    server.service.stop()
+    jobs.join()
+    server.shutdown()
+    server.server_close()
+    server.service.close()
+
+
+def test_service(service, tmp_path):
+    pipe = viper.Pipeline(ARGS)
+    ref = pipe.run()
+    pipe.close()
+
+    # concurrent clients are queued
+    with ThreadPoolExecutor(2) as pool:
+        results = list(pool.map(lambda tag: fit(ARGS + ['-tag', tag], url=service), ['a', 'b']))
+    for res in results:
+        assert [os.path.basename(x) for x in res['obsnames']] == ['SGC_220325_1.fits', 'SGC_220806_1.fits']
+        np.testing.assert_allclose(res['RV'], ref['RV'], rtol=1e-10)
+
+    # the loaded pipeline runs with the cache of the job
+    fit(ARGS + ['-cache', str(tmp_path / 'fits')], url=service)
+    assert len(os.listdir(tmp_path / 'fits')) == 8
+    with urllib.request.urlopen(service) as f:
+        assert json.load(f) == {'pipelines': 1, 'queued': 0}
+
+
+def test_service_rejects(service):
+    with pytest.raises(RuntimeError, match='-where'):
+        fit(ARGS + ['-where', "object='x'"], url=service)
+    # the index options are evaluated
+    with pytest.raises(RuntimeError, match='invalid arguments'):
+        fit(ARGS + ['-oset', '__import__("os").getpid()'], url=service)
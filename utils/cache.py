@@ -0,0 +1,139 @@
+#! /usr/bin/env python3
+# Licensed under a GPLv3 style license - see LICENSE
+
+# Content-addressed on-disk cache for the results of chunk fits.
+
+import hashlib
+import json
+import os
+import pickle
+
+_filehashes = {}   # (path, size, mtime): digest
+
+
+def filehash(filename):
+    '''
+    SHA-256 digest of the file content.
+
+    The digest is memoised by path, size and modification time, so each file is read only once.
+
+    Example
+    -------
+    >>> import tempfile
+    >>> filename = os.path.join(tempfile.mkdtemp(), 'test_filehash.txt')
+    >>> with open(filename, 'w') as f: _ = f.write('viper')
+    >>> filehash(filename)[:16]
+    '895d1ba9ca06739e'
+    >>> os.remove(filename)
+    '''
+    st = os.stat(filename)
+    id = os.path.realpath(filename), st.st_size, st.st_mtime_ns
+    if id not in _filehashes:
+        h = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b''):
+                h.update(block)
+        _filehashes[id] = h.hexdigest()
+    return _filehashes[id]
+
+
+def hashkey(*items):
+    '''
+    Digest of JSON serialisable items (other objects enter with their str).
+
+    Example
+    -------
+    >>> hashkey({'b': 1, 'a': [2, 3]}) == hashkey({'a': [2, 3], 'b': 1})
+    True
+    '''
+    return hashlib.sha256(json.dumps(items, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class FitCache:
+    '''
+    Directory of pickled fit results named by their key.
+
+    Entries are written atomically, so several processes can share a cache. A hit
+    refreshes the modification time of the entry; when the total size exceeds
+    maxsize, the least recently used entries are removed.
+
+    Parameters
+    ----------
+    directory : str
+        Cache directory. It is created if needed.
+    maxsize : float
+        Size limit [MB].
+
+    Example
+    -------
+    >>> import tempfile
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> cache = FitCache(tmpdir, maxsize=1)
+    >>> key = hashkey('obs.fits', 7, 0)
+    >>> cache.get(key) is None
+    True
+    >>> cache.put(key, (1.5, 0.1))
+    >>> cache.get(key)
+    (1.5, 0.1)
+    >>> cache.clear(); os.rmdir(tmpdir)
+    '''
+    def __init__(self, directory, maxsize=1000):
+        self.directory = directory
+        self.maxsize = maxsize * 2**20
+        self.hits = self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key+'.pkl')
+
+    def get(self, key):
+        '''Return the stored value or None.'''
+        filename = self.path(key)
+        try:
+            with open(filename, 'rb') as f:
+                value = pickle.load(f)
+            os.utime(filename)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            # missing, evicted meanwhile, or incomplete
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        '''Store a value and evict old entries.'''
+        filename = self.path(key)
+        tmpname = f'{filename}.{os.getpid()}.tmp'
+        with open(tmpname, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpname, filename)
+        self.evict()
+
+    def entries(self):
+        '''List of (mtime, size, filename), least recently used first.'''
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.pkl'):
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, entry.path))
+        return sorted(entries)
+
+    def evict(self):
+        '''Remove the least recently used entries until the cache fits into maxsize.'''
+        entries = self.entries()
+        size = sum(e[1] for e in entries)
+        for _, nbytes, filename in entries:
+            if size <= self.maxsize:
+                break
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            size -= nbytes
+
+    def clear(self):
+        for _, _, filename in self.entries():
+            os.remove(filename)
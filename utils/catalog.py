@@ -0,0 +1,113 @@
+#! /usr/bin/env python3
+# Licensed under a GPLv3 style license - see LICENSE
+
+# SQLite catalogue of the primary headers for the selection of observations.
+#
+# viper updates the catalogue for the files matching obspath (only new or modified
+# files are opened) and selects with an SQL condition on its columns:
+#    viper '/data/CRIRES/*.fits' tpl.fits -inst CRIRES -where "setting='K2166' and date>'2022-03'"
+
+import os
+import sqlite3
+
+from astropy.io import fits
+
+CATALOG = os.path.join(os.path.expanduser('~'), '.cache', 'viper', 'headers.sqlite')
+
+# column: header keyword (or keywords, the first present is taken)
+# Instrument modules can override them with a dict header_keys.
+KEYS = {
+    'date': ['DATE-OBS', 'DATE'],
+    'object': 'OBJECT',
+    'ra': 'RA',
+    'dec': 'DEC',
+    'setting': [],
+    'catg': 'ESO PRO CATG',
+    'exptime': ['EXPTIME', 'EXP_TIME', 'EXPOSURE'],
+}
+
+COLUMNS = ['filename', 'inst', 'size', 'mtime', *KEYS]
+
+
+def header_values(filename, keys=KEYS):
+    '''The catalogue values from the primary header (None for missing keywords or unreadable files).'''
+    try:
+        hdr = fits.getheader(filename)
+    except Exception:
+        return {col: None for col in keys}
+    values = {}
+    for col, kws in keys.items():
+        kws = [kws] if isinstance(kws, str) else kws
+        value = next((hdr[kw] for kw in kws if kw in hdr), None)
+        values[col] = value if isinstance(value, (int, float, str)) or value is None else str(value)
+    return values
+
+
+class Catalog:
+    '''
+    Header catalogue of observations.
+
+    Rows are keyed by the real path of the file and refreshed when its size or
+    modification time changes.
+
+    Parameters
+    ----------
+    filename : str
+        SQLite database. It is created if needed.
+
+    Example
+    -------
+    >>> import tempfile
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> cat = Catalog(os.path.join(tmpdir, 'test_catalog.sqlite'))
+    >>> files = ['tests/test_data/SGC_220325_1.fits', 'tests/test_data/SGC_220806_1.fits']
+    >>> [os.path.basename(f) for f in cat.select(files, 'CRIRES', "date > '2022-06'")]
+    ['SGC_220806_1.fits']
+    >>> cat.close(); os.remove(os.path.join(tmpdir, 'test_catalog.sqlite')); os.rmdir(tmpdir)
+    '''
+    def __init__(self, filename=CATALOG):
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        self.db = sqlite3.connect(filename, timeout=60)
+        self.db.execute('CREATE TABLE IF NOT EXISTS obs (filename TEXT PRIMARY KEY, inst TEXT, size INTEGER, mtime INTEGER, '
+                        + ', '.join(KEYS) + ')')
+
+    def update(self, filenames, inst, keys=None):
+        '''Add new and modified files to the catalogue and remove the files that vanished.'''
+        keys = {**KEYS, **(keys or {})}
+        known = {row[0]: row[1:] for row in self.db.execute('SELECT filename, inst, size, mtime FROM obs')}
+        rows = []
+        vanished = []
+        for filename in filenames:
+            path = os.path.realpath(filename)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                # removed since the glob (e.g. while watching)
+                vanished.append((path,))
+                continue
+            if known.get(path) != (inst, st.st_size, st.st_mtime_ns):
+                values = header_values(path, keys)
+                rows.append([path, inst, st.st_size, st.st_mtime_ns, *[values[col] for col in KEYS]])
+        if rows or vanished:
+            with self.db:
+                self.db.executemany('INSERT OR REPLACE INTO obs VALUES (' + ', '.join('?'*len(COLUMNS)) + ')', rows)
+                self.db.executemany('DELETE FROM obs WHERE filename = ?', vanished)
+
+    def select(self, filenames, inst, where, keys=None):
+        '''
+        The files fulfilling the SQL condition where (in the given order).
+
+        The condition can use the columns filename, inst, size, mtime, date, object,
+        ra, dec, setting, catg, and exptime.
+        '''
+        self.update(filenames, inst, keys)
+        paths = [os.path.realpath(filename) for filename in filenames]
+        with self.db:
+            self.db.execute('CREATE TEMP TABLE IF NOT EXISTS sel (filename TEXT PRIMARY KEY)')
+            self.db.execute('DELETE FROM sel')
+            self.db.executemany('INSERT OR IGNORE INTO sel VALUES (?)', [(path,) for path in paths])
+            found = {row[0] for row in self.db.execute(f'SELECT filename FROM obs JOIN sel USING (filename) WHERE ({where})')}
+        return [filename for filename, path in zip(filenames, paths) if path in found]
+
+    def close(self):
+        self.db.close()
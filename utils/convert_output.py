@@ -28,7 +28,7 @@ class convert_data:
                 deletechars='', encoding=None).view(np.recarray)
             self.header_par = self.data_par.dtype.names
             
-        self.args = vars(args)
+        self.args = dict(vars(args))   # a copy, the options are still in use
         self.args.pop('config_file', None)
         self.args.pop('ftsname', None)
         self.args = {key: self.args[key] for key in self.args if 'look' not in key}           
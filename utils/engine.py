@@ -0,0 +1,134 @@
+#! /usr/bin/env python3
+# Licensed under a GPLv3 style license - see LICENSE
+
+# Execution engine for independent fit tasks.
+
+import multiprocessing
+import os
+
+
+def njobs(jobs):
+    '''
+    Number of worker processes.
+
+    jobs: Requested number of processes. 0 or negative values count from the number of cores.
+
+    Example
+    -------
+    >>> njobs(3)
+    3
+    >>> njobs(0) == os.cpu_count()
+    True
+    '''
+    if jobs < 1:
+        jobs += os.cpu_count()
+    return max(jobs, 1)
+
+
+def available_memory():
+    '''Available memory [bytes] (None if unknown).'''
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def memcap(jobs, memory, overhead=200*2**20):
+    '''
+    Limit the number of processes to the available memory.
+
+    jobs: Number of processes.
+    memory: Estimated memory of a task [bytes].
+    overhead: Memory of a worker process besides the task [bytes].
+
+    Example
+    -------
+    >>> memcap(4, 0)
+    4
+    >>> memcap(4, 2**50)
+    1
+    '''
+    avail = available_memory()
+    if avail is None:
+        return jobs
+    return int(max(1, min(jobs, 0.8 * avail // (memory + overhead))))
+
+
+def imap(func, tasks, jobs=1, cost=None, callback=None):
+    '''
+    Map func over tasks and yield the results in the order of tasks.
+
+    With jobs=1 the tasks are processed serially in the current process.
+    Otherwise they are farmed to a pool of forked worker processes, which
+    inherit the state of the parent (e.g. the loaded reference data).
+
+    Parameters
+    ----------
+    func : callable
+        Function with a single argument.
+    tasks : list
+        Arguments for func.
+    jobs : int
+        Number of processes (see njobs).
+    cost : list, optional
+        Estimated cost of each task. The pool is fed with the most expensive tasks first,
+        so that no long task is left at the end. The results still come in the order of tasks.
+    callback : callable, optional
+        Called in the parent as callback(k, result) with the index of the task as soon as
+        its result arrives, while the result may still wait for its turn (e.g. to checkpoint it).
+
+    Example
+    -------
+    >>> list(imap(abs, [-1, 2, -3], jobs=2))
+    [1, 2, 3]
+    >>> list(imap(abs, [-1, 2, -3], jobs=2, cost=[1, 3, 2]))
+    [1, 2, 3]
+    >>> list(imap(abs, [-1, 2], callback=print))
+    0 1
+    1 2
+    [1, 2]
+    '''
+    jobs = njobs(jobs)
+    if jobs == 1:
+        for k, task in enumerate(tasks):
+            result = func(task)
+            if callback:
+                callback(k, result)
+            yield result
+        return
+
+    # longest processing time first
+    order = range(len(tasks)) if cost is None else sorted(range(len(tasks)), key=lambda i: -cost[i])
+
+    ctx = multiprocessing.get_context('fork')
+    # func is handed to the forked workers once (not pickled per task), so bound methods
+    # of objects holding large data are fine
+    with ctx.Pool(min(jobs, len(tasks) or 1), initializer=_init, initargs=(func,)) as pool:
+        # results arrive in any order and are buffered until they are due
+        done = {}
+        i = 0
+        for k, result in pool.imap_unordered(_call, [(k, tasks[k]) for k in order], chunksize=1):
+            if callback:
+                callback(k, result)
+            done[k] = result
+            while i in done:
+                yield done.pop(i)
+                i += 1
+
+
+_func = None
+
+def _init(func):
+    global _func
+    _func = func
+
+def _call(item):
+    k, task = item
+    return k, _func(task)
@@ -0,0 +1,56 @@
+#! /usr/bin/env python3
+# Licensed under a GPLv3 style license - see LICENSE
+
+# On-disk cache of the resampled FTS cell spectra.
+
+import os
+import sys
+
+import numpy as np
+
+from utils.cache import filehash, hashkey
+
+NAMES = ('w', 'f', 'uj', 'iod_j')
+
+
+def cached_fts(FTS, ftsname, directory, dv=100):
+    '''
+    The resampled FTS (w, f, uj, iod_j) of an instrument FTS function, cached on disk.
+
+    With dv=None, the FTS is not resampled (uj, iod_j are None) and only w, f are cached.
+
+    The first call reads and resamples the FTS and stores the arrays as .npy files.
+    Later calls map them read-only into memory. The key is the FTS path, its size and
+    modification time, dv, and the instrument module (which may convert the FTS).
+
+    Example
+    -------
+    >>> import shutil, tempfile
+    >>> from inst.inst_TLS import FTS
+    >>> ftsname = 'lib/TLS/FTS/TLS_I2_FTS.fits'
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> fts = cached_fts(FTS, ftsname, tmpdir)
+    >>> fts = cached_fts(FTS, ftsname, tmpdir)
+    >>> all(np.array_equal(a, b) for a, b in zip(fts, FTS(ftsname)))
+    True
+    >>> shutil.rmtree(tmpdir)
+    '''
+    st = os.stat(ftsname)
+    module = sys.modules[FTS.__module__]
+    key = hashkey(os.path.realpath(ftsname), st.st_size, st.st_mtime_ns, dv, FTS.__module__, filehash(module.__file__))
+    base = os.path.join(directory, key[:32])
+    names = NAMES if dv else NAMES[:2]   # dv=None: FTS not resampled
+    try:
+        arrays = [np.load(f'{base}.{name}.npy', mmap_mode='r') for name in names]
+        return (*arrays, *[None]*(len(NAMES)-len(names)))
+    except (OSError, ValueError):
+        pass
+
+    arrays = FTS(ftsname, dv=dv)
+    os.makedirs(directory, exist_ok=True)
+    # written atomically, so concurrent runs can share the cache
+    for name, x in zip(names, arrays):
+        tmpname = f'{base}.{name}.{os.getpid()}.tmp.npy'
+        np.save(tmpname, np.ascontiguousarray(x))
+        os.replace(tmpname, f'{base}.{name}.npy')
+    return arrays
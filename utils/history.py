@@ -0,0 +1,62 @@
+#! /usr/bin/env python3
+# Licensed under a GPLv3 style license - see LICENSE
+
+# Runtime history of the chunk fits for the task scheduling.
+
+import json
+import os
+
+
+class History:
+    '''
+    Mean runtimes of chunk fits from previous runs.
+
+    The keys identify a kind of task, e.g. instrument, order and option set. The
+    mean runs over the last ~10 runs, so the history follows changes of the code
+    and the machine. Without a filename, the history is kept only in memory.
+
+    Example
+    -------
+    >>> import tempfile
+    >>> filename = os.path.join(tempfile.mkdtemp(), 'runtimes.json')
+    >>> hist = History(filename)
+    >>> hist.update('CRIRES 7', 2.); hist.update('CRIRES 7', 4.)
+    >>> hist.estimate('CRIRES 7'), hist.estimate('CRIRES 8')
+    (3.0, 3.0)
+    >>> hist.save()
+    >>> History(filename).estimate('CRIRES 7')
+    3.0
+    >>> os.remove(filename)
+    '''
+    def __init__(self, filename=''):
+        self.filename = filename
+        self.times = {}   # key: [mean, count]
+        if filename:
+            try:
+                with open(filename) as f:
+                    self.times = json.load(f)
+            except (OSError, ValueError):
+                pass
+
+    def estimate(self, key, default=1.):
+        '''Mean runtime of a task kind. Unknown kinds get the mean of all kinds (or default).'''
+        if key in self.times:
+            return self.times[key][0]
+        if self.times:
+            return sum(t for t, _ in self.times.values()) / len(self.times)
+        return default
+
+    def update(self, key, runtime):
+        mean, count = self.times.get(key, (runtime, 0))
+        count = min(count+1, 10)
+        self.times[key] = [mean + (runtime-mean)/count, count]
+
+    def save(self):
+        '''Write the history (atomically, as concurrent runs may share it).'''
+        if not self.filename:
+            return
+        os.makedirs(os.path.dirname(self.filename) or '.', exist_ok=True)
+        tmpname = f'{self.filename}.{os.getpid()}.tmp'
+        with open(tmpname, 'w') as f:
+            json.dump(self.times, f, indent=0)
+        os.replace(tmpname, self.filename)
@@ -0,0 +1,138 @@
+#! /usr/bin/env python3
+# Licensed under a GPLv3 style license - see LICENSE
+
+# Journal of finished fit tasks for checkpointing and resuming viper runs.
+
+import json
+import os
+
+import numpy as np
+
+from utils.param import Params
+
+
+def params2list(par):
+    '''
+    Serialise Params to a list of [name, index, value, unc].
+
+    Example
+    -------
+    >>> par = Params(rv=(1.5, 0.1), norm=[(2, 0.2), 3])
+    >>> params2list(par)
+    [['rv', None, 1.5, 0.1], ['norm', 0, 2, 0.2], ['norm', 1, 3, None]]
+    >>> list2params(params2list(par))
+    rv: 1.5 ± 0.1
+    norm: [2 ± 0.2, 3]
+    '''
+    return [[*(k if isinstance(k, tuple) else (k, None)), v.value, v.unc] for k, v in par.flat().items()]
+
+
+def list2params(items):
+    '''Inverse of params2list.'''
+    par = Params()
+    for name, idx, value, unc in items:
+        if idx is None:
+            par[name] = (value, unc)
+        else:
+            par[name] = par.get(name, []) + [(value, unc)]
+    return par
+
+
+class Journal:
+    '''
+    Append-only record of the finished fit tasks.
+
+    The first line holds the run options; each further line is a JSON record of one
+    (observation, order, chunk) task with its fit result, the template products and the
+    error message. A record is written with a single write and synced to disk, so an
+    interrupted run leaves at most one truncated last line, which is ignored.
+
+    Tasks that failed without a result (e.g. an I/O error) are not recorded, so a resumed
+    run tries them again. Chunks over their budget have a result and are recorded.
+
+    Example
+    -------
+    >>> import tempfile
+    >>> filename = os.path.join(tempfile.mkdtemp(), 'test.journal')
+    >>> jn = Journal(filename, header={'oset': '7,12'})
+    >>> par = Params(rv=(1.5, 0.1), norm=[(2, 0.2)])
+    >>> jn.add(('a.fits', 7, 0), (1.5, 0.1, 2459000.5, 3.2, par, np.eye(2), 0.8), {}, None)
+    >>> jn.add(('a.fits', 12, 0), None, {}, "OSError('read error')")
+    >>> jn.close()
+    >>> jn = Journal(filename, header={'oset': '7,12'}, resume=True)  # doctest: +ELLIPSIS
+    resuming from ... with 1 finished tasks
+    >>> result, products, err = jn[('a.fits', 7, 0)]
+    >>> result[4]
+    rv: 1.5 ± 0.1
+    norm: [2 ± 0.2]
+    >>> ('a.fits', 12, 0) in jn
+    False
+    >>> jn.close(); os.remove(filename)
+    '''
+    def __init__(self, filename, header=None, resume=False):
+        self.filename = filename
+        self.done = {}
+        header = json.loads(json.dumps(header, default=str))   # normalise for comparison
+
+        resume = resume and os.path.exists(filename)
+        if resume:
+            with open(filename) as f:
+                lines = f.read().split('\n')
+            recs = []
+            for line in lines:
+                try:
+                    recs.append(json.loads(line))
+                except ValueError:
+                    # empty or truncated line
+                    recs.append(None)
+            if recs and recs[0] == {'header': header}:
+                for rec in recs[1:]:
+                    if rec and (rec['result'] or not rec['err']):
+                        self.done[tuple(rec['task'])] = rec
+                print(f'resuming from {filename} with {len(self.done)} finished tasks')
+            else:
+                print(f'WARNING: options differ from {filename}. Starting a new journal.')
+                resume = False
+
+        self.fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_APPEND | (0 if resume else os.O_TRUNC), 0o644)
+        if not resume:
+            self._write({'header': header})
+        elif lines[-1]:
+            # terminate a truncated last line
+            os.write(self.fd, b'\n')
+
+    def _write(self, rec):
+        os.write(self.fd, (json.dumps(rec, default=float) + '\n').encode())
+        os.fsync(self.fd)
+
+    def __contains__(self, task):
+        return tuple(task) in self.done
+
+    def __getitem__(self, task):
+        '''Restore the result, products, and error of a finished task.'''
+        rec = self.done[tuple(task)]
+        result = rec['result']
+        if result:
+            rvo, e_rvo, bjd, berv, par, e_params, prms = result
+            if par is not None:
+                par, e_params = list2params(par), np.array(e_params, dtype=float)
+            result = rvo, e_rvo, bjd, berv, par, e_params, prms
+        products = {(o, k): np.array(v, dtype=float) for o, k, v in rec['products']}
+        return result, products, rec['err']
+
+    def add(self, task, result, products, err):
+        '''Record a finished task. Failures without a result are left for a resumed run.'''
+        if err and not result:
+            return
+        if result:
+            rvo, e_rvo, bjd, berv, par, e_params, prms = result
+            if par is not None:
+                par, e_params = params2list(par), np.asarray(e_params).tolist()
+            result = rvo, e_rvo, bjd, berv, par, e_params, prms
+        products = [[int(o), k, np.asarray(v).tolist()] for (o, k), v in products.items()]
+        rec = {'task': list(task), 'result': result, 'products': products, 'err': err}
+        self._write(rec)
+        self.done[tuple(task)] = json.loads(json.dumps(rec, default=float))
+
+    def close(self):
+        os.close(self.fd)
@@ -1,7 +1,11 @@
 #! /usr/bin/env python3
 # Licensed under a GPLv3 style license - see LICENSE
 
+import time
+
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import fft
 from scipy.optimize import curve_fit
 from scipy.special import erf
 from astropy.modeling.models import Voigt1D
@@ -10,6 +14,10 @@ from utils.gplot import *
 
 c = 299792.458   # [km/s] speed of light
 
+memo_stats = {'hits': 0, 'calls': 0}   # reuse of Sj_eff by all models of the process
+
+FFT_TAPS = 128   # IPs with more taps are convolved by FFT (the default iphs=50 has 101)
+
 # IP sampling in velocity space
 # index k for IP space
 def IP(vk, s=2.2):
@@ -119,6 +127,31 @@ def IP_lor(vk, s=2.2):
 IPs = {'g': IP, 'sg': IP_sg, 'sbg': IP_sbg, 'ag': IP_ag, 'agr': IP_agr, 'asg': IP_asg, 'bg': IP_bg, 'mg': IP_mg, 'mcg': IP_mcg, 'lor': IP_lor, 'bnd': 'bnd'}
 
 
+def convolve_valid(kernels, x, nblock=8):
+    '''
+    The 'valid' convolutions of x with kernels of equal length by overlap-save FFTs.
+
+    x is cut into overlapping blocks of about nblock kernel lengths, which are
+    transformed once for all kernels.
+
+    Example
+    -------
+    >>> x = np.random.default_rng(1).random(5000)
+    >>> k1, k2 = np.hanning(301), np.bartlett(301)
+    >>> y1, y2 = convolve_valid([k1, k2], x)
+    >>> np.allclose(y1, np.convolve(k1, x, mode='valid')), np.allclose(y2, np.convolve(k2, x, mode='valid'))
+    (True, True)
+    '''
+    K, N = len(kernels[0]), len(x)
+    L = fft.next_fast_len(nblock*K, real=True)
+    step = L - K + 1   # valid outputs per block
+    nb = -(-(N-K+1) // step)
+    xp = np.zeros((nb-1)*step + L)
+    xp[:N] = x
+    X = fft.rfft(sliding_window_view(xp, L)[::step], axis=1)
+    return [fft.irfft(X*fft.rfft(k, L), L, axis=1)[:, K-1:].ravel()[:N-K+1] for k in kernels]
+
+
 def poly(x, a):
     # redefine polynomial for argument order and adjacent coefficients
     return np.polyval(a[::-1], x)
@@ -132,16 +165,54 @@ def pade(x, a, b):
     return y
 
 
+class BudgetExceeded(RuntimeError):
+    '''A fit exceeded its number of model evaluations or its time.'''
+
+
+class Budget:
+    '''
+    Limits for the fits of a chunk.
+
+    maxfev: Maximum number of model evaluations per fit (None: default of curve_fit).
+    timeout: Wall-clock time for all fits of the chunk [s] (None: unlimited).
+
+    Example
+    -------
+    >>> Budget(timeout=1e-9).check()
+    Traceback (most recent call last):
+    ...
+    utils.model.BudgetExceeded: timeout of 1e-09 s
+    '''
+    def __init__(self, maxfev=None, timeout=None):
+        self.maxfev = maxfev or None
+        self.timeout = timeout or None
+        self.deadline = time.time() + timeout if timeout else None
+
+    def check(self):
+        if self.deadline and time.time() > self.deadline:
+            raise BudgetExceeded(f'timeout of {self.timeout} s')
+
+
 class model:
     '''
     The forward model.
 
     '''
-    def __init__(self, *args, func_norm=poly, IP_hs=50, xcen=0):
+    def __init__(self, *args, func_norm=poly, IP_hs=50, xcen=0, budget=None, jac=False, varpro=False, sparse=False):
         # IP_hs: Half size of the IP (number of sampling knots).
         # xcen: Central pixel (to center polynomial for numeric reason).
+        # budget: Budget for the fits.
+        # jac: Pass the Jacobian to the solver (instead of finite differences of the model).
+        # varpro: Solve the polynomial norm coefficients linearly (variable projection).
+        # sparse: Convolve only at the grid points next to the pixels.
 
         self.xcen = xcen
+        self.budget = budget
+        self.jac = jac
+        self.varpro = varpro
+        self.sparse = sparse
+        self.memo = {}   # (rv, ip, atm, bkg, ipB): Sj_eff
+        self.memo_size = 8
         self.S_star, self.lnwave_j, self.spec_cell_j, self.fluxes_molec, self.IP = args
         # convolving with IP will reduce the valid wavelength range
         self.dx = self.lnwave_j[1] - self.lnwave_j[0]   # step size of the uniform sampled grid
@@ -151,55 +222,209 @@ class model:
         self.func_norm = func_norm
         #print("sampling [km/s]:", self.dx*c)
 
-    def __call__(self, pixel, rv=0, norm=[1], wave=[], ip=[], atm=[], bkg=[0], ipB=[]):
-        # renaming (coeff is ok prefix below, but too verbose for par)
-        coeff_norm, coeff_wave, coeff_ip, coeff_atm, coeff_bkg, coeff_ipB = norm, wave, ip, atm, bkg, ipB
+    def _shift_atm(self, flux_atm, coeff_atm):
+        # variable telluric wavelength shift; one shift for all molecules
+        if len(coeff_atm) == len(self.fluxes_molec)+1:
+            flux_atm = np.interp(self.lnwave_j, self.lnwave_j-np.log(1+coeff_atm[-1]/c), flux_atm)
+        return flux_atm
 
+    def _gas(self, coeff_atm):
+        # cell and telluric absorption
         spec_gas = 1 * self.spec_cell_j
 
         if len(self.fluxes_molec):
             # telluric forward modelling
             flux_atm = np.nanprod(np.power(self.fluxes_molec, np.abs(coeff_atm[:len(self.fluxes_molec)])[:, np.newaxis]), axis=0)
+            spec_gas *= self._shift_atm(flux_atm, coeff_atm)
 
-            # variable telluric wavelength shift; one shift for all molecules
-            if len(coeff_atm) == len(self.fluxes_molec)+1:
-                flux_atm = np.interp(self.lnwave_j, self.lnwave_j-np.log(1+coeff_atm[-1]/c), flux_atm)
-
-            spec_gas *= flux_atm
-
-        # IP convolution
-        Sj_eff = np.convolve(self.IP(self.vk, *coeff_ip), self.S_star(self.lnwave_j-rv/c) * (spec_gas + coeff_bkg[0]), mode='valid')
+        return spec_gas
 
+    def _kernels(self, coeff_ip, coeff_ipB):
+        # the IP, and the IP at the end of the chunk for the dual IP
+        kernels = [self.IP(self.vk, *coeff_ip)]
         if len(coeff_ipB):
             coeff_ipB = [coeff_ipB[0]*coeff_ip[0], *coeff_ip[1:]]
-            Sj_B = np.convolve(self.IP(self.vk, *coeff_ipB), self.S_star(self.lnwave_j-rv/c) * (spec_gas + coeff_bkg[0]), mode='valid')
-            Sj_A = Sj_eff
+            kernels.append(self.IP(self.vk, *coeff_ipB))
+        return kernels
+
+    def _conv(self, kernels, Sj):
+        # IP convolution; with two IPs, linear transition from the first to the second
+        if len(kernels[0]) > FFT_TAPS:
+            # wide IP: overlap-save FFT, the transform of Sj is shared by both IPs
+            Sjs = convolve_valid(kernels, Sj)
+        else:
+            Sjs = [np.convolve(kernel, Sj, mode='valid') for kernel in kernels]
+        Sj_eff = Sjs[0]
+
+        if len(kernels) > 1:
+            Sj_A, Sj_B = Sjs
             g = self.lnwave_j_eff - self.lnwave_j_eff[0]
             g /= g[-1]
             Sj_eff = (1-g)*Sj_A + g*Sj_B
 
+        return Sj_eff
+
+    def _sample(self, kernels, Sj, lnwave_obs):
+        # The convolved spectrum linearly interpolated at lnwave_obs and its slope.
+        # sparse: the convolution is computed only at the bracketing nodes of the valid grid.
+        lnwave_j_eff = self.lnwave_j_eff
+        j = np.clip(np.searchsorted(lnwave_j_eff, lnwave_obs, side='right')-1, 0, len(lnwave_j_eff)-2)
+        if self.sparse:
+            used = np.zeros(len(lnwave_j_eff), dtype=bool)
+            used[j] = used[j+1] = True
+            nodes = np.flatnonzero(used)
+            pos = np.cumsum(used) - 1   # position of a grid point among the nodes
+            Sj_win = sliding_window_view(Sj, len(kernels[0]))[nodes]   # Sj[node:node+2*IP_hs+1]
+            Sj_eff = Sj_win @ kernels[0][::-1]
+            if len(kernels) > 1:
+                g = (lnwave_j_eff[nodes]-lnwave_j_eff[0]) / (lnwave_j_eff[-1]-lnwave_j_eff[0])
+                Sj_eff = (1-g)*Sj_eff + g*(Sj_win @ kernels[1][::-1])
+            S0, S1 = Sj_eff[pos[j]], Sj_eff[pos[j]+1]
+        else:
+            Sj_eff = self._conv(kernels, Sj)
+            S0, S1 = Sj_eff[j], Sj_eff[j+1]
+        du = lnwave_j_eff[j+1] - lnwave_j_eff[j]
+        dSi_eff = (S1-S0) / du
+        # constant outside the grid as np.interp
+        return S0 + dSi_eff*np.clip(lnwave_obs-lnwave_j_eff[j], 0, du), dSi_eff
+
+    def __call__(self, pixel, rv=0, norm=[1], wave=[], ip=[], atm=[], bkg=[0], ipB=[]):
+        # renaming (coeff is ok prefix below, but too verbose for par)
+        coeff_norm, coeff_wave, coeff_ip, coeff_atm, coeff_bkg, coeff_ipB = norm, wave, ip, atm, bkg, ipB
+
+        # The effective spectrum depends only on rv, ip, atm, bkg, and ipB. Finite differences
+        # for norm and wave (and the evaluations at the same point) reuse it.
+        # (sparse: the IPs and the spectrum before the convolution)
+        key = len(coeff_ip), len(coeff_atm), np.array([rv, *coeff_ip, *coeff_atm, coeff_bkg[0], *coeff_ipB], dtype=float).tobytes()
+        memo_stats['calls'] += 1
+        Sj_eff = self.memo.get(key)
+        if Sj_eff is None:
+            spec_gas = self._gas(coeff_atm)
+            kernels = self._kernels(coeff_ip, coeff_ipB)
+            Sj = self.S_star(self.lnwave_j-rv/c) * (spec_gas + coeff_bkg[0])
+
+            # IP convolution
+            Sj_eff = (kernels, Sj) if self.sparse else self._conv(kernels, Sj)
+
+            if len(self.memo) >= self.memo_size:
+                del self.memo[next(iter(self.memo))]   # the oldest
+            self.memo[key] = Sj_eff
+        else:
+            memo_stats['hits'] += 1
+
         # wavelength relation
         #    lam(x) = b0 + b1 * x + b2 * x^2
         lnwave_obs = np.log(poly(pixel-self.xcen, coeff_wave))
 
         # sampling to pixel
-        Si_eff = np.interp(lnwave_obs, self.lnwave_j_eff, Sj_eff)
+        if self.sparse:
+            Si_eff = self._sample(*Sj_eff, lnwave_obs)[0]
+        else:
+            Si_eff = np.interp(lnwave_obs, self.lnwave_j_eff, Sj_eff)
 
         # flux normalisation
         Si_mod = self.func_norm(pixel-self.xcen, coeff_norm) * Si_eff
         #Si_mod = self.func_norm((np.exp(lnwave_obs)-b[0]-coeff_norm[-1]), coeff_norm[:-1]) * Si_eff
         return Si_mod
 
+    def jacobian(self, pixel, keys, rv=0, norm=[1], wave=[], ip=[], atm=[], bkg=[0], ipB=[]):
+        '''
+        Partial derivatives of the model with respect to the parameters keys (as in Params.vary).
+
+        The derivatives for norm (polynomial), wave, bkg, and the telluric abundances
+        and shift are analytic. For rv, ip, and ipB, only the stellar template or the
+        IP are differenced, and the difference is propagated through the linear convolution.
+        Each column costs one convolution, instead of a full model evaluation.
+
+        Returns
+        -------
+        J : array (pixel, keys)
+        '''
+        coeff_norm, coeff_wave, coeff_ip, coeff_atm, coeff_bkg, coeff_ipB = norm, wave, ip, atm, bkg, ipB
+        step = lambda p: 1e-6 * (abs(p) or 1)   # as MINPACK for epsfcn=1e-12
+        x = pixel - self.xcen
+
+        spec_gas = self._gas(coeff_atm)
+        if len(self.fluxes_molec):
+            flux_atm = np.nanprod(np.power(self.fluxes_molec, np.abs(coeff_atm[:len(self.fluxes_molec)])[:, np.newaxis]), axis=0)
+        S_star = self.S_star(self.lnwave_j-rv/c)
+        Sj = S_star * (spec_gas + coeff_bkg[0])
+        kernels = self._kernels(coeff_ip, coeff_ipB)
+
+        wave_obs = poly(x, coeff_wave)
+        lnwave_obs = np.log(wave_obs)
+        Si_eff, dSi_eff = self._sample(kernels, Sj, lnwave_obs)
+        Si_norm = self.func_norm(x, coeff_norm)
+
+        def dSi(dSj, kernels=kernels):
+            # the derivative of the spectrum before the convolution, convolved, sampled, and normalised
+            return Si_norm * self._sample(kernels, dSj, lnwave_obs)[0]
+
+        J = np.empty((len(pixel), len(keys)))
+        for n, key in enumerate(keys):
+            name, i = key if isinstance(key, tuple) else (key, 0)
+            if name == 'norm':
+                if self.func_norm is poly:
+                    J[:, n] = x**i * Si_eff
+                else:
+                    h = step(coeff_norm[i])
+                    coeff_h = [*coeff_norm[:i], coeff_norm[i]+h, *coeff_norm[i+1:]]
+                    J[:, n] = (self.func_norm(x, coeff_h)-Si_norm) / h * Si_eff
+            elif name == 'wave':
+                J[:, n] = Si_norm * dSi_eff * x**i / wave_obs
+            elif name == 'bkg':
+                J[:, n] = dSi(S_star)
+            elif name == 'rv':
+                h = 0.01 * self.dx * c   # a fraction of the grid step, also for rv near zero
+                dS_star = (self.S_star(self.lnwave_j-(rv+h)/c) - S_star) / h
+                J[:, n] = dSi(dS_star * (spec_gas + coeff_bkg[0]))
+            elif name == 'atm' and i < len(self.fluxes_molec):
+                # d/da f^|a| = f^|a| ln(f) sign(a); the product skips NaN as nanprod
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    dflux_atm = flux_atm * np.log(self.fluxes_molec[i]) * (1 if coeff_atm[i] >= 0 else -1)
+                dflux_atm[~np.isfinite(dflux_atm)] = 0
+                J[:, n] = dSi(S_star * self.spec_cell_j * self._shift_atm(dflux_atm, coeff_atm))
+            elif name == 'atm':
+                # telluric shift: slope of the shifted linear interpolation
+                lnwave_atm = self.lnwave_j - np.log(1+coeff_atm[-1]/c)
+                j = np.clip(np.searchsorted(lnwave_atm, self.lnwave_j, side='right')-1, 0, len(lnwave_atm)-2)
+                dflux_atm = (flux_atm[j+1]-flux_atm[j]) / (lnwave_atm[j+1]-lnwave_atm[j]) / (c+coeff_atm[-1])
+                dflux_atm[(self.lnwave_j < lnwave_atm[0]) | (self.lnwave_j > lnwave_atm[-1])] = 0   # np.interp is constant outside
+                J[:, n] = dSi(S_star * self.spec_cell_j * dflux_atm)
+            elif name in ('ip', 'ipB'):
+                coeff = coeff_ip if name == 'ip' else coeff_ipB
+                h = step(coeff[i])
+                coeff_h = [*coeff[:i], coeff[i]+h, *coeff[i+1:]]
+                kernels_h = self._kernels(coeff_h, coeff_ipB) if name == 'ip' else self._kernels(coeff_ip, coeff_h)
+                J[:, n] = dSi(Sj, [(k_h-k)/h for k_h, k in zip(kernels_h, kernels)])
+            else:
+                raise ValueError(f'no derivative for parameter {key}')
+        return J
+
     def fit(self, pixel, spec_obs, par, sig=[], **kwargs):
         '''
         Generic fit wrapper.
         '''
         varykeys, varyvals = zip(*par.vary().items())
 
-        S_model = lambda x, *params: self(x, **(par + dict(zip(varykeys, params))))
-        #S_model(pixel, *varyvals)
+        budget = self.budget or Budget()
 
-        params, e_params = curve_fit(S_model, pixel, spec_obs, p0=varyvals, sigma=sig, absolute_sigma=False, epsfcn=1e-12)
+        # linear parameters for the variable projection
+        linkeys = [k for k in varykeys if isinstance(k, tuple) and k[0] == 'norm'] if self.varpro and self.func_norm is poly else []
+
+        if linkeys and len(linkeys) < len(varykeys):
+            params, e_params = self._fit_varpro(pixel, spec_obs, par, sig, varykeys, linkeys, budget)
+        else:
+            def S_model(x, *params):
+                budget.check()
+                return self(x, **(par + dict(zip(varykeys, params))))
+            #S_model(pixel, *varyvals)
+
+            def S_jac(x, *params):
+                budget.check()
+                return self.jacobian(x, varykeys, **(par + dict(zip(varykeys, params))))
+
+            params, e_params = self._curve_fit(S_model, pixel, spec_obs, varyvals, sig, budget, jac=self.jac and S_jac)
 
         pnew = par + dict(zip(varykeys, params))
         # attach uncertainties
@@ -211,6 +436,73 @@ class model:
 
         return pnew, e_params
 
+    def _curve_fit(self, S_model, pixel, spec_obs, p0, sig, budget, jac=None):
+        opt = {'maxfev': budget.maxfev} if budget.maxfev else {}
+        if jac:
+            opt['jac'] = jac
+        try:
+            return curve_fit(S_model, pixel, spec_obs, p0=p0, sigma=sig, absolute_sigma=False, epsfcn=1e-12, **opt)
+        except RuntimeError as e:
+            if budget.maxfev and 'maxfev' in str(e):
+                raise BudgetExceeded(f'maxfev of {budget.maxfev}') from None
+            raise
+
+    def _fit_varpro(self, pixel, spec_obs, par, sig, varykeys, linkeys, budget):
+        '''
+        Fit with variable projection.
+
+        The linear parameters (linkeys, the norm coefficients) are solved by weighted
+        linear least squares for each set of the nonlinear parameters, which curve_fit
+        iterates. bkg stays nonlinear, since it is multiplied with the normalisation.
+        With jac, the Jacobian of the projected problem is approximated as in
+        Kaufman (1975). The covariance of all parameters is computed at the solution
+        with the analytic Jacobian.
+
+        Returns
+        -------
+        params : Values of varykeys.
+        e_params : Covariance matrix of varykeys.
+        '''
+        nlkeys = [k for k in varykeys if k not in linkeys]
+        lin = [k[1] for k in linkeys]
+        w = 1 / np.asarray(sig, dtype=float) if len(sig) else np.ones(len(pixel))
+        x = pixel - self.xcen
+
+        def solve(params):
+            # the model with the best linear parameters
+            p = par + dict(zip(nlkeys, params))
+            Si_eff = self(pixel, **(p + {'norm': [1]}))
+            Si_fixed = poly(x, [0 if i in lin else a for i, a in enumerate(p.norm)]) * Si_eff
+            A = x[:, np.newaxis]**lin * Si_eff[:, np.newaxis]
+            a = np.linalg.lstsq(A*w[:, np.newaxis], (spec_obs-Si_fixed)*w, rcond=None)[0]
+            return p + dict(zip(linkeys, a)), Si_fixed + A@a, A
+
+        def S_model(_, *params):
+            budget.check()
+            return solve(params)[1]
+
+        def S_jac(_, *params):
+            budget.check()
+            p, _, A = solve(params)
+            Jw = self.jacobian(pixel, nlkeys, **p) * w[:, np.newaxis]
+            Q = np.linalg.qr(A*w[:, np.newaxis])[0]
+            return (Jw - Q @ (Q.T @ Jw)) / w[:, np.newaxis]
+
+        p0 = [par[k] for k in nlkeys]
+        params, _ = self._curve_fit(S_model, pixel, spec_obs, p0, sig, budget, jac=self.jac and S_jac)
+
+        p, Si_mod, _ = solve(params)
+        # covariance from the Jacobian of the full problem (as curve_fit)
+        Jw = self.jacobian(pixel, varykeys, **p) * w[:, np.newaxis]
+        res = (spec_obs-Si_mod) * w
+        dof = len(pixel) - len(varykeys)
+        try:
+            e_params = np.linalg.inv(Jw.T @ Jw) * (res @ res / dof if dof > 0 else np.inf)
+        except np.linalg.LinAlgError:
+            e_params = np.full((len(varykeys),)*2, np.inf)
+
+        return [p[k] for k in varykeys], e_params
+
     def show(self, params, x, y, par_rv=None, res=True, x2=None, dx=None, rel_fac=None):
         '''
         res: Show residuals.
@@ -261,11 +553,15 @@ class model_bnd(model):
     The forward model with band matrix.
 
     '''
-    def __init__(self, *args, func_norm=poly, IP_hs=50, xcen=0):
+    def __init__(self, *args, func_norm=poly, IP_hs=50, xcen=0, budget=None, jac=False, varpro=False, sparse=False):
         # IP_hs: Half size of the IP (number of sampling knots).
         # xcen: Central pixel (to center polynomial for numeric reason).
 
         self.xcen = xcen
+        self.budget = budget
+        self.jac = jac
+        self.varpro = varpro
+        self.sparse = sparse
         self.S_star, self.lnwave_j, self.spec_cell_j, self.IP = args
         # convolving with IP will reduce the valid wavelength range
         self.dx = self.lnwave_j[1] - self.lnwave_j[0]   # step size of the uniform sampled grid
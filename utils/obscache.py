@@ -0,0 +1,183 @@
+#! /usr/bin/env python3
+# Licensed under a GPLv3 style license - see LICENSE
+
+# Persistent cache of the preprocessed observations (the Spectrum outputs).
+#
+# Build the cache once with the usual viper arguments:
+#    python -m utils.obscache build -obscache cache/obs '/data/CRIRES/*.fits' -inst CRIRES -oset 7,12
+# Later viper runs with -obscache cache/obs read the cached orders instead of decoding the FITS files.
+#
+# Each observation is one .npy file (memory-mappable) with the stacked arrays
+# pixel, wave, spec, err, flag of shape (5, orders, pixels) and a JSON sidecar
+# with the orders, their sizes (shorter orders are padded), dtypes, bjd and berv.
+# An entry is used only when it is newer than the observation and was written by
+# the same version of the instrument module.
+
+import argparse
+import importlib
+import json
+import os
+
+import numpy as np
+from astropy.time import Time
+
+from utils.cache import filehash, hashkey
+
+
+def _time(t):
+    # bjd to JSON
+    if isinstance(t, Time):
+        return {'jd1': float(t.jd1), 'jd2': float(t.jd2), 'scale': t.scale}
+    return float(t)
+
+
+def _untime(t):
+    if isinstance(t, dict):
+        return Time(t['jd1'], t['jd2'], format='jd', scale=t['scale'])
+    return t
+
+
+class ObsCache:
+    '''
+    Directory with the preprocessed observations of the instruments.
+
+    Parameters
+    ----------
+    directory : str
+        Cache directory. It is created when writing.
+
+    Example
+    -------
+    >>> import contextlib, io, tempfile
+    >>> with contextlib.redirect_stdout(io.StringIO()): import inst.inst_CRIRES as Inst
+    >>> obs = 'tests/test_data/SGC_220325_1.fits'
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> cache = ObsCache(tmpdir)
+    >>> cache.build(Inst, obs, [7, 12])
+    >>> spec = cache.load(Inst, obs, [12])
+    >>> np.array_equal(spec[2][0], Inst.Spectrum(obs, order=12)[2], equal_nan=True)
+    True
+    >>> cache.load(Inst, obs, [13]) is None
+    True
+    >>> cache.clear(); os.rmdir(tmpdir)
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, Inst, filename):
+        '''Filename of the entry without extension.'''
+        inst = Inst.__name__.split('inst_')[-1]
+        name = os.path.basename(filename) + '.' + hashkey(os.path.realpath(filename))[:12]
+        return os.path.join(self.directory, inst, name)
+
+    def build(self, Inst, filename, orders, targ=None):
+        '''Read the orders of an observation with the instrument module and store them.'''
+        if hasattr(Inst, 'Spectra'):
+            *arrays, bjd, berv = Inst.Spectra(filename, list(orders), targ=targ)
+        else:
+            spectra = [Inst.Spectrum(filename, order=order, targ=targ) for order in orders]
+            arrays = [[s[i] for s in spectra] for i in range(5)]
+            bjd, berv = spectra[0][5:]
+        sizes = [len(x) for x in arrays[0]]
+        cube = np.full((5, len(sizes), max(sizes)), np.nan)
+        for i, x in enumerate(arrays):
+            for k, x_k in enumerate(x):
+                cube[i, k, :sizes[k]] = x_k
+
+        base = self.path(Inst, filename)
+        os.makedirs(os.path.dirname(base), exist_ok=True)
+        st = os.stat(filename)
+        info = {'source': os.path.realpath(filename), 'mtime': st.st_mtime_ns, 'reader': filehash(Inst.__file__),
+                'targ': targ and repr(targ), 'orders': [int(o) for o in orders], 'sizes': sizes,
+                'dtypes': [np.asarray(x[0]).dtype.str for x in arrays], 'bjd': _time(bjd), 'berv': float(berv)}
+
+        # the data first, the sidecar completes the entry
+        tmpname = f'{base}.{os.getpid()}.tmp.npy'
+        np.save(tmpname, cube)
+        os.replace(tmpname, base+'.npy')
+        tmpname = f'{base}.{os.getpid()}.tmp'
+        with open(tmpname, 'w') as f:
+            json.dump(info, f)
+        os.replace(tmpname, base+'.json')
+
+    def load(self, Inst, filename, orders, targ=None):
+        '''
+        The lists (with the array of each order) pixel, wave, spec, err, flag, and bjd, berv as Spectra returns them.
+
+        None, when the entry is missing, outdated, or does not have all orders.
+        '''
+        base = self.path(Inst, filename)
+        try:
+            with open(base+'.json') as f:
+                info = json.load(f)
+            mtime = os.stat(filename).st_mtime_ns
+            if info['mtime'] != mtime or os.stat(base+'.npy').st_mtime_ns < mtime:
+                return None
+            if info['targ'] != (targ and repr(targ)) or info['reader'] != filehash(Inst.__file__):
+                return None
+            idx = [info['orders'].index(o) for o in orders]
+            sizes = [info['sizes'][k] for k in idx]
+            cube = np.load(base+'.npy', mmap_mode='r')
+        except (OSError, ValueError, KeyError):
+            # missing, incomplete, or orders not cached
+            return None
+        arrays = [[cube[i, k, :n].astype(dtype) for k, n in zip(idx, sizes)] for i, dtype in enumerate(info['dtypes'])]
+        return (*arrays, _untime(info['bjd']), info['berv'])
+
+    def wrap(self, Inst):
+        '''The Spectrum function of an instrument reading from the cache.'''
+        def Spectrum(filename='', order=None, targ=None):
+            res = None if order is None else self.load(Inst, filename, [order], targ=targ)
+            if res is None:
+                return Inst.Spectrum(filename, order=order, targ=targ)
+            return (*[x[0] for x in res[:5]], *res[5:])
+        return Spectrum
+
+    def entries(self):
+        '''List of the data and sidecar files.'''
+        if not os.path.isdir(self.directory):
+            return []
+        return [entry.path for inst in os.scandir(self.directory) if inst.is_dir()
+                for entry in os.scandir(inst.path) if entry.name.endswith(('.npy', '.json'))]
+
+    def clear(self):
+        for filename in self.entries():
+            os.remove(filename)
+        if os.path.isdir(self.directory):
+            for inst in os.listdir(self.directory):
+                os.rmdir(os.path.join(self.directory, inst))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='viper observation cache', usage='%(prog)s {build,clear} -obscache DIR [viper arguments]')
+    parser.add_argument('command', choices=['build', 'clear'], help='build: store the selected observations and orders (obspath, -inst, -oset, -nset, -nexcl, -targ); clear: remove all entries.')
+    parser.add_argument('-obscache', help='Cache directory (the -obscache of the viper runs).', required=True)
+    args, rest = parser.parse_known_args(argv)
+    cache = ObsCache(args.obscache)
+
+    if args.command == 'clear':
+        cache.clear()
+        return
+
+    # imported here, so that clear does not need the pipeline and its dependencies
+    try:
+        import viper.viper as viper
+    except ImportError:
+        import viper
+
+    opts = viper.parse_args(rest)
+    Inst = importlib.import_module('inst.inst_'+opts.inst)
+    targ = None
+    if opts.targname:
+        from utils.targ import Targ
+        targ = Targ(opts.targname, csv=opts.tag+'.targ.csv').sc
+    orders = np.r_[opts.oset]
+    obsnames = viper.select_obs(opts.obspath, opts.nset, opts.nexcl, opts.where, opts.inst, opts.catalog)
+    for i, obsname in enumerate(obsnames):
+        print(f"{i+1:3d}/{len(obsnames)}", os.path.basename(obsname))
+        cache.build(Inst, obsname, orders, targ=targ)
+    print('cache:', cache.directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+#! /usr/bin/env python3
+# Licensed under a GPLv3 style license - see LICENSE
+
+# Reader stage that loads the next observations in background threads.
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Prefetch:
+    '''
+    Load items in background threads ahead of their use.
+
+    Requesting a key returns its loaded item and starts loading the next keys of
+    the sequence. At most the current and the ahead following items are held, so
+    the memory stays bounded. Each process (e.g. a forked worker) starts its own
+    threads on first use.
+
+    Parameters
+    ----------
+    load : callable
+        Function loading the item for a key.
+    keys : list
+        The keys in the expected order of use.
+    ahead : int
+        Number of items loaded in advance.
+
+    Example
+    -------
+    >>> pre = Prefetch(lambda x: 2*x, ['a', 'b', 'c'], ahead=1)
+    >>> pre['a']
+    'aa'
+    >>> list(pre.futures)
+    ['a', 'b']
+    >>> pre['c']
+    'cc'
+    >>> pre.close()
+    '''
+    def __init__(self, load, keys, ahead=2):
+        self.load = load
+        self.keys = list(keys)
+        self.pos = {key: i for i, key in enumerate(self.keys)}
+        self.ahead = ahead
+        self.pid = None
+        self.pool = None
+        self.futures = {}
+
+    def __getitem__(self, key):
+        if self.pid != os.getpid():
+            # threads are not inherited by forked processes
+            self.pid = os.getpid()
+            self.pool = ThreadPoolExecutor(max(self.ahead, 1), thread_name_prefix='prefetch')
+            self.futures = {}
+
+        i = self.pos.get(key, -1)
+        wanted = [key] + self.keys[i+1: i+1+self.ahead] if i >= 0 else [key]
+        for k in list(self.futures):
+            if k not in wanted:
+                self.futures.pop(k).cancel()
+        for k in wanted:
+            if k not in self.futures:
+                self.futures[k] = self.pool.submit(self.load, k)
+
+        return self.futures[key].result()
+
+    def close(self):
+        if self.pool and self.pid == os.getpid():
+            for future in self.futures.values():
+                future.cancel()
+            self.pool.shutdown(wait=True)
+        self.pool = None
+        self.pid = None
+        self.futures = {}
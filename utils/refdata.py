@@ -0,0 +1,86 @@
+#! /usr/bin/env python3
+# Licensed under a GPLv3 style license - see LICENSE
+
+# Read-only reference data (FTS, tellurics, templates) in shared memory.
+
+from multiprocessing import shared_memory
+
+import numpy as np
+
+attached = []   # blocks in use by the views of this process
+
+
+class RefData:
+    '''
+    A collection of read-only arrays placed in shared memory.
+
+    The parent process copies each array once into a shared memory block. Forked
+    workers use the returned views directly; other processes attach by the block
+    names in spec() without copying or unpickling the data.
+
+    Example
+    -------
+    >>> refdata = RefData()
+    >>> x = refdata.share('x', np.arange(5.))
+    >>> y = RefData.attach(refdata.spec())['x']
+    >>> y
+    array([0., 1., 2., 3., 4.])
+    >>> x.flags.writeable, y.flags.writeable
+    (False, False)
+
+    The attached array is a view of the shared block (a second mapping of it, not a copy),
+    so it sees a change of the block:
+
+    >>> shm = refdata.blocks['x'][0]
+    >>> np.ndarray(5, buffer=shm.buf)[0] = 9.
+    >>> y
+    array([9., 1., 2., 3., 4.])
+    >>> refdata.unlink()
+    '''
+    def __init__(self):
+        self.blocks = {}   # name: (SharedMemory, shape, dtype)
+
+    def share(self, name, arr):
+        '''Copy arr to shared memory and return a read-only view.'''
+        arr = np.ascontiguousarray(arr)
+        shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        view = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+        view[...] = arr
+        view.flags.writeable = False
+        self.blocks[name] = shm, arr.shape, arr.dtype.str
+        return view
+
+    def share_dict(self, name, d):
+        '''Share all arrays of a dictionary.'''
+        return {k: self.share(f'{name}[{k}]', v) for k, v in d.items()}
+
+    @property
+    def nbytes(self):
+        return sum(shm.size for shm, _, _ in self.blocks.values())
+
+    def spec(self):
+        '''Picklable description of the blocks for RefData.attach.'''
+        return {name: (shm.name, shape, dtype) for name, (shm, shape, dtype) in self.blocks.items()}
+
+    @staticmethod
+    def attach(spec):
+        '''Attach to the blocks of a spec and return the arrays by name.'''
+        arrays = {}
+        for name, (shmname, shape, dtype) in spec.items():
+            try:
+                shm = shared_memory.SharedMemory(name=shmname, track=False)
+            except TypeError:
+                # python < 3.13
+                shm = shared_memory.SharedMemory(name=shmname)
+            attached.append(shm)   # the block must live as long as the view
+            arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+            arr.flags.writeable = False
+            arrays[name] = arr
+        return arrays
+
+    def unlink(self):
+        '''Release the names of the blocks. Existing views stay valid until the processes exit.'''
+        for shm, _, _ in self.blocks.values():
+            shm.unlink()
+            attached.append(shm)
+        self.blocks = {}
@@ -0,0 +1,193 @@
+#! /usr/bin/env python3
+# Licensed under a GPLv3 style license - see LICENSE
+
+# viper as a long-lived service on a loopback HTTP endpoint.
+#
+# Start the service:
+#    python -m utils.service -port 8778
+# and send fit jobs with the usual viper arguments:
+#    >>> from utils.service import fit
+#    >>> res = fit(['/data/CRIRES/*.fits', '/data/tpl.fits', '-inst', 'CRIRES', '-oset', '7,12'])
+#    >>> res['RV']
+#
+# The pipelines (FTS, tellurics and templates) stay loaded for each set of fit options.
+# Paths are resolved by the service, so absolute paths are safest. The requests of
+# several clients are accepted at once, but the jobs are queued and run one after the
+# other in the working directory of the service (residuals in res/).
+# The option -where is not accepted (it is pasted into an SQL query).
+
+import argparse
+import json
+import queue
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from utils.cache import hashkey
+from utils.journal import params2list
+
+URL = 'http://127.0.0.1:8778'
+
+
+class Rejected(Exception):
+    '''A job with options the service does not accept.'''
+
+
+class Service:
+    '''
+    Warm pipelines for fit jobs.
+
+    One pipeline is loaded per set of options that affect the fits (instrument,
+    template, FTS, orders, ...) or the loading of the reference data (-ftscache,
+    -tplstore). The other options (caches, -jobs, ...) are taken from each job.
+
+    The jobs are queued and processed one at a time by serve: all pipelines write
+    their residuals and the runtime history in the same working directory, and the
+    worker pool of a job (-jobs) is forked from the thread running serve, while the
+    request threads only wait for their results.
+    '''
+    def __init__(self):
+        # imported here, so that clients do not need the pipeline and its dependencies
+        try:
+            import viper.viper as viper
+        except ImportError:
+            import viper
+        self.viper = viper
+        self.pipes = {}   # key: Pipeline
+        self.queue = queue.Queue()   # (argv, Future), None stops serve
+
+    def pipeline(self, args):
+        key = hashkey(self.viper.fit_options(args), args.ftscache, args.tplstore)
+        if key not in self.pipes:
+            self.pipes[key] = self.viper.Pipeline(args)
+        pipe = self.pipes[key]
+        pipe.configure(args)
+        return pipe
+
+    def submit(self, argv):
+        '''Queue a fit job and wait for its result (called from the request threads).'''
+        future = Future()
+        self.queue.put((argv, future))
+        return future.result()
+
+    def serve(self):
+        '''Run the queued jobs one after the other until stop.'''
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            argv, future = job
+            try:
+                future.set_result(self.fit(argv))
+            except (Exception, SystemExit) as e:
+                # SystemExit from argparse
+                future.set_exception(e)
+
+    def stop(self):
+        self.queue.put(None)
+
+    def fit(self, argv):
+        '''
+        Fit the observations selected by viper arguments.
+
+        Returns
+        -------
+        dict with the lists obsnames, bjd, RV, e_RV, BERV, rv, e_rv (as Pipeline.run), and
+        params (for each chunk a list of [name, index, value, unc] or None for failed chunks).
+        '''
+        args = self.viper.parse_args(argv)
+        if args.where:
+            raise Rejected('-where is not accepted by the service')
+        obsnames = self.viper.select_obs(args.obspath, args.nset, args.nexcl, inst=args.inst)
+        if not obsnames:
+            raise FileNotFoundError('no files: ' + args.obspath)
+
+        pipe = self.pipeline(args)
+        pipe.spec_all.clear()
+        out = pipe.run(obsnames=obsnames)
+
+        res = {'obsnames': obsnames}
+        res.update({k: np.asarray(out[k]).tolist() for k in ['bjd', 'RV', 'e_RV', 'BERV', 'rv', 'e_rv']})
+        res['params'] = [par and params2list(par) for par in out['params']]
+        return res
+
+    def close(self):
+        for pipe in self.pipes.values():
+            pipe.close()
+        self.pipes = {}
+
+
+class Handler(BaseHTTPRequestHandler):
+    '''
+    POST /fit with {"args": [...]} runs a fit job; GET / reports the loaded pipelines and the queued jobs.
+
+    Each request has its own thread. A fit job waits in the queue of the service until the
+    jobs before it are done. Replies are JSON. Missing values are encoded as NaN.
+    '''
+    def reply(self, code, obj):
+        body = json.dumps(obj, default=float).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        service = self.server.service
+        self.reply(200, {'pipelines': len(service.pipes), 'queued': service.queue.qsize()})
+
+    def do_POST(self):
+        if self.path != '/fit':
+            return self.reply(404, {'error': 'unknown path ' + self.path})
+        try:
+            req = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            res = self.server.service.submit(req['args'])
+        except SystemExit:
+            # from argparse
+            return self.reply(400, {'error': 'invalid arguments: %s' % req['args']})
+        except Rejected as e:
+            return self.reply(400, {'error': str(e)})
+        except Exception as e:
+            return self.reply(500, {'error': repr(e)})
+        self.reply(200, res)
+
+
+def fit(argv, url=URL):
+    '''Send a fit job with viper arguments to the service and return the result.'''
+    req = urllib.request.Request(url+'/fit', data=json.dumps({'args': list(argv)}).encode(),
+                                 headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(req) as f:
+            return json.load(f)
+    except urllib.error.HTTPError as e:
+        raise RuntimeError(json.load(e)['error']) from None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='viper service - fit jobs on warm pipelines')
+    parser.add_argument('-host', help='Address to listen. Keep the loopback address unless the network is trusted.', default='127.0.0.1')
+    parser.add_argument('-port', help='Port.', default=8778, type=int)
+    args = parser.parse_args(argv)
+
+    # the requests in threads, the jobs in the main thread (see Service)
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    server.service = service = Service()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f'viper service on http://{args.host}:{args.port}')
+    try:
+        service.serve()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+#! /usr/bin/env python3
+# Licensed under a GPLv3 style license - see LICENSE
+
+# Store of the preprocessed stellar template.
+#
+# The template orders are read, optionally oversampled on a log-wavelength grid,
+# and stored together with their log-wavelengths in one .npz file in the store
+# directory (e.g. tpl_tpl.fits -> <directory>/tpl_tpl.fits.3f2a9c0d1e4b.npz). The
+# name contains the key (template content, oversampling, window, instrument module,
+# target), so a modified template or other settings simply get another file.
+
+import inspect
+import os
+import sys
+
+import numpy as np
+from scipy.interpolate import CubicSpline
+
+from utils.cache import filehash, hashkey
+
+
+def cut(wave_tplo, spec_tplo, window):
+    '''The template order in the window (wmin, wmax), with one more sample at each end.'''
+    if wave_tplo[0] > wave_tplo[-1]:
+        return wave_tplo, spec_tplo
+    i0, i1 = np.searchsorted(wave_tplo, window)
+    s = slice(max(i0-1, 0), i1+1)
+    return wave_tplo[s], spec_tplo[s]
+
+
+def preprocess(wave_tplo, spec_tplo, oversampling=None):
+    '''The template order (wave, spec, lnwave), oversampled by a cubic spline in log-wavelength.'''
+    if oversampling:
+        us = np.linspace(np.log(wave_tplo[0]), np.log(wave_tplo[-1]), oversampling*wave_tplo.size)
+        spec_tplo = np.nan_to_num(spec_tplo)
+        fs = CubicSpline(np.log(wave_tplo), spec_tplo)(us)
+        wave_tplo, spec_tplo = np.exp(us), fs
+    # np.log(wave) (not us), so the model sees the same values as without the store
+    return wave_tplo, spec_tplo, np.log(wave_tplo)
+
+
+class TplStore:
+    '''
+    Preprocessed orders of a stellar template.
+
+    Parameters
+    ----------
+    Tpl : function
+        Template reader of the instrument module.
+    tplname : str
+        Template file.
+    oversampling : int
+        Oversampling factor (None: as read).
+    targ : SkyCoord
+        Target (passed to the reader).
+    window : tuple
+        Wavelength range (wmin, wmax) the orders are cut to (None: as read). Readers
+        with a parameter window (e.g. for PHOENIX models) read only this range.
+    directory : str
+        Store directory for the .npz file. It is created when writing. Empty:
+        the orders are preprocessed in memory only. When the directory is not
+        writable, the store works in memory only.
+
+    Example
+    -------
+    >>> import contextlib, io, shutil, tempfile
+    >>> with contextlib.redirect_stdout(io.StringIO()): from inst.inst_CRIRES import Tpl
+    >>> tplname = 'tests/test_data/SGC_220325_1.fits'
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> tpl = TplStore(Tpl, tplname, oversampling=2, directory=tmpdir).load([7, 12])
+    >>> wave, spec, lnwave = TplStore(Tpl, tplname, oversampling=2, directory=tmpdir).load([12])[12]
+    >>> np.array_equal(lnwave, np.log(wave)), wave.size == 2 * Tpl(tplname, order=12)[0].size
+    (True, True)
+    >>> shutil.rmtree(tmpdir)
+    '''
+    def __init__(self, Tpl, tplname, oversampling=None, targ=None, window=None, directory=''):
+        self.Tpl = Tpl
+        self.tplname = tplname
+        self.oversampling = oversampling
+        self.targ = targ
+        self.window = window and tuple(map(float, window))
+        self.kwargs = {'window': self.window} if window and 'window' in inspect.signature(Tpl).parameters else {}
+        self.directory = directory
+        module = sys.modules[Tpl.__module__]
+        self.key = hashkey(filehash(tplname), oversampling or None, Tpl.__module__, filehash(module.__file__), targ and repr(targ), self.window)
+        self.filename = directory and os.path.join(directory, f'{os.path.basename(tplname)}.{self.key[:12]}.npz')
+
+    def _read(self):
+        '''The stored orders {order: (wave, spec, lnwave)}.'''
+        if not self.directory:
+            return {}
+        try:
+            with np.load(self.filename) as f:
+                orders = sorted({int(name.split('_')[-1]) for name in f.files})
+                return {o: (f[f'wave_{o}'], f[f'spec_{o}'], f[f'lnwave_{o}']) for o in orders}
+        except (OSError, ValueError, KeyError):
+            return {}
+
+    def _write(self, tpl):
+        arrays = {f'{name}_{o}': x for o, xs in tpl.items() for name, x in zip(('wave', 'spec', 'lnwave'), xs)}
+        tmpname = f'{self.filename}.{os.getpid()}.tmp.npz'
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            np.savez(tmpname, **arrays)
+            os.replace(tmpname, self.filename)
+        except OSError:
+            # read-only store directory
+            pass
+
+    def load(self, orders):
+        '''
+        The preprocessed orders {order: (wave, spec, lnwave)}.
+
+        Missing orders are read with Tpl and added to the store.
+        '''
+        tpl = self._read()
+        missing = [o for o in orders if o not in tpl]
+        for order in missing:
+            wave_tplo, spec_tplo = self.Tpl(self.tplname, order=order, targ=self.targ, **self.kwargs)
+            if self.window:
+                wave_tplo, spec_tplo = cut(wave_tplo, spec_tplo, self.window)
+            tpl[order] = preprocess(wave_tplo, spec_tplo, self.oversampling)
+        if missing and self.directory:
+            self._write(tpl)
+        return {o: tpl[o] for o in orders}
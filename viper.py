@@ -7,7 +7,10 @@
 import argparse
 import glob
 import importlib
+import itertools
 import os
+import re
+import sys
 import time
 from collections import defaultdict
 import configparser
@@ -16,7 +19,6 @@ import numpy as np
 from scipy.optimize import curve_fit
 from scipy.interpolate import CubicSpline
 from astropy.io import fits
-import astropy.units as u
 
 from utils.gplot import *
 gplot.colors('classic')
@@ -24,9 +26,22 @@ gplot2 = Gplot()
 from utils.param import Params
 from utils.pause import pause
 
-from utils.model import model, model_bnd, IPs, show_model, pade
+from utils.model import model, model_bnd, IPs, show_model, pade, Budget, BudgetExceeded, memo_stats
 from utils.targ import Targ
 import utils.convert_output as convert_output
+from utils import engine
+from utils.refdata import RefData
+from utils.journal import Journal
+from utils.cache import FitCache, filehash, hashkey
+from utils.prefetch import Prefetch
+from utils.history import History
+from utils.obscache import ObsCache
+from utils.catalog import Catalog, CATALOG
+from utils.ftscache import cached_fts
+from utils.tplstore import TplStore
+from inst import FTS_resample
+from inst.FTS_resample import LogGrid
+from inst import barycorr
 try:
     import viper.vpr as vpr
 except: 
@@ -37,8 +52,6 @@ viperdir = os.path.dirname(os.path.realpath(__file__)) + os.sep
 
 c = 299792.458   # [km/s] speed of light
 
-targ = None
-modset = {}   # model setting parameters
 insts = [os.path.basename(i)[5:-3] for i in glob.glob(viperdir+'inst/inst_*.py')]
 
 class nameddict(dict):
@@ -76,16 +89,22 @@ flag = nameddict(
 )
 
 
+def index(arg):
+    """Check that an index argument has only numbers, colons and commas (it is evaluated)."""
+    if not re.fullmatch(r'[\s\d:,+-]*', arg):
+        raise argparse.ArgumentTypeError('invalid index: ' + arg)
+    return arg
+
 def arg2slice(arg):
     """Convert string argument to a slice."""
     # We want four cases for indexing: None, int, list of ints, slices.
     # Use [] as default, so 'in' can be used.
     if isinstance(arg, str):
-        arg = eval('np.s_['+arg+']')
+        arg = eval('np.s_['+index(arg)+']')
     return [arg] if isinstance(arg, int) else arg
 
 def arg2range(arg):
-    return  eval('np.r_['+arg+']')
+    return  eval('np.r_['+index(arg)+']')
 
 
 def SSRstat(vgrid, SSR, dk=1, plot='maybe', N=None):
@@ -130,7 +149,8 @@ def SSRstat(vgrid, SSR, dk=1, plot='maybe', N=None):
     return v, e_v, a
 
     
-if __name__ == "__main__" or __name__ == "viper.viper":
+def parse_args(argv=None):
+    '''Parse the command line arguments (default: sys.argv).'''
     # Print defaults, but do not wrap lines
     argparse.ArgumentDefaultsHelpFormatter._split_lines = lambda self, text, width: text.splitlines()
 
@@ -139,13 +159,10 @@ if __name__ == "__main__" or __name__ == "viper.viper":
     preparser.add_argument('args', nargs='*')
     preparser.add_argument('-inst', help='Instrument.', default='TLS', choices=insts)
     preparser.add_argument('-config_file', help='Config file and optional section  [None DEFAULT].', nargs='*', type=str)
-    preargs = preparser.parse_known_args()[0]
+    preargs = preparser.parse_known_args(argv)[0]
     
     Inst = importlib.import_module('inst.inst_'+preargs.inst)
     FTS = Inst.FTS
-    Tpl = Inst.Tpl
-    Spectrum = Inst.Spectrum
-    Tell = getattr(Inst, 'Tell', None)
     iset = getattr(Inst, 'iset', slice(None))
     oset = getattr(Inst, 'oset')
 
@@ -177,7 +194,11 @@ if __name__ == "__main__" or __name__ == "viper.viper":
     argopt('tplname', help='Filename of template.', nargs='?', type=str)
     argopt('-inst', help='Instrument.', default='TLS', choices=insts)
     argopt('-fts', help='Filename of FTS Cell.', default=viperdir + FTS.__defaults__[0], dest='ftsname', type=str)
+    argopt('-ftscache', help='Directory of the resampled FTS (memory mapped on later runs). Empty: not used.', default='', type=str)
     argopt('-ip', help='IP model (g: Gaussian, ag: asymmetric (skewed) Gaussian, sg: super Gaussian, bg: biGaussian, mg: multiple Gaussians, mcg: multiple central Gaussians, bnd: bandmatrix).', default='g', choices=[*IPs], type=str)
+    argopt('-catalog', help='SQLite catalogue of the observation headers for -where.', default=CATALOG, type=str)
+    argopt('-cache', help='Directory of a cache for the chunk fit results. Unchanged chunks are not fitted again.', dest='cachedir', type=str)
+    argopt('-cache_size', help='Size limit of the fit cache [MB]. The least recently used results are removed.', default=1000, type=float)
     argopt('-chunks', nargs='?', help='Divide one order into a number of chunks.', default=1, type=int)
     argopt('-config_file', nargs='*', help='Config file and optional section  [None DEFAULT].', type=str)
     argopt('-createtpl', nargs='?', help='Removal of telluric features (or cell lines) and combination of several observations.', default=False, const=True, type=int)
@@ -187,10 +208,12 @@ if __name__ == "__main__" or __name__ == "viper.viper":
     argopt('-deg_wave', nargs='?', help='Polynomial degree for wavelength scale l(x).', default=3, type=int)
     argopt('-demo', nargs='?', help='Demo plots. Use -8 to skip plots 1,2,4).', default=0, const=-1, type=int)
     argopt('-flagfile', help='Use just good region as defined in flag file.', default='', type=str)
+    argopt('-history', help='File with the runtime history of the chunk fits for the scheduling of parallel runs (e.g. ~/.cache/viper/runtimes.json). Empty: not kept.', default='', type=str)
     argopt('-infoprec', help='Prints and plots information about precision estimates for the star and the iodine.', action='store_true')
     argopt('-iphs', nargs='?', help='Half size of the IP.', default=50, type=int)
     argopt('-ipB', nargs='*', help='Factor of IP width varation.', type=float, default=[])
     argopt('-iset', help='Pixel range.', default=iset, type=arg2slice)
+    argopt('-jobs', nargs='?', help='Number of parallel processes for the chunk fits (0: all cores; negative: all but these).', default=1, const=0, type=int)
     argopt('-kapsig', nargs='*', help='Kappa sigma values for the clipping stages. Zero does not clip.', default=[0], type=float)
     argopt('-kapsig_ctpl', help='Kappa sigma values for the clipping of outliers in template creation.', default=0.6, type=float)
     argopt('-look', nargs='?', help='See final fit of chunk with pause.', default=[], const=':200', type=arg2range)
@@ -200,21 +223,32 @@ if __name__ == "__main__" or __name__ == "viper.viper":
     argopt('-lookres', nargs='?', help='Analyse the residuals.', default=[], const=':200', type=arg2range)
     argopt('-lookctpl', nargs='?', help='Show created template.', default=[], const=':200', type=arg2range)
     #argopt('-nexcl', help='Pattern ignore', default=[], type=arg2range)
+    argopt('-jac', help='Fit with the analytic Jacobian of the model instead of finite differences.', action='store_true')
+    argopt('-varpro', help='Solve the normalisation polynomial by linear least squares within the fit (variable projection).', action='store_true')
+    argopt('-sparse', help='Evaluate the IP convolution only at the grid points next to the pixels.', action='store_true')
+    argopt('-maxfev', help='Maximum number of model evaluations per fit (0: default of curve_fit). Chunks exceeding it fail.', default=0, type=int)
     argopt('-molec', nargs='*', help='Molecular specifies; all: Automatic selection of all present molecules.', default=['all'], type=str)
     argopt('-nexcl', nargs='*', help='Ignore spectra with string pattern.', default=[], type=str)
     argopt('-nocell', help='Do the calibration without using the FTS.', action='store_true')
     argopt('-nset', help='Index for spectrum.', default=':', type=arg2slice)
     argopt('-oset', help='Index for order.', default=oset, type=arg2slice)
+    argopt('-obscache', help='Directory of the preprocessed observations (see utils.obscache). Entries newer than the observation are read instead of the FITS files. Empty: not used.', default='', dest='obscachedir', type=str)
     argopt('-output_format', nargs='*', help='Format of output files for rvo and par data (dat, fits, cpl).', default=['dat'], dest='oformat', type=str)
     argopt('-oversampling', help='Oversampling factor for the template data.', default=None, type=int)
+    argopt('-tplstore', help='Directory of the preprocessed template orders (see utils.tplstore). Empty: not used.', default='', type=str)
+    argopt('-prefetch', help='Number of observations read ahead in background threads while fitting, serially and in each worker (0: no read-ahead).', default=2, type=int)
+    argopt('-resume', help='Continue an interrupted run. Chunks recorded in the journal <tag>.journal are not fitted again.', action='store_true')
     argopt('-rv_guess', help='RV guess.', default=1., type=float)   # slightly offsetted
     argopt('-tag', help='Output tag for filename.', default='tmp', type=str)
     argopt('-targ', help='Target name requested in simbad for coordinates, proper motion, parallax and absolute RV.', dest='targname')
     argopt('-tellshift', nargs='?', help='Variable telluric wavelength shift (one value for all selected molecules).', default=False, const=True, type=int)
     argopt('-telluric', help='Treating tellurics (mask: mask tellurics; sig: downweight tellurics; add: telluric forward modelling with one coeff for each molecule; add2: telluric forward modelling with combined coeff for non-water molecules).', default='', type=str)
+    argopt('-timeout', help='Time limit for the fit of a chunk [s] (0: unlimited). Chunks exceeding it fail.', default=0, type=float)
     argopt('-tpl_wave', help='Output wavelength of generated template (initial: take wavelengths from imput file; berv: apply barycentric correction to input wavelengths; tell: updated wavelength solution estimated via telluric lines).', default='initial', type=str)
     argopt('-tsig', help='(Relative) sigma value for weighting tellurics.', default=1, type=float)
     argopt('-vcut', help='Trim the observation to a range valid for the model [km/s]', default=100, type=float)
+    argopt('-watch', nargs='?', help='Watch obspath and fit new observations as they appear, appending to the output. Optional poll interval [s].', default=0, const=10, type=float)
+    argopt('-where', help='Select observations by an SQL condition on their headers, e.g. "setting=\'K2166\' and date>\'2022-03\'". Columns: date, object, ra, dec, setting, catg, exptime, filename.', default='', type=str)
     argopt('-wgt', nargs='?', help='Weighted least square fit (error: employ data error; tell: upweight tellurics and downweight stellar lines)', default='', type=str)
     argopt('-?', '-h', '-help', '--help', help='Show this help message and exit.', action='help')
 
@@ -225,796 +259,1344 @@ if __name__ == "__main__" or __name__ == "viper.viper":
 
     parser.set_defaults(kapsig = [float(i) for i in (argopt('--kapsig').default.split(' '))])
     
-    args = parser.parse_args()
-    globals().update(vars(args))
+    return parser.parse_args(argv)
 
 
-def fit_chunk(order, chunk, obsname, targ=None, tpltarg=None):
-    ####  observation  ####
-    pixel, wave_obs, spec_obs, err_obs, flag_obs, bjd, berv = Spectrum(obsname, order=order, targ=targ)
-    
-    if telluric == 'mask':
-        flag_obs[mskatm(wave_obs) > 0.1] |= flag.atm
-    flag_obs[np.isnan(spec_obs)] |= flag.nan
+def select_obs(obspath, nset=slice(None), nexcl=[], where='', inst=None, catalog=CATALOG):
+    '''
+    Filenames of the observations matching obspath, selected by index (nset) and excluded by pattern (nexcl).
 
-    # select common wavelength range
-    lmin = max(wave_obs[iset][0], wave_tpl[order][0], wave_cell[0])
-    lmax = min(wave_obs[iset][-1], wave_tpl[order][-1], wave_cell[-1])
+    With an SQL condition where, the files are first selected by their headers in the catalogue.
+    '''
+    obsnames = sorted(glob.glob(obspath))
+    if where:
+        cat = Catalog(catalog)
+        obsnames = cat.select(obsnames, inst, where, keys=getattr(importlib.import_module('inst.inst_'+inst), 'header_keys', None))
+        cat.close()
+    obsnames = np.array(obsnames)[nset]
+    return [x for x in obsnames if not any(pat in os.path.basename(x) for pat in nexcl)]
 
-    # trim the observation to a range valid for the model
-    #  vcut = 100   # [km/s]
-    flag_obs[np.log(wave_obs) < np.log(lmin)+vcut/c] |= flag.out
-    flag_obs[np.log(wave_obs) > np.log(lmax)-vcut/c] |= flag.out
 
-    # using the supersampled log(wavelength) space with knot index j
-    sj = slice(*np.searchsorted(lnwave_j_full, np.log([lmin, lmax])))
-    lnwave_j = lnwave_j_full[sj]
-    spec_cell_j = spec_cell_j_full[sj]
+def fit_options(args):
+    '''The options that can affect the result of a chunk fit.'''
+    nofit = ('obspath', 'nset', 'nexcl', 'where', 'catalog', 'tag', 'oformat', 'config_file', 'jobs', 'history', 'prefetch', 'resume', 'watch', 'cachedir', 'cache_size', 'obscachedir', 'ftscache', 'tplstore',
+             'look', 'lookfast', 'lookguess', 'lookpar', 'lookres', 'lookctpl')
+    return {k: v for k, v in vars(args).items() if k not in nofit}
 
-    ibeg, iend = np.where(flag_obs==0)[0][[0, -1]]   # the first and last pixel that is not trimmed
-    
-    len_ch = int((iend-ibeg)/chunks)
-    ibeg = ibeg + chunk*len_ch
-    iend = ibeg + len_ch
-    if chunks > 1:
-        # divide dataset into chunks
-        flag_obs[:ibeg] |= flag.chunk
-        flag_obs[iend:] |= flag.chunk
-
-    if flagfile:
-        # clip selected pixel ranges in order          
-        for msk_i in msk_o[msk_o.order==order]:
-            flag_obs[int(msk_i.start):int(msk_i.end)] |= flag.clip        
-        # clip selected wavelength regions
-        if len(msk_l):   
-            msk_wave = lambda x: np.interp(x, msk_w, msk_f)
-            flag_obs[msk_wave(wave_obs) > 0.1] |= flag.clip
-
-    if 1:
-        # preclip upper outlier (cosmics)
-        kap = 6
-        p17, smod, p83 = np.percentile(spec_obs[flag_obs==0], [17, 50, 83])
-        sig = (p83 - p17) / 2
-        flag_obs[spec_obs > smod+kap*sig] |= flag.clip
-        # gplot(spec_obs, f', {p17}, {smod}, {p83}, {smod+ kap*sig}')
-
-    # select good pixel
-    i_ok = np.where(flag_obs==0)[0]
-    pixel_ok = pixel[i_ok]
-    wave_obs_ok = wave_obs[i_ok]
-    spec_obs_ok = spec_obs[i_ok]
-
-    modset['xcen'] = xcen = np.nanmean(pixel_ok) + 18   # slight offset, then it converges for CES+TauCet
-    modset['IP_hs'] = iphs
-
-    if deg_norm_rat:
-        # rational polynomial
-        modset['func_norm'] = lambda x, par_norm: pade(x, par_norm[:deg_norm+1], par_norm[deg_norm+1:])
-
-    specs_molec = []
-    par_atm = parfix_atm = []
-    if 'add' in telluric:
-        # select present molecules for telluric forward modeling
-        specs_molec = np.zeros((0, len(lnwave_j)))
-        for mol in specs_molec_all.keys():
-            s_mol = slice(*np.searchsorted(wave_atm_all[mol], [lmin, lmax]))
-            # bring it to same log(wavelength) scale as cell        
-            if specs_molec_all[mol][s_mol] != []:
-                spec_mol = np.interp(lnwave_j, np.log(wave_atm_all[mol][s_mol]), specs_molec_all[mol][s_mol])
-                specs_molec = np.r_[specs_molec, [spec_mol]]
-                # chose just present molecules in wavelength range
-                if np.nanstd(spec_mol) > 0.0001:
-                    par_atm.append((1, np.inf))
-                else:
-                   # fix parameter and set it to nan if molecule is not present in order
-                    par_atm.append((np.nan, 0))	# fix parameter
-            else:
-                # set default spectrum if molecule is not present in wavelength range
-                specs_molec = np.r_[specs_molec, [lnwave_j*0+1]]
-                par_atm.append((np.nan, 0))	# fix parameter 
-
-        if telluric == 'add2' and len(molec) > 1:
-            # use combined coeff for all non-water tellurics instead of one for each molecule
-            # water tellurics grow with airmass and pwv
-            # non-water telluics grow with airmass and depend on seasonal changes
-            par_atm = np.asarray(par_atm)
-            is_H2O = np.asarray(molec) == 'H2O'
-
-            if any(is_H2O):
-                specs_molec = [specs_molec[is_H2O][0], np.nanprod(specs_molec[~is_H2O]*(par_atm[~is_H2O][:, 0]).reshape(-1, 1), axis=0)]
-                par_atm = [(1, np.inf), (1, np.inf)]
+
+class Pipeline:
+    '''
+    A viper session.
+
+    It holds the options and the loaded reference data (FTS cell, tellurics,
+    stellar template), so that many observations, orders and chunks can be fitted
+    without reloading them.
+
+    Parameters
+    ----------
+    args : list or argparse.Namespace
+        Command line arguments as for viper.py or the output of parse_args.
+    **options
+        Further options by their attribute name (e.g. chunks=2, oset=[7, 12]), overriding args.
+
+    Example
+    -------
+    >>> pipe = Pipeline(['data/CRIRES/*.fits', 'tpl.fits', '-inst', 'CRIRES', '-oset', '7,12'])
+    >>> rv, e_rv, bjd, berv, params, e_params, prms = pipe.fit(pipe.obsnames[0], 7)
+    >>> res = pipe.run()
+    >>> res['RV']
+    '''
+    def __init__(self, args=None, **options):
+        if not isinstance(args, argparse.Namespace):
+            args = parse_args(args)
+        vars(args).update(options)
+        vars(self).update(vars(args))
+
+        self.Inst = importlib.import_module('inst.inst_'+self.inst)
+        self.FTS = self.Inst.FTS
+        self.Tpl = self.Inst.Tpl
+        self.configure(args)
+
+        self.obsnames = select_obs(self.obspath, self.nset, self.nexcl, self.where, self.inst, self.catalog)
+        if not self.obsnames: pause('no files: ', self.obspath)
+
+        self.targ = None
+        if self.targname:
+            self.targ = Targ(self.targname, csv=self.tag+'.targ.csv').sc
+
+        self.orders = np.r_[self.oset]
+        print(self.orders)
+
+        self.specs_molec_all = self.wave_atm_all = {}
+        # collect all spectra for createtpl function
+        self.spec_all = defaultdict(dict)
+        self.refdata = None
+        self.reader = None
+        self._refkey = None
+
+        self.load()
+
+    def configure(self, args):
+        '''
+        Take over the options that do not affect the fits (selection, caches, jobs, output, plots).
+
+        A loaded pipeline can so run jobs with other such options (e.g. in the service).
+        '''
+        self.args = args
+        vars(self).update({k: v for k, v in vars(args).items() if k not in fit_options(args)})
+        self.Spectrum = self.Inst.Spectrum
+        self.obscache = ObsCache(self.obscachedir) if self.obscachedir else None
+        if self.obscache:
+            self.Spectrum = self.obscache.wrap(self.Inst)
+        self.fitcache = FitCache(self.cachedir, self.cache_size) if self.cachedir else None
+
+    def load(self):
+        '''Load the reference data.'''
+        # estimate wavelength range from observation
+        pixel, wave0, spec0, err0, flag0, bjd, berv = self.Spectrum(self.obsnames[0], order=self.orders[0])
+        pixel, wave1, spec1, err1, flag1, bjd, berv = self.Spectrum(self.obsnames[0], order=self.orders[-1])
+
+        self.obs_lmin = np.min([wave0[0], wave0[-1], wave1[0], wave1[-1]])
+        self.obs_lmax = np.max([wave0[0], wave0[-1], wave1[0], wave1[-1]])
+
+        self.load_fts(npix=len(pixel))
+
+        # mask wavelengths with strong tellurics
+        self.msk_atm = np.genfromtxt(viperdir+'lib/mask_vis1.0.dat').T
+
+        if self.flagfile:
+            self.load_flagfile()
+
+        if 'add' in self.telluric:
+            self.load_telluric()
+
+        self.load_tpl()
+        self.load_windows()
+
+    def load_fts(self, npix):
+        '''FTS and its supersampled log(wavelength) space with knot index j (resampled in windows, see cell_j).'''
+        if self.ftsname != 'None':
+            # not resampled here (dv=None), but only in the windows of the orders
+            if self.ftscache:
+                fts = cached_fts(self.FTS, self.ftsname, self.ftscache, dv=None)
             else:
-                specs_molec = np.nanprod(specs_molec[~is_H2O]*(par_atm[~is_H2O][:, 0]).reshape(-1, 1), axis=0)
-                par_atm = [(1, np.inf)]
-               
-        # add parameter for telluric position shift if selected
-        if tellshift:
-            par_atm.append((1, np.inf))
+                fts = self.FTS(self.ftsname, dv=None)
+            self.wave_cell, self.spec_cell = fts[:2]
+            u = np.log(self.wave_cell[[0, -1]])
+            self.grid_j = LogGrid(u[0], u[-1], self.FTS.__defaults__[1]/FTS_resample.c)
+        else:
+            # create fake cell spectrum
+            self.wave_cell = np.linspace(self.obs_lmin, self.obs_lmax, npix*len(self.orders)*200)
+            self.spec_cell = self.wave_cell*0 + 1
+            u = np.log(self.wave_cell[[0, -1]])
+            self.grid_j = LogGrid(u[0], u[-1], 200/3e8)
+
+        if self.nocell:
+            # option nocell will be removed in near future
+            self.spec_cell = self.spec_cell*0 + 1
+        self.window_j = {}   # order: (first index, lnwave_j, spec_cell_j)
+
+    def cell_j(self, order, lmin, lmax):
+        '''
+        The supersampled log(wavelength) grid and the cell spectrum on it from lmin to lmax.
+
+        They are slices of the window of the order, which is resampled on first use and
+        extended when a range exceeds it.
+        '''
+        i0, i1 = self.grid_j.index(np.log(lmin)), self.grid_j.index(np.log(lmax))
+        j0, lnwave_j, spec_cell_j = self.window_j.get(order, (i0, (), ()))
+        if i0 < j0 or i1 > j0+len(lnwave_j):
+            if len(lnwave_j):
+                i0, i1 = min(i0, j0), max(i1, j0+len(lnwave_j))
+            j0, lnwave_j, spec_cell_j = self.window_j[order] = (i0, *self.resample_cell(i0, i1))
+        return lnwave_j[i0-j0:i1-j0], spec_cell_j[i0-j0:i1-j0]
+
+    def resample_cell(self, i0, i1):
+        '''The nodes i0 to i1 of the supersampled grid and the cell spectrum interpolated on them.'''
+        lnwave_j = self.grid_j.nodes(i0, i1)
+        if not len(lnwave_j):
+            return lnwave_j, lnwave_j*1.
+        # the part of the FTS bracketing the nodes
+        k0, k1 = np.searchsorted(self.wave_cell, np.exp(lnwave_j[[0, -1]]))
+        s = slice(max(k0-2, 0), k1+2)
+        return lnwave_j, np.interp(lnwave_j, np.log(self.wave_cell[s]), self.spec_cell[s])
+
+    def load_windows(self):
+        '''Resample the cell in the windows of the selected orders (with the vcut margin).'''
+        spectra = self.read_obs(self.obsnames[0])
+        for order in self.orders:
+            spectrum = spectra.get(order) or self.Spectrum(self.obsnames[0], order=order, targ=self.targ)
+            wave_obs = spectrum[1][self.iset]
+            lmin = max(wave_obs[0]*np.exp(-self.vcut/c), self.wave_tpl[order][0], self.wave_cell[0])
+            lmax = min(wave_obs[-1]*np.exp(self.vcut/c), self.wave_tpl[order][-1], self.wave_cell[-1])
+            self.cell_j(order, lmin, lmax)
+
+    def load_flagfile(self):
+        # user created file for removal of selected regions
+        msk = np.genfromtxt(self.flagfile, names=True, invalid_raise=False, missing_values = {'order':"-"}, filling_values={'order':np.nan}, delimiter=' ').view(np.recarray)
+
+        self.msk_o = msk[np.isfinite(msk.order)]		# selected pixel in order
+        self.msk_l = msk_l = msk[np.isnan(msk.order)]		# selected wavelength/lambda ranges
+
+        if len(msk_l):
+            msk_w = np.asarray(np.concatenate([msk_l.start, msk_l.end, msk_l.start-0.05, msk_l.end+0.05]))
+            msk_f = np.asarray(np.concatenate([np.ones(2*len(msk_l.start)), np.zeros(2*len(msk_l.start))]))
+
+            ind = np.argsort(msk_w)
+            self.msk_w, self.msk_f = msk_w[ind], msk_f[ind]
+
+    def load_telluric(self):
+        '''Read in telluric spectra for wavelength range of the instrument.'''
+        bands_all = ['vis', 'J', 'H', 'K']
+        wave_band = [0, 9000, 14000, 18500]
+
+        # select which bands are covered by the observation
+        w0 = self.obs_lmin - wave_band
+        w1 = self.obs_lmax - wave_band
+        bands = bands_all[np.argmin(w0[w0 >= 0]): int(np.argmin(w1[w1 >= 0]) + 1)]
+
+        specs_molec_all = defaultdict(list)
+        wave_atm_all = defaultdict(list)
+        molec_sel = molec = self.molec
+
+        for band in bands:
+
+            hdu = fits.open(viperdir+'/lib/atmos/stdAtmos_'+band+'.fits')
+            cols = hdu[1].columns.names
+            data = hdu[1].data
+
+            if molec_sel[0] == 'all': molec = cols[1:]
+
+            # add wavelength shift
+            # synthetic telluric spectra (molecfit) are laboratory wavelengths
+            # shift was determined empirical from several observations
+            for i_mol, mol in enumerate(molec):
+                if (mol != 'lambda') and (mol in cols):
+                    specs_molec_all[mol].extend(data[mol])
+                    wave_atm_all[mol].extend(data['lambda'] * (1 + (-0.249/3e5)))
+
+            molec = np.array(list(specs_molec_all.keys()))
+
+        self.molec = molec
+        # arrays instead of lists (avoids conversion in each chunk and allows sharing)
+        self.specs_molec_all = {mol: np.asarray(spec_mol) for mol, spec_mol in specs_molec_all.items()}
+        self.wave_atm_all = {mol: np.asarray(wave_mol) for mol, wave_mol in wave_atm_all.items()}
+
+    def load_tpl(self):
+        '''Read the stellar template.'''
+        orders = self.orders
+        if self.tplname:
+            print('reading stellar template')
+            # only the range of the orders (with the vcut margin) is kept, e.g. of a PHOENIX model
+            window = self.obs_lmin*np.exp(-self.vcut/c), self.obs_lmax*np.exp(self.vcut/c)
+            tpl = TplStore(self.Tpl, self.tplname, oversampling=self.oversampling, targ=self.targ, window=window, directory=self.tplstore).load(list(orders))
+            self.wave_tpl = {order: wave for order, (wave, spec, lnwave) in tpl.items()}
+            self.spec_tpl = {order: spec for order, (wave, spec, lnwave) in tpl.items()}
+            self.lnwave_tpl = {order: lnwave for order, (wave, spec, lnwave) in tpl.items()}
+        else:
+            # no template given; model pure iodine
+            self.wave_tpl, self.spec_tpl = [self.wave_cell[[0, -1]]]*200, [np.ones(2)]*200
 
-    if demo & 1:
-        # pre-look raw input
-        s_cell = slice(*np.searchsorted(wave_cell, [lmin, lmax]))
-        s_tpl = slice(*np.searchsorted(wave_tpl[order], [lmin, lmax]))
+        if self.createtpl:
+            wave_tplo, spec_tplo = self.Tpl(self.obsnames[-1], order=orders[-1], targ=self.targ)
+            wmax = np.max(wave_tplo)
+        else:
+            wmax = np.max(self.wave_tpl[orders[-1]])
+
+        if self.telluric == 'add' and (self.wave_cell[-1] < wmax):
+            # extend wavelength range for telluric modelling
+            # iodine ends around order 36 for TLS and OES
+            # at higher orders modelling with telluric lines instead of iodine is possible
+            wave_cell, spec_cell = self.wave_cell, self.spec_cell
+
+            wave_cell_ext = np.arange(wave_cell[-1], wmax, wave_cell[-1]-wave_cell[-2])[1:]
+            spec_cell_ext = np.ones_like(wave_cell_ext)
+
+            self.wave_cell = wave_cell = np.append(wave_cell, wave_cell_ext)
+            self.spec_cell = spec_cell = np.append(spec_cell, spec_cell_ext)
+
+            u = np.log(wave_cell[[0, -1]])
+            self.grid_j = LogGrid(u[0], u[-1], 200/3e8)
+
+            if not self.tplname:
+                self.wave_tpl, self.spec_tpl = [wave_cell[[0, -1]]]*200, [np.ones(2)]*200
+
+    def share(self):
+        '''Place the large read-only arrays in shared memory, so workers neither copy nor rebuild them.'''
+        self.refdata = refdata = RefData()
+        self.wave_cell = refdata.share('wave_cell', self.wave_cell)
+        self.spec_cell = refdata.share('spec_cell', self.spec_cell)
+        self.window_j = {order: (j0, refdata.share(f'lnwave_j[{order}]', lnwave_j), refdata.share(f'spec_cell_j[{order}]', spec_cell_j))
+                         for order, (j0, lnwave_j, spec_cell_j) in self.window_j.items()}
+        self.specs_molec_all = refdata.share_dict('specs_molec_all', self.specs_molec_all)
+        self.wave_atm_all = refdata.share_dict('wave_atm_all', self.wave_atm_all)
+        if self.tplname:
+            self.wave_tpl = refdata.share_dict('wave_tpl', self.wave_tpl)
+            self.spec_tpl = refdata.share_dict('spec_tpl', self.spec_tpl)
+            self.lnwave_tpl = refdata.share_dict('lnwave_tpl', self.lnwave_tpl)
+        print(f'shared reference data: {refdata.nbytes/2**20:.1f} MB')
+
+    def close(self):
+        if self.refdata:
+            self.refdata.unlink()
+            self.refdata = None
+
+    def mskatm(self, x):
+        return np.interp(x, *self.msk_atm)
+
+    def fit_options(self):
+        '''The options that can affect the result of a chunk fit.'''
+        return fit_options(self.args)
+
+    def task_kind(self, order):
+        '''Key of the runtime history: instrument, order and option set.'''
+        options = self.fit_options()
+        options.pop('oset')
+        options.pop('tplname')
+        return f'{self.inst} {order} {hashkey(options)[:12]}'
+
+    def task_memory(self):
+        '''Rough memory of a chunk fit [bytes] from the model grids of the widest order.'''
+        nj = self.grid_j.n
+        if self.tplname:
+            dx = self.grid_j.delta
+            nj = min(nj, max(np.log(self.wave_tpl[o][-1]/self.wave_tpl[o][0]) / dx for o in self.orders))
+        return 8 * nj * (len(self.specs_molec_all) + 12)
+
+    def read_obs(self, obsname):
+        '''
+        Read all orders of an observation (at once, if cached or the instrument provides Spectra).
+
+        If the orders cannot be read at once, they are read one by one. Orders failing also
+        then are left out, so that only their chunks fail (when reading them again).
+        '''
+        res = self.obscache and self.obscache.load(self.Inst, obsname, list(self.orders), targ=self.targ)
+        if not res and hasattr(self.Inst, 'Spectra'):
+            try:
+                res = self.Inst.Spectra(obsname, list(self.orders), targ=self.targ)
+            except Exception:
+                res = None
+        if res:
+            pixel, wave, spec, err, flag, bjd, berv = res
+            return {order: (pixel[i], wave[i], spec[i], err[i], flag[i], bjd, berv) for i, order in enumerate(self.orders)}
+        spectra = {}
+        for order in self.orders:
+            try:
+                spectra[order] = self.Spectrum(obsname, order=order, targ=self.targ)
+            except Exception:
+                pass
+        return spectra
+
+    def barycentric(self, obsnames):
+        '''
+        Compute the barycentric corrections of all observations in one vectorised call.
+
+        Needs the instrument to provide Obsinfo, which returns the target coordinates of the
+        header first (None if there are none) and the mid-exposure time last. The results are
+        memoised for the readers.
+        '''
+        if not hasattr(self.Inst, 'Obsinfo'):
+            return
+        targs, midtimes = [], []
+        for obsname in obsnames:
+            try:
+                info = self.Inst.Obsinfo(obsname)
+            except Exception:
+                # left to the reader
+                continue
+            targ = self.targ or info[0]
+            if targ is None:
+                # no barycentric correction (e.g. OES without -targ)
+                continue
+            targs.append(targ)
+            midtimes.append(info[-1])
+        if midtimes:
+            barycorr.prepare(targs, midtimes, self.Inst.location)
+
+    def spectrum(self, obsname, order, targ=None):
+        '''Spectrum of an order. It comes from the per-observation cache of the reader stage, when it runs.'''
+        spectra = self.reader[obsname] if self.reader and targ is self.targ else {}
+        if order in spectra:
+            # copies, since the flags are modified
+            return [x.copy() if isinstance(x, np.ndarray) else x for x in spectra[order]]
+        return self.Spectrum(obsname, order=order, targ=targ)
+
+    @property
+    def interactive(self):
+        '''Whether options for plots and pauses are set.'''
+        return bool(self.demo or self.infoprec or any(map(len, [self.look, self.lookfast, self.lookguess, self.lookpar, self.lookres])))
+
+    def chunk_key(self, obsname, order, chunk):
+        '''Key of a chunk fit in the fit cache from the content of the input files, the fit options and the code.'''
+        if self._refkey is None:
+            options = self.fit_options()
+            options.pop('oset')
+            # files enter by their content
+            files = {k: filehash(options.pop(k)) for k in ('tplname', 'ftsname', 'flagfile') if options[k] and os.path.isfile(options[k])}
+            # extent of the cell grid (extended for telluric modelling) and the selected molecules
+            grid = len(self.wave_cell), self.wave_cell[-1], self.grid_j.n, list(getattr(self, 'molec', []))
+            # the code of the fit: this module, the instrument module, the model and their helpers
+            modules = self.Inst, sys.modules[model.__module__], sys.modules[Params.__module__], FTS_resample, barycorr
+            code = [filehash(__file__)] + [filehash(module.__file__) for module in modules]
+            self._refkey = hashkey(options, files, grid, code)
+        return hashkey(self._refkey, filehash(obsname), int(order), int(chunk))
+
+    def fit_chunk(self, order, chunk, obsname, targ=None, tpltarg=None, n=0, resfile='res.dat'):
+        budget = Budget(self.maxfev, self.timeout)
+
+        ####  observation  ####
+        pixel, wave_obs, spec_obs, err_obs, flag_obs, bjd, berv = self.spectrum(obsname, order, targ=targ)
+    
+        if self.telluric == 'mask':
+            flag_obs[self.mskatm(wave_obs) > 0.1] |= flag.atm
+        flag_obs[np.isnan(spec_obs)] |= flag.nan
 
-        # plot data, template, and iodine with some scaling
-        gplot.xlabel('"Vacuum wavelength [Å]"')
-        gplot.ylabel('"flux"')
-        gplot(wave_cell[s_cell], spec_cell[s_cell]/np.nanmedian(spec_cell[s_cell]), 'w l lc 9 t "cell",', wave_tpl[order][s_tpl], spec_tpl[order][s_tpl]/np.nanmedian(spec_tpl[order][s_tpl]), 'w l lc 3 t "tpl",', wave_obs, spec_obs/np.nanmedian(spec_obs), 'w lp lc 1 pt 7 ps 0.5 t "obs"')
-        pause('demo 1: raw input')
+        # select common wavelength range
+        lmin = max(wave_obs[self.iset][0], self.wave_tpl[order][0], self.wave_cell[0])
+        lmax = min(wave_obs[self.iset][-1], self.wave_tpl[order][-1], self.wave_cell[-1])
 
+        # trim the observation to a range valid for the model
+        #  vcut = 100   # [km/s]
+        flag_obs[np.log(wave_obs) < np.log(lmin)+self.vcut/c] |= flag.out
+        flag_obs[np.log(wave_obs) > np.log(lmax)-self.vcut/c] |= flag.out
 
-    # convert discrete template into a function
-    if tplname:
-        S_star = lambda x: np.interp(x, np.log(wave_tpl[order]) - np.log(1+berv/c), spec_tpl[order])  # Apply barycentric motion
-    else:
-        S_star = lambda x: 0*x + 1
-
-    IP = IPs[ip]
-
-    # setup the model
-    S_mod = model(S_star, lnwave_j, spec_cell_j, specs_molec, IP, **modset)
-
-    if demo & 2:
-        # plot the IP
-        gplot.xlabel('"[km/s]"')
-        gplot.ylabel('"contribution"')
-        gplot(S_mod.vk, S_mod.IP(S_mod.vk), 't "IP model"')
-        pause('demo 2: default IP')
-
-    if demo & 4:
-       # plot again, now the stellar template can be interpolated
-       gplot.xlabel('"Vacuum wavelength [Å]"')
-       gplot.ylabel('"flux"')
-       gplot(np.exp(lnwave_j), spec_cell_j, S_star(lnwave_j)/np.nanmedian(S_star(lnwave_j)), 'w l lc 9 t "cell", "" us 1:3 w l lc 3 t "tpl"')
-       pause('demo 4: stellar template evaluated at lnwave_j')
-
-
-    # an initial parameter set
-    par = Params()
-
-    # a good guess for the stellar RV is needed
-  #  par.rv = rv_guess if (tplname or createtpl) else (0, 0)   # else: do not fit for RV
-    par.rv = rv_guess if tplname else (0, 0)   # else: do not fit for RV
-
-    # guess for normalization
-    norm_guess = np.nanmean(spec_obs_ok) / np.nanmean(S_star(np.log(wave_obs_ok))) / np.nanmean(spec_cell_j)
-    par.norm = [norm_guess] + [0]*deg_norm
-
-    if deg_norm_rat:
-        # rational polynom
-        par.norm += [5e-7] * deg_norm_rat   # a tiny scale hint (zero didn't iterate)
-        #par.norm += [ 5e-7**(i+1) for i in range(deg_norm_rat)]   # a tiny scale hint (zero didn't iterate)
-
-    # guess wavelength solution
-    par.wave = np.polyfit(pixel_ok-xcen, wave_obs_ok, deg_wave)[::-1]
-    parguess = Params(par)
-
-    # guess IP - read in from instrument file
-    par.ip = [Inst.ip_guess['s']]
-    par.atm = par_atm
-
-    # guess additional background
-    if deg_bkg:
-        par.bkg = [0] #* deg_bkg
-
-    if demo:
-        # disturb guess
-        par.norm = parguess.norm = [norm_guess*1.3] + [0]*deg_norm
-        # b = par_wave_guess = [wave_ob[0], (wave_obs[-1]-wave_obs[0])/wave_obs.size] # [6128.8833940969, 0.05453566108124]
-        par.wave = parguess.wave = [*np.polyfit(pixel[[400, -300]]-xcen-10, wave_obs[[400, -300]], 1)[::-1]] + [0]*(deg_wave-1)
-        par.ip = [par.ip[0]*1.5]
-
-    if ip in Inst.ip_guess:
-        par.ip = Inst.ip_guess[ip]
-    elif ip in ('sg', 'mg', 'asg'):
-        par.ip += [2.]   # exponent of super Gaussian
-    elif ip in ('ag', 'agr', 'asg'):
-        par.ip += [1.]   # skewness parameter (offset to get iterations)
-    elif ip in ('bg',):
-        par.ip += [par.ip[-1]]   # symmetric biGaussian
-    parguess.ip = par.ip
-
-    # set weighting parameter for tellurics
-    sig = 1 * err_obs if (wgt in 'error') else np.ones_like(spec_obs)
-    if telluric in ('sig', 'add', 'add2'):
-        sig[mskatm(wave_obs) < 0.1] = tsig
-
-    if demo & 8:
-        # a simple call to the forward model
-        # Si_mod = S_mod(pixel_ok, par_rv=0, a=a, b=b, s=s)
-        # show the start guess
-        S_mod.show(par, pixel_ok, spec_obs_ok, res=False, dx=0.1)
-        pause('demo 8: Smod simple call')
-
-    fixed = lambda x: [(pk, 0) for pk in x]
-    if demo & 16:
-        # A wrapper to fit the continuum
-        par_d16 = Params(rv=(rv_guess, 0), norm=[norm_guess], wave=fixed(parguess.wave), ip=fixed(parguess.ip), atm=fixed(par.atm))
-        p_norm, _ = S_mod.fit(pixel_ok, spec_obs_ok, par_d16, res=False, dx=0.1, sig=sig[i_ok])
-        parguess.norm[0] = p_norm.norm[0]
-        pause('demo 16: S_par_norm')
-
-    if demo & 32:
-        # A wrapper to fit the wavelength solution
-        par_d32 = Params(rv=(rv_guess, 0), norm=fixed(parguess.norm), wave=parguess.wave[:-1]+[1e-15], ip=fixed(parguess.ip), atm=fixed(par.atm), bkg=[(0, 0)])
-        p_wave, _ = S_mod.fit(pixel_ok, spec_obs_ok, par_d32, res=False, dx=0.1, sig=sig[i_ok])
-        par.wave = p_wave.wave
-        pause('demo 32: S_par_wave')
-
-    if demo & 64:
-        # fit par_rv, a0 and b simultaneously
-        par_d64 = Params(rv=(rv_guess, 0), norm=parguess.norm, wave=par.wave, ip=fixed(parguess.ip), atm=fixed(par.atm), bkg=[(0, 0)])
-        params, _ = S_mod.fit(pixel_ok, spec_obs_ok, par_d64, res=False, dx=0.1, sig=sig[i_ok])
-        par = Params(params)
-        # remove uncertainties
-        par = par + dict([(k, v.value) for k,v in par.flat().items()])
-        pause('demo 64: S_par_norm_wave_rv')
-
-
-    if ip in ('sg', 'ag', 'agr', 'bg', 'bnd'):
-        # prefit with Gaussian IP
-        S_modg = model(S_star, lnwave_j, spec_cell_j, specs_molec, IPs['g'], **modset)
-
-        par1 = Params(par, ip=par.ip[0:1])   # fit only sigma
-        par2, _ = S_modg.fit(pixel_ok, spec_obs_ok, par1, sig=sig[i_ok])
-
-        par = par + par2.flat()   # update, but replace first ip par
-    par3 = par
-
-    if order in lookguess:
-        if demo:
-            par_wave_guess = par_wave
-            par_norm = [norm_guess]
-        params_guess = Params(rv=par.rv, norm=par.norm, wave=parguess.wave, ip=par.ip, atm=parfix_atm, bkg=par.bkg)
-        prms = S_mod.show(params_guess, pixel_ok, spec_obs_ok, res=True, dx=0.1)
-        pause('lookguess')
-
-
-    if kapsig[0]:
-        # first kappa sigma clipping of outliers
-        smod = S_mod(pixel, **par3)
-        resid = spec_obs - smod
-        resid[flag_obs != 0] = np.nan
-
-        flag_obs[abs(resid) >= (kapsig[0]*np.nanstd(resid))] |= flag.clip
-        i_ok = np.where(flag_obs == 0)[0]
+        # using the supersampled log(wavelength) space with knot index j
+        lnwave_j, spec_cell_j = self.cell_j(order, lmin, lmax)
+
+        ibeg, iend = np.where(flag_obs==0)[0][[0, -1]]   # the first and last pixel that is not trimmed
+    
+        len_ch = int((iend-ibeg)/self.chunks)
+        ibeg = ibeg + chunk*len_ch
+        iend = ibeg + len_ch
+        if self.chunks > 1:
+            # divide dataset into chunks
+            flag_obs[:ibeg] |= flag.chunk
+            flag_obs[iend:] |= flag.chunk
+
+        if self.flagfile:
+            # clip selected pixel ranges in order          
+            for msk_i in self.msk_o[self.msk_o.order==order]:
+                flag_obs[int(msk_i.start):int(msk_i.end)] |= flag.clip        
+            # clip selected wavelength regions
+            if len(self.msk_l):   
+                msk_wave = lambda x: np.interp(x, self.msk_w, self.msk_f)
+                flag_obs[msk_wave(wave_obs) > 0.1] |= flag.clip
+
+        if 1:
+            # preclip upper outlier (cosmics)
+            kap = 6
+            p17, smod, p83 = np.percentile(spec_obs[flag_obs==0], [17, 50, 83])
+            sig = (p83 - p17) / 2
+            flag_obs[spec_obs > smod+kap*sig] |= flag.clip
+            # gplot(spec_obs, f', {p17}, {smod}, {p83}, {smod+ kap*sig}')
+
+        # select good pixel
+        i_ok = np.where(flag_obs==0)[0]
         pixel_ok = pixel[i_ok]
         wave_obs_ok = wave_obs[i_ok]
         spec_obs_ok = spec_obs[i_ok]
 
-    if IP == 'bnd':
-        # Non parametric fit with band matrix
-        # We step through velocity in 100 m/s step. At each step there is linear least square
-        # fit for the 2D IP using band matrix.
-        S_mod = model_bnd(S_star, lnwave_j, spec_cell_j, params[2], **modset)
-        opt = {'x': pixel_ok, 'sig_k': par_ip[0]/1.5/c}
-        rr = S_mod.fit(spec_obs_ok, 0.1, **opt)
-        fx = S_mod(pixel_ok, 0.1, rr[0])
-        ipxj = S_mod.IPxj(rr[0])
-        if demo & 2:
-            gplot(ipxj, 'matrix w image')
-
-        e_v = np.nan
-        if tplname:
-            vv = np.arange(-1, 1, 0.1)
-            RR = []
-            aa = []
-            for v in vv:
-                rr = S_mod.fit(spec_obs_ok, v, **opt)
-                RR.append(*rr[1])
-                aa.append(rr[0])
-                if 1:
-                    print(v, rr[1])
-
-            par_rv, e_v, a = SSRstat(vv, RR, plot=1, N=spec_obs_ok.size)
-
-        best = S_mod.fit(spec_obs_ok, par_rv, **opt)
-        fx = S_mod(pixel_ok, par_rv, best[0])
-        pause()
-        S_mod.show([par_rv, best[0]], pixel_ok, spec_obs_ok, x2=pixel_ok)
-        res = spec_obs_ok - fx
-        np.savetxt('res.dat', list(zip(pixel_ok, res)), fmt="%s")
-        prms = np.nanstd(res) / fx.nanmean() * 100
-        if order in look:
-            pause()
-        return par_rv*1000, e_v*1000, bjd.jd, berv, best[0], np.diag(np.nan*best[0]), prms
-    
-    show = (order in look) or (order in lookfast)
-
-    if 1:
-        # par from prefit, (not pre-clip)
-        par.wave = parguess.wave   # why?
-        if ipB:
-            par.bkg = [(0, 0)]
-            par.ipB = [(ipB[0], 0)]
-        if deg_bkg:
-            par.bkg = [0]
-
-        par4, e_params = S_mod.fit(pixel_ok, spec_obs_ok, par, dx=0.1*show, sig=sig[i_ok], res=(not createtpl)*show, rel_fac=createtpl*show)
-        par = par4
-
-    if kapsig[-1]:
-        # second kappa sigma clipping of outliers
-        smod = S_mod(pixel, **par)
-        resid = spec_obs - smod
-        resid[flag_obs != 0] = np.nan
-
-        nr_k1 = np.count_nonzero(flag_obs)
-        flag_obs[abs(resid) >= (kapsig[-1]*np.nanstd(resid))] |= flag.clip
-        nr_k2 = np.count_nonzero(flag_obs)
-
-        # test if outliers were flagged
-        if nr_k1 != nr_k2:
+        modset = {}   # model setting parameters
+        modset['xcen'] = xcen = np.nanmean(pixel_ok) + 18   # slight offset, then it converges for CES+TauCet
+        modset['IP_hs'] = self.iphs
+        modset['budget'] = budget
+        modset['jac'] = self.jac
+        modset['varpro'] = self.varpro
+        modset['sparse'] = self.sparse
+
+        if self.deg_norm_rat:
+            # rational polynomial
+            modset['func_norm'] = lambda x, par_norm: pade(x, par_norm[:self.deg_norm+1], par_norm[self.deg_norm+1:])
+
+        specs_molec = []
+        par_atm = parfix_atm = []
+        if 'add' in self.telluric:
+            # select present molecules for telluric forward modeling
+            specs_molec = np.zeros((0, len(lnwave_j)))
+            for mol in self.specs_molec_all.keys():
+                s_mol = slice(*np.searchsorted(self.wave_atm_all[mol], [lmin, lmax]))
+                # bring it to same log(wavelength) scale as cell        
+                if len(self.specs_molec_all[mol][s_mol]):
+                    spec_mol = np.interp(lnwave_j, np.log(self.wave_atm_all[mol][s_mol]), self.specs_molec_all[mol][s_mol])
+                    specs_molec = np.r_[specs_molec, [spec_mol]]
+                    # chose just present molecules in wavelength range
+                    if np.nanstd(spec_mol) > 0.0001:
+                        par_atm.append((1, np.inf))
+                    else:
+                       # fix parameter and set it to nan if molecule is not present in order
+                        par_atm.append((np.nan, 0))	# fix parameter
+                else:
+                    # set default spectrum if molecule is not present in wavelength range
+                    specs_molec = np.r_[specs_molec, [lnwave_j*0+1]]
+                    par_atm.append((np.nan, 0))	# fix parameter 
+
+            if self.telluric == 'add2' and len(self.molec) > 1:
+                # use combined coeff for all non-water tellurics instead of one for each molecule
+                # water tellurics grow with airmass and pwv
+                # non-water telluics grow with airmass and depend on seasonal changes
+                par_atm = np.asarray(par_atm)
+                is_H2O = np.asarray(self.molec) == 'H2O'
+
+                if any(is_H2O):
+                    specs_molec = [specs_molec[is_H2O][0], np.nanprod(specs_molec[~is_H2O]*(par_atm[~is_H2O][:, 0]).reshape(-1, 1), axis=0)]
+                    par_atm = [(1, np.inf), (1, np.inf)]
+                else:
+                    specs_molec = np.nanprod(specs_molec[~is_H2O]*(par_atm[~is_H2O][:, 0]).reshape(-1, 1), axis=0)
+                    par_atm = [(1, np.inf)]
+               
+            # add parameter for telluric position shift if selected
+            if self.tellshift:
+                par_atm.append((1, np.inf))
+
+        if self.demo & 1:
+            # pre-look raw input
+            s_cell = slice(*np.searchsorted(self.wave_cell, [lmin, lmax]))
+            s_tpl = slice(*np.searchsorted(self.wave_tpl[order], [lmin, lmax]))
+
+            # plot data, template, and iodine with some scaling
+            gplot.xlabel('"Vacuum wavelength [Å]"')
+            gplot.ylabel('"flux"')
+            gplot(self.wave_cell[s_cell], self.spec_cell[s_cell]/np.nanmedian(self.spec_cell[s_cell]), 'w l lc 9 t "cell",', self.wave_tpl[order][s_tpl], self.spec_tpl[order][s_tpl]/np.nanmedian(self.spec_tpl[order][s_tpl]), 'w l lc 3 t "tpl",', wave_obs, spec_obs/np.nanmedian(spec_obs), 'w lp lc 1 pt 7 ps 0.5 t "obs"')
+            pause('demo 1: raw input')
+
+
+        # convert discrete template into a function
+        if self.tplname:
+            lnwave_tpl = self.lnwave_tpl[order] - np.log(1+berv/c)   # Apply barycentric motion
+            S_star = lambda x: np.interp(x, lnwave_tpl, self.spec_tpl[order])
+        else:
+            S_star = lambda x: 0*x + 1
+
+        IP = IPs[self.ip]
+
+        # setup the model
+        S_mod = model(S_star, lnwave_j, spec_cell_j, specs_molec, IP, **modset)
+
+        if self.demo & 2:
+            # plot the IP
+            gplot.xlabel('"[km/s]"')
+            gplot.ylabel('"contribution"')
+            gplot(S_mod.vk, S_mod.IP(S_mod.vk), 't "IP model"')
+            pause('demo 2: default IP')
+
+        if self.demo & 4:
+           # plot again, now the stellar template can be interpolated
+           gplot.xlabel('"Vacuum wavelength [Å]"')
+           gplot.ylabel('"flux"')
+           gplot(np.exp(lnwave_j), spec_cell_j, S_star(lnwave_j)/np.nanmedian(S_star(lnwave_j)), 'w l lc 9 t "cell", "" us 1:3 w l lc 3 t "tpl"')
+           pause('demo 4: stellar template evaluated at lnwave_j')
+
+
+        # an initial parameter set
+        par = Params()
+
+        # a good guess for the stellar RV is needed
+      #  par.rv = rv_guess if (tplname or createtpl) else (0, 0)   # else: do not fit for RV
+        par.rv = self.rv_guess if self.tplname else (0, 0)   # else: do not fit for RV
+
+        # guess for normalization
+        norm_guess = np.nanmean(spec_obs_ok) / np.nanmean(S_star(np.log(wave_obs_ok))) / np.nanmean(spec_cell_j)
+        par.norm = [norm_guess] + [0]*self.deg_norm
+
+        if self.deg_norm_rat:
+            # rational polynom
+            par.norm += [5e-7] * self.deg_norm_rat   # a tiny scale hint (zero didn't iterate)
+            #par.norm += [ 5e-7**(i+1) for i in range(deg_norm_rat)]   # a tiny scale hint (zero didn't iterate)
+
+        # guess wavelength solution
+        par.wave = np.polyfit(pixel_ok-xcen, wave_obs_ok, self.deg_wave)[::-1]
+        parguess = Params(par)
+
+        # guess IP - read in from instrument file
+        par.ip = [self.Inst.ip_guess['s']]
+        par.atm = par_atm
+
+        # guess additional background
+        if self.deg_bkg:
+            par.bkg = [0] #* deg_bkg
+
+        if self.demo:
+            # disturb guess
+            par.norm = parguess.norm = [norm_guess*1.3] + [0]*self.deg_norm
+            # b = par_wave_guess = [wave_ob[0], (wave_obs[-1]-wave_obs[0])/wave_obs.size] # [6128.8833940969, 0.05453566108124]
+            par.wave = parguess.wave = [*np.polyfit(pixel[[400, -300]]-xcen-10, wave_obs[[400, -300]], 1)[::-1]] + [0]*(self.deg_wave-1)
+            par.ip = [par.ip[0]*1.5]
+
+        if self.ip in self.Inst.ip_guess:
+            par.ip = self.Inst.ip_guess[self.ip]
+        elif self.ip in ('sg', 'mg', 'asg'):
+            par.ip += [2.]   # exponent of super Gaussian
+        elif self.ip in ('ag', 'agr', 'asg'):
+            par.ip += [1.]   # skewness parameter (offset to get iterations)
+        elif self.ip in ('bg',):
+            par.ip += [par.ip[-1]]   # symmetric biGaussian
+        parguess.ip = par.ip
+
+        # set weighting parameter for tellurics
+        sig = 1 * err_obs if (self.wgt in 'error') else np.ones_like(spec_obs)
+        if self.telluric in ('sig', 'add', 'add2'):
+            sig[self.mskatm(wave_obs) < 0.1] = self.tsig
+
+        if self.demo & 8:
+            # a simple call to the forward model
+            # Si_mod = S_mod(pixel_ok, par_rv=0, a=a, b=b, s=s)
+            # show the start guess
+            S_mod.show(par, pixel_ok, spec_obs_ok, res=False, dx=0.1)
+            pause('demo 8: Smod simple call')
+
+        fixed = lambda x: [(pk, 0) for pk in x]
+        if self.demo & 16:
+            # A wrapper to fit the continuum
+            par_d16 = Params(rv=(self.rv_guess, 0), norm=[norm_guess], wave=fixed(parguess.wave), ip=fixed(parguess.ip), atm=fixed(par.atm))
+            p_norm, _ = S_mod.fit(pixel_ok, spec_obs_ok, par_d16, res=False, dx=0.1, sig=sig[i_ok])
+            parguess.norm[0] = p_norm.norm[0]
+            pause('demo 16: S_par_norm')
+
+        if self.demo & 32:
+            # A wrapper to fit the wavelength solution
+            par_d32 = Params(rv=(self.rv_guess, 0), norm=fixed(parguess.norm), wave=parguess.wave[:-1]+[1e-15], ip=fixed(parguess.ip), atm=fixed(par.atm), bkg=[(0, 0)])
+            p_wave, _ = S_mod.fit(pixel_ok, spec_obs_ok, par_d32, res=False, dx=0.1, sig=sig[i_ok])
+            par.wave = p_wave.wave
+            pause('demo 32: S_par_wave')
+
+        if self.demo & 64:
+            # fit par_rv, a0 and b simultaneously
+            par_d64 = Params(rv=(self.rv_guess, 0), norm=parguess.norm, wave=par.wave, ip=fixed(parguess.ip), atm=fixed(par.atm), bkg=[(0, 0)])
+            params, _ = S_mod.fit(pixel_ok, spec_obs_ok, par_d64, res=False, dx=0.1, sig=sig[i_ok])
+            par = Params(params)
+            # remove uncertainties
+            par = par + dict([(k, v.value) for k,v in par.flat().items()])
+            pause('demo 64: S_par_norm_wave_rv')
+
+
+        if self.ip in ('sg', 'ag', 'agr', 'bg', 'bnd'):
+            # prefit with Gaussian IP
+            S_modg = model(S_star, lnwave_j, spec_cell_j, specs_molec, IPs['g'], **modset)
+
+            par1 = Params(par, ip=par.ip[0:1])   # fit only sigma
+            par2, _ = S_modg.fit(pixel_ok, spec_obs_ok, par1, sig=sig[i_ok])
+
+            par = par + par2.flat()   # update, but replace first ip par
+        par3 = par
+
+        if order in self.lookguess:
+            if self.demo:
+                par_wave_guess = par_wave
+                par_norm = [norm_guess]
+            params_guess = Params(rv=par.rv, norm=par.norm, wave=parguess.wave, ip=par.ip, atm=parfix_atm, bkg=par.bkg)
+            prms = S_mod.show(params_guess, pixel_ok, spec_obs_ok, res=True, dx=0.1)
+            pause('lookguess')
+
+
+        if self.kapsig[0]:
+            # first kappa sigma clipping of outliers
+            smod = S_mod(pixel, **par3)
+            resid = spec_obs - smod
+            resid[flag_obs != 0] = np.nan
+
+            flag_obs[abs(resid) >= (self.kapsig[0]*np.nanstd(resid))] |= flag.clip
             i_ok = np.where(flag_obs == 0)[0]
             pixel_ok = pixel[i_ok]
             wave_obs_ok = wave_obs[i_ok]
             spec_obs_ok = spec_obs[i_ok]
+
+        if IP == 'bnd':
+            # Non parametric fit with band matrix
+            # We step through velocity in 100 m/s step. At each step there is linear least square
+            # fit for the 2D IP using band matrix.
+            S_mod = model_bnd(S_star, lnwave_j, spec_cell_j, params[2], **modset)
+            opt = {'x': pixel_ok, 'sig_k': par_ip[0]/1.5/c}
+            rr = S_mod.fit(spec_obs_ok, 0.1, **opt)
+            fx = S_mod(pixel_ok, 0.1, rr[0])
+            ipxj = S_mod.IPxj(rr[0])
+            if self.demo & 2:
+                gplot(ipxj, 'matrix w image')
+
+            e_v = np.nan
+            if self.tplname:
+                vv = np.arange(-1, 1, 0.1)
+                RR = []
+                aa = []
+                for v in vv:
+                    rr = S_mod.fit(spec_obs_ok, v, **opt)
+                    RR.append(*rr[1])
+                    aa.append(rr[0])
+                    if 1:
+                        print(v, rr[1])
+
+                par_rv, e_v, a = SSRstat(vv, RR, plot=1, N=spec_obs_ok.size)
+
+            best = S_mod.fit(spec_obs_ok, par_rv, **opt)
+            fx = S_mod(pixel_ok, par_rv, best[0])
+            pause()
+            S_mod.show([par_rv, best[0]], pixel_ok, spec_obs_ok, x2=pixel_ok)
+            res = spec_obs_ok - fx
+            np.savetxt(resfile, list(zip(pixel_ok, res)), fmt="%s")
+            prms = np.nanstd(res) / fx.nanmean() * 100
+            if order in self.look:
+                pause()
+            return par_rv*1000, e_v*1000, bjd.jd, berv, best[0], np.diag(np.nan*best[0]), prms
+    
+        show = (order in self.look) or (order in self.lookfast)
+
+        if 1:
+            # par from prefit, (not pre-clip)
+            par.wave = parguess.wave   # why?
+            if self.ipB:
+                par.bkg = [(0, 0)]
+                par.ipB = [(self.ipB[0], 0)]
+            if self.deg_bkg:
+                par.bkg = [0]
+
+            par4, e_params = S_mod.fit(pixel_ok, spec_obs_ok, par, dx=0.1*show, sig=sig[i_ok], res=(not self.createtpl)*show, rel_fac=self.createtpl*show)
+            par = par4
+
+        if self.kapsig[-1]:
+            # second kappa sigma clipping of outliers
+            smod = S_mod(pixel, **par)
+            resid = spec_obs - smod
+            resid[flag_obs != 0] = np.nan
+
+            nr_k1 = np.count_nonzero(flag_obs)
+            flag_obs[abs(resid) >= (self.kapsig[-1]*np.nanstd(resid))] |= flag.clip
+            nr_k2 = np.count_nonzero(flag_obs)
+
+            # test if outliers were flagged
+            if nr_k1 != nr_k2:
+                i_ok = np.where(flag_obs == 0)[0]
+                pixel_ok = pixel[i_ok]
+                wave_obs_ok = wave_obs[i_ok]
+                spec_obs_ok = spec_obs[i_ok]
             
-        if wgt in 'tell':  
-            # up-weighting of telluric lines, down-weighting of stellar lines
-            # this weigthing option raises problems for orders with too weak lines  
-            # test if atmosphere is modelled correctly in the first round
-            # uncertanties are large or zero in case of problems, f.e. too weak lines
-            # tests are still on-going to find best parameters          
-            atm_ok = np.array([0 if (d.unc>20 or d.unc==0) else 1 for d in par.atm])
-            atm_ok[np.array(par.atm)<0.2] = 0
-
-            if np.sum(atm_ok) > 0:           
-                # modelled telluric spectrum
-                sig = smod**2/spec_obs
-                sig /= np.nanmedian(sig[i_ok])
-                # down-weigth saturated lines
-                sig[spec_obs/np.nanmedian(spec_obs[i_ok])<0.1] = 2
-
-        if (nr_k1 != nr_k2) or ('tell' in wgt):
-            par5, e_params = S_mod.fit(pixel_ok, spec_obs_ok, par3, dx=0.1*show, sig=sig[i_ok], res=(not createtpl)*show, rel_fac=createtpl*show)
-            par = par5
+            if self.wgt in 'tell':  
+                # up-weighting of telluric lines, down-weighting of stellar lines
+                # this weigthing option raises problems for orders with too weak lines  
+                # test if atmosphere is modelled correctly in the first round
+                # uncertanties are large or zero in case of problems, f.e. too weak lines
+                # tests are still on-going to find best parameters          
+                atm_ok = np.array([0 if (d.unc>20 or d.unc==0) else 1 for d in par.atm])
+                atm_ok[np.array(par.atm)<0.2] = 0
+
+                if np.sum(atm_ok) > 0:           
+                    # modelled telluric spectrum
+                    sig = smod**2/spec_obs
+                    sig /= np.nanmedian(sig[i_ok])
+                    # down-weigth saturated lines
+                    sig[spec_obs/np.nanmedian(spec_obs[i_ok])<0.1] = 2
+
+            if (nr_k1 != nr_k2) or ('tell' in self.wgt):
+                par5, e_params = S_mod.fit(pixel_ok, spec_obs_ok, par3, dx=0.1*show, sig=sig[i_ok], res=(not self.createtpl)*show, rel_fac=self.createtpl*show)
+                par = par5
         
-        if wgt in 'tell':            
-           # modelled telluric spectrum
-           sig = smod**2/spec_obs
-           sig /= np.nanmedian(sig[i_ok])
-           sig[spec_obs/np.nanmedian(spec_obs[i_ok])<0.1] = 2
-
-        if (nr_k1 != nr_k2) or ('tell' in wgt):
-            par5, e_params = S_mod.fit(pixel_ok, spec_obs_ok, par3, dx=0.1*show, sig=sig[i_ok], res=(not createtpl)*show, rel_fac=createtpl*show)
-            par = par5
+            if self.wgt in 'tell':            
+               # modelled telluric spectrum
+               sig = smod**2/spec_obs
+               sig /= np.nanmedian(sig[i_ok])
+               sig[spec_obs/np.nanmedian(spec_obs[i_ok])<0.1] = 2
+
+            if (nr_k1 != nr_k2) or ('tell' in self.wgt):
+                par5, e_params = S_mod.fit(pixel_ok, spec_obs_ok, par3, dx=0.1*show, sig=sig[i_ok], res=(not self.createtpl)*show, rel_fac=self.createtpl*show)
+                par = par5
        
-    if createtpl:
-        if tplname:
-            # model just the tellurics; exclude stellar lines
-            S_star = lambda x: 0*x + 1
-            S_mod = model(S_star, lnwave_j, spec_cell_j, specs_molec, IP, **modset)
+        if self.createtpl:
+            if self.tplname:
+                # model just the tellurics; exclude stellar lines
+                S_star = lambda x: 0*x + 1
+                S_mod = model(S_star, lnwave_j, spec_cell_j, specs_molec, IP, **modset)
             
-        # modeled telluric spectrum
-        spec_model = np.nan * np.empty_like(pixel)
-        spec_model[iset] = S_mod(pixel[iset], **par)
-        spec_model /= np.nanmedian(spec_model[iset])
-
-        # telluric corrected spectrum
-        spec_cor = spec_obs / spec_model
-        err_cor = err_obs / spec_model
-
-        # remove regions with strong telluric lines
-        spec_cor[spec_model<0.2] = np.nan
-        #spec_cor[spec_cor<3*err_cor] = np.nan
-        spec_cor[spec_cor<0.01] = np.nan
-
-        # select wavelength solution for the created template
-        if tpl_wave in ('initial', 'berv'):
-            # use wavelength solution from input file
-            wave_model= wave_obs + 0
-        elif tpl_wave in ('tell'):
-            # use wavelength solution calculated via telluric lines 
-            wave_model = np.poly1d(par.wave[::-1])(pixel-xcen)
-        bervt = berv + 0
-        if tpl_wave in ('initial'): 
-            # apply no barycentric correction 
-            bervt = 0
+            # modeled telluric spectrum
+            spec_model = np.nan * np.empty_like(pixel)
+            spec_model[self.iset] = S_mod(pixel[self.iset], **par)
+            spec_model /= np.nanmedian(spec_model[self.iset])
+
+            # telluric corrected spectrum
+            spec_cor = spec_obs / spec_model
+            err_cor = err_obs / spec_model
+
+            # remove regions with strong telluric lines
+            spec_cor[spec_model<0.2] = np.nan
+            #spec_cor[spec_cor<3*err_cor] = np.nan
+            spec_cor[spec_cor<0.01] = np.nan
+
+            # select wavelength solution for the created template
+            if self.tpl_wave in ('initial', 'berv'):
+                # use wavelength solution from input file
+                wave_model= wave_obs + 0
+            elif self.tpl_wave in ('tell'):
+                # use wavelength solution calculated via telluric lines 
+                wave_model = np.poly1d(par.wave[::-1])(pixel-xcen)
+            bervt = berv + 0
+            if self.tpl_wave in ('initial'): 
+                # apply no barycentric correction 
+                bervt = 0
         
-        spec_cor = np.interp(wave_model, wave_model*(1+bervt/c)/(1+par.rv/c), spec_cor/np.nanmedian(spec_cor))
-        spec_cor /= np.nanmedian(spec_cor)
-
-        # downweighting by telluric spectrum and errors
-        weight = spec_model / (err_cor/np.nanmedian(spec_cor))**2
-        # weight[spec_model<0.2] = 0.00001   # downweight deep telluric lines
-        weight = np.interp(wave_model, wave_model*(1+bervt/c)/(1+par.rv/c), weight)
-
-        # save telluric corrected spectrum
-        spec_all[order, 0][n] = wave_model   # updated wavelength
-        spec_all[order, 1][n] = spec_cor     # telluric corrected spectrum
-        spec_all[order, 2][n] = weight       # weighting for combination of spectra
-
-    if show:
-        # overplot flagged and clipped data
-        gplot+(pixel[flag_obs != 0], wave_obs[flag_obs != 0], spec_obs[flag_obs != 0], 1*(flag_obs[flag_obs != 0] == flag.clip), 'us (lam?$2:$1):3:(int($4)?5:9) w p pt 6 ps 0.5 lc 9 t "flagged and clipped"')
-
-    if infoprec:
-        # estimate velocity precision limit from stellar information content
-        # without iodine cell (smoothed to a constant)
-        S_pure = model(S_star, lnwave_j, spec_cell_j*0+np.nanmean(spec_cell_j), specs_molec, IP, **modset)
-        dS = S_pure(pixel+0.1, **par) - S_pure(pixel, **par)   # flux gradient from finite difference
-        du = 1000 * c * np.diff(wave_obs)*0.1 / wave_obs[:-1]   # [m/s] velocity differential from initial solution
-        # assuming spectrum given in photon counts (until viper propagates flux uncertainties)
-        varS = abs(spec_obs) + 5**2   # (5 = readout noise)
-        # RV precision Eq. (6) from Butler+ (1996PASP..108..500B)
-        ev_star = np.sum(((dS[:-1]/du)**2 / varS[:-1])[i_ok])**-0.5
-        print(f'Stellar RV precision limit: {ev_star} m/s')
-
-        # estimate velocity precision limit for the iodine from its RV information content
-        # now the star is smoothed
-        tpl_smooth = np.cumsum(spec_tpl[order])
-        wz = 1000   # window size
-        tpl_smooth = (tpl_smooth[wz:] - tpl_smooth[:-wz]) / wz
-        # gplot(spec_tpl[order], ',', tpl_smooth)
-        S_smooth = lambda x: np.interp(x, np.log(wave_tpl[order][wz//2:-wz//2])-berv/c, tpl_smooth)
-        iod_pure = model(S_smooth, lnwave_j, spec_cell_j, specs_molec, IP, **modset)
-        dS = iod_pure(pixel+0.1, **par) - iod_pure(pixel, **par)   # flux gradient from finite difference
-        ev_iod = np.sum(((dS[:-1]/du)**2 / varS[:-1])[i_ok])**-0.5
-        print(f'Iodine RV precision limit: {ev_iod} m/s')
-
-        # total precision is the squared sum of both
-        # in practice it will be worse, since more parameters are modelled
-        ev_total = np.sqrt(ev_star**2 + ev_iod**2)
-        print(f'Total RV precision limit: {ev_total} m/s')
-        if 1:
-            gplot2.xlabel('"pixel"')
-            gplot2.ylabel('"flux"')
-            gplot2(pixel, spec_obs, flag_obs, f' us 1:2:($3>0?9:1) lc var ps 0.5 t "data ({ev_total:.2f} m/s)",', pixel, iod_pure(pixel, **par)+np.nanmean(spec_obs)/2, flag_obs, f' us 1:2:($3>0?9:2) w l lc var t "offset + IP x iod ({ev_iod:.2f} m/s)",', pixel, S_pure(pixel, **par), flag_obs, f' us 1:2:($3>0?9:3) w l lc var t "IP x star ({ev_star:.2f} m/s)"')
-            pause()
+            spec_cor = np.interp(wave_model, wave_model*(1+bervt/c)/(1+par.rv/c), spec_cor/np.nanmedian(spec_cor))
+            spec_cor /= np.nanmedian(spec_cor)
+
+            # downweighting by telluric spectrum and errors
+            weight = spec_model / (err_cor/np.nanmedian(spec_cor))**2
+            # weight[spec_model<0.2] = 0.00001   # downweight deep telluric lines
+            weight = np.interp(wave_model, wave_model*(1+bervt/c)/(1+par.rv/c), weight)
+
+            # save telluric corrected spectrum
+            self.spec_all[order, 0][n] = wave_model   # updated wavelength
+            self.spec_all[order, 1][n] = spec_cor     # telluric corrected spectrum
+            self.spec_all[order, 2][n] = weight       # weighting for combination of spectra
+
+        if show:
+            # overplot flagged and clipped data
+            gplot+(pixel[flag_obs != 0], wave_obs[flag_obs != 0], spec_obs[flag_obs != 0], 1*(flag_obs[flag_obs != 0] == flag.clip), 'us (lam?$2:$1):3:(int($4)?5:9) w p pt 6 ps 0.5 lc 9 t "flagged and clipped"')
+
+        if self.infoprec:
+            # estimate velocity precision limit from stellar information content
+            # without iodine cell (smoothed to a constant)
+            S_pure = model(S_star, lnwave_j, spec_cell_j*0+np.nanmean(spec_cell_j), specs_molec, IP, **modset)
+            dS = S_pure(pixel+0.1, **par) - S_pure(pixel, **par)   # flux gradient from finite difference
+            du = 1000 * c * np.diff(wave_obs)*0.1 / wave_obs[:-1]   # [m/s] velocity differential from initial solution
+            # assuming spectrum given in photon counts (until viper propagates flux uncertainties)
+            varS = abs(spec_obs) + 5**2   # (5 = readout noise)
+            # RV precision Eq. (6) from Butler+ (1996PASP..108..500B)
+            ev_star = np.sum(((dS[:-1]/du)**2 / varS[:-1])[i_ok])**-0.5
+            print(f'Stellar RV precision limit: {ev_star} m/s')
+
+            # estimate velocity precision limit for the iodine from its RV information content
+            # now the star is smoothed
+            tpl_smooth = np.cumsum(self.spec_tpl[order])
+            wz = 1000   # window size
+            tpl_smooth = (tpl_smooth[wz:] - tpl_smooth[:-wz]) / wz
+            # gplot(spec_tpl[order], ',', tpl_smooth)
+            S_smooth = lambda x: np.interp(x, self.lnwave_tpl[order][wz//2:-wz//2]-berv/c, tpl_smooth)
+            iod_pure = model(S_smooth, lnwave_j, spec_cell_j, specs_molec, IP, **modset)
+            dS = iod_pure(pixel+0.1, **par) - iod_pure(pixel, **par)   # flux gradient from finite difference
+            ev_iod = np.sum(((dS[:-1]/du)**2 / varS[:-1])[i_ok])**-0.5
+            print(f'Iodine RV precision limit: {ev_iod} m/s')
+
+            # total precision is the squared sum of both
+            # in practice it will be worse, since more parameters are modelled
+            ev_total = np.sqrt(ev_star**2 + ev_iod**2)
+            print(f'Total RV precision limit: {ev_total} m/s')
+            if 1:
+                gplot2.xlabel('"pixel"')
+                gplot2.ylabel('"flux"')
+                gplot2(pixel, spec_obs, flag_obs, f' us 1:2:($3>0?9:1) lc var ps 0.5 t "data ({ev_total:.2f} m/s)",', pixel, iod_pure(pixel, **par)+np.nanmean(spec_obs)/2, flag_obs, f' us 1:2:($3>0?9:2) w l lc var t "offset + IP x iod ({ev_iod:.2f} m/s)",', pixel, S_pure(pixel, **par), flag_obs, f' us 1:2:($3>0?9:3) w l lc var t "IP x star ({ev_star:.2f} m/s)"')
+                pause()
+
+        # overplot FTS iodine spectrum
+        #gplot+(np.exp(lnwave_j), spec_cell_j/spec_cell_j.max()*spec_obs_ok.max(), 'w l lc 9')
+        # overplot stellar spectrum
+        #gplot+(np.exp(lnwave_j), S_star(lnwave_j)/S_star(lnwave_j).max()*spec_obs_ok.max(), 'w l lc 9')
+
+        rvo, e_rvo = 1000*par.rv, 1000*par.rv.unc   # convert to m/s
+        #prms = S_mod.show([params[0], params[1:1+1+deg_norm], params[2+deg_norm:2+deg_norm+1+deg_wave], params[3+deg_norm+deg_wave:]], pixel_ok, spec_obs_ok, dx=0.1)
+        # gplot+(wave_tpl[s_s]*(1-berv/c), spec_tpl[s_s]*parguess_norm, 'w lp lc 4 ps 0.5')
+        #gplot+(pixel_ok, S_star(np.log(np.poly1d(b[::-1])(pixel_ok))+(v)/c), 'w lp ps 0.5')
+        # gplot+(np.exp(S_star.x), S_star.y, 'w lp ps 0.5 lc 7')
+
+        fmod = S_mod(pixel_ok, **par)
+        res = spec_obs_ok - fmod
+        prms = np.nanstd(res) / np.nanmean(fmod) * 100
+        np.savetxt(resfile, list(zip(pixel_ok, res)), fmt="%s")
+
+        if order in self.look:
+            pause('look %s:'% order, rvo, '+/- %.2f' % e_rvo)  # globals().update(locals())
+
+        if order in self.lookres:
+            gplot2.palette_defined('(0 "blue", 1 "green", 2 "red")')
+            gplot2.var(j=1, lab_ddS='"Finite second derivative 2S(i) - S(i+1) - S(i-1)"')
+            # shortcut "j" allows to toggle between flux and second derivative
+            gplot2.bind('j "j=(j+1) % 2; set xlabel (j==0? \\"S(i)\\" : lab_ddS) ;repl"')
+            gplot2.xlabel('lab_ddS')
+            gplot2.ylabel('"residuals S_i - S(i)"')
+            gplot2.cblabel('"pixel x_i"')
+            #gplot(pixel_ok, spec_obs_ok, S_mod(pixel_ok, **par), 2*spec_obs_ok-f[pixel_ok-1]-f[pixel_ok+1], 'us 3+j:($2-$3):1 w p pt 7 palette t ""')
+            gplot2(pixel_ok, spec_obs_ok, S_mod(pixel_ok, **par), 2*S_mod(pixel_ok, **par)-S_mod(pixel_ok-1, **par)-S_mod(pixel_ok+1, **par), 'us 3+j:($2-$3):1 w p pt 7 palette t ""')
+            pause(f'lookres {order}')
+
+        if order in self.lookpar:   
+            sa = self.tplname is not None
+            sb = sa + self.deg_norm+1
+            ss = sb + self.deg_wave+1
+            # error estimation
+            # uncertainty in continuum
+            xl = np.log(np.poly1d(par.wave[::-1])(pixel-xcen))
+            Cg = np.poly1d(parguess.norm[::-1])(pixel-xcen)      # continuum guess
+            Cp = np.poly1d(par.norm[::-1])(pixel-xcen)    # best continuum 
+            X = np.vander(xl, self.deg_norm+1)[:,::-1].T
+            e_Cp = np.einsum('ji,jk,ki->i', X, e_params[sa:sb,sa:sb], X)**0.5
+            # uncertainty in wavelength solution
+            X = np.vander(xl, self.deg_wave+1)[:,::-1].T
+            lam_g = np.poly1d(parguess.wave[::-1])(pixel-xcen)
+            lam = np.poly1d(par.wave[::-1])(pixel-xcen)
+            e_lam = np.einsum('ji,jk,ki->i', X, e_params[sb:ss,sb:ss], X)**0.5
+            e_wavesol = np.sum((e_lam/lam*3e8)**-2)**-0.5
+
+            # compare the wavelength solutions
+            #show_model(i, np.poly1d(b[::-1])(i), np.poly1d(par_wave_guess[::-1])(i), res=True)
+            gplot.reset()
+            gplot.multiplot("layout 2,2")
+            gplot.xlabel('"pixel"').ylabel('"k(x2)"')
+            gplot.mxtics().mytics()
+            gplot(f'[{ibeg}:{iend}][0:]', pixel, Cg, Cp, e_Cp, 'w l lc 9 t "guess",  "" us 1:3 w l lc 3, "" us 1:($3-$4):($3+$4) w filledcurves fill fs transparent solid 0.2 lc 3 t "1{/Symbol s}" ')
+            gplot.xlabel('"pixel"').ylabel('"deviation c * ({/Symbol l} / {/Symbol l}_{guess} - 1) [km/s]"')
+            gplot(f'[{ibeg}:{iend}]', pixel, (lam/lam_g-1)*c, ((lam-e_lam)/lam_g-1)*c, ((lam+e_lam)/lam_g-1)*c, 'w l lc 3, "" us 1:3:4 w filledcurves fill fs transparent solid 0.2 lc 3 t "1{/Symbol s}"')
+            gplot.xlabel('"[km/s]"').ylabel('"contribution"')
+            e_s = e_params[ss,ss]**0.5
+            gplot(S_mod.vk, S_mod.IP(S_mod.vk, *parguess.ip), ' lc 9 ps 0.5 t "IP_{guess}", ',
+                  S_mod.vk, S_mod.IP(S_mod.vk, *par.ip),
+                            S_mod.IP(S_mod.vk, *[par.ip[0]-e_s, *par.ip[1:]]),
+                            S_mod.IP(S_mod.vk, *[par.ip[0]+e_s, *par.ip[1:]]),
+                  'lc 3 ps 0.5 t "IP", "" us 1:3:4 w filledcurves fill fs transparent solid 0.2 lc 3 t "1{/Symbol s}"')
+            gplot.unset('multiplot')
+            pause('lookpar', par.ip)
+
+        return rvo, e_rvo, bjd.jd, berv, par, e_params, prms
+
+    def fit(self, obsname, order, chunk=0):
+        '''
+        Fit one chunk of an order of an observation.
+
+        Returns
+        -------
+        rv, e_rv : RV and its uncertainty [m/s].
+        bjd, berv : Barycentric Julian date and barycentric correction [km/s].
+        params : Params
+            Best fit parameters (rv in km/s).
+        e_params : Covariance matrix.
+        prms : Relative rms of residuals [%].
+        '''
+        return self.fit_chunk(order, chunk, obsname, targ=self.targ)
+
+    def fit_task(self, task):
+        '''
+        Fit one chunk of an observation.
+
+        Wraps fit_chunk for the serial loop and for the worker processes. Returns the fit result
+        (None on failure; without params for chunks exceeding the budget), the products for the
+        template creation, the error message, the runtime (None for cached results), and the
+        reused and all model evaluations.
+        '''
+        t0 = time.time()
+        memo0 = memo_stats['hits'], memo_stats['calls']
+        n, obsname, o, ch = task
+        filename = os.path.basename(obsname)
+        gplot.RV2title = lambda x: gplot.key('title noenhanced "%s (n=%s, o=%s%s)"'% (filename, n+1, o, x))
+        gplot.RV2title('')
+
+        key = self.fitcache and not self.interactive and self.chunk_key(obsname, o, ch)
+        cached = key and self.fitcache.get(key)
+        if cached:
+            result, products = cached
+            return result, products, None, None, (0, 0)
+
+        result = err = None
+        try:
+            result = self.fit_chunk(o, ch, obsname=obsname, targ=self.targ, n=n, resfile='res/%03d_%03d.dat' % (n, o))
+        except BudgetExceeded as e:
+            err = repr(e)
+            # the time stamps for the row of the failed chunk
+            bjd, berv = self.spectrum(obsname, o, targ=self.targ)[5:]
+            result = np.nan, np.nan, bjd.jd, berv, None, None, np.nan
+        except Exception as e:
+            err = repr(e)
+
+        # hand back the telluric corrected spectra (the workers do not share spec_all)
+        products = {k: self.spec_all[k].pop(n) for k in [(o, 0), (o, 1), (o, 2)] if n in self.spec_all.get(k, {})}
+
+        if key and not err:
+            self.fitcache.put(key, (result, products))
+
+        memo = memo_stats['hits'] - memo0[0], memo_stats['calls'] - memo0[1]
+        return result, products, err, time.time() - t0, memo
+
+    def fit_tasks(self, tasks):
+        '''
+        Fit a list of chunk tasks, e.g. the batch of observations of a worker.
+
+        Without a reader of the run (see run), the observations of the tasks are read once,
+        all orders at a time, and the next one while fitting.
+        '''
+        if self.reader or len(tasks) == 1:
+            return [self.fit_task(task) for task in tasks]
+        self.reader = Prefetch(self.read_obs, dict.fromkeys(task[1] for task in tasks), ahead=self.prefetch)
+        try:
+            return [self.fit_task(task) for task in tasks]
+        finally:
+            self.reader.close()
+            self.reader = None
+
+    def run(self, obsnames=None, rvounit=None, parunit=None, journal=None, start=0):
+        '''
+        Fit all orders and chunks of the observations.
+
+        Parameters
+        ----------
+        obsnames : list, optional
+            Filenames of the observations. Default are the files selected with obspath, nset and nexcl.
+        rvounit, parunit : file, optional
+            Files to write the rows of the .rvo.dat and .par.dat output.
+        journal : Journal, optional
+            Record of finished chunks. Chunks already in the journal are restored instead of fitted.
+        start : int, optional
+            Number of preceding observations (e.g. already in the output files) for the numbering n.
+
+        Returns
+        -------
+        dict with the arrays bjd, RV, e_RV, BERV (length N), rv, e_rv (shape N x chunks*orders),
+        the list params (Params for each chunk; None for failed chunks), and the list failed
+        with (filename, order, chunk, error) of the failed chunks.
+        '''
+        obsnames = self.obsnames if obsnames is None else obsnames
+        orders, chunks = self.orders, self.chunks
+        N = len(obsnames)
+
+        rv = np.nan * np.empty(chunks*len(orders))
+        e_rv = np.nan * np.empty(chunks*len(orders))
+        out = dict(bjd=np.nan*np.empty(N), RV=np.nan*np.empty(N), e_RV=np.nan*np.empty(N), BERV=np.nan*np.empty(N),
+                   rv=np.nan*np.empty((N, rv.size)), e_rv=np.nan*np.empty((N, rv.size)), params=[], failed=[])
+
+        if rvounit and not rvounit.tell():
+            # file headers (not when appending)
+            colnums = orders if chunks == 1 else [f'{order}-{ch}' for order in orders for ch in range(chunks)]
+            print('BJD RV e_RV BERV', *map("rv{0} e_rv{0}".format, colnums), 'filename', file=rvounit)
+
+        jobs = self.jobs
+        if jobs != 1 and self.interactive:
+            print('Interactive options are set. Fitting serially.')
+            jobs = 1
+
+        jobs = engine.njobs(jobs)
+        if jobs > 1:
+            memjobs = engine.memcap(jobs, self.task_memory())
+            if memjobs < jobs:
+                print(f'Available memory limits the processes to {memjobs}.')
+                jobs = memjobs
+
+        if jobs > 1 and not self.refdata:
+            self.share()
+
+        headrow = not (parunit and parunit.tell())
+        colnames = None
+        failrows = []   # rows of chunks over budget, waiting for the column names
+        # the column failed flags the chunks over budget; without a budget the rows stay as they were
+        failed = ['failed'] if self.maxfev or self.timeout else []
 
-    # overplot FTS iodine spectrum
-    #gplot+(np.exp(lnwave_j), spec_cell_j/spec_cell_j.max()*spec_obs_ok.max(), 'w l lc 9')
-    # overplot stellar spectrum
-    #gplot+(np.exp(lnwave_j), S_star(lnwave_j)/S_star(lnwave_j).max()*spec_obs_ok.max(), 'w l lc 9')
-
-    rvo, e_rvo = 1000*par.rv, 1000*par.rv.unc   # convert to m/s
-    #prms = S_mod.show([params[0], params[1:1+1+deg_norm], params[2+deg_norm:2+deg_norm+1+deg_wave], params[3+deg_norm+deg_wave:]], pixel_ok, spec_obs_ok, dx=0.1)
-    # gplot+(wave_tpl[s_s]*(1-berv/c), spec_tpl[s_s]*parguess_norm, 'w lp lc 4 ps 0.5')
-    #gplot+(pixel_ok, S_star(np.log(np.poly1d(b[::-1])(pixel_ok))+(v)/c), 'w lp ps 0.5')
-    # gplot+(np.exp(S_star.x), S_star.y, 'w lp ps 0.5 lc 7')
-
-    fmod = S_mod(pixel_ok, **par)
-    res = spec_obs_ok - fmod
-    prms = np.nanstd(res) / np.nanmean(fmod) * 100
-    np.savetxt('res.dat', list(zip(pixel_ok, res)), fmt="%s")
-
-    if order in look:
-        pause('look %s:'% o, rvo, '+/- %.2f' % e_rvo)  # globals().update(locals())
-
-    if order in lookres:
-        gplot2.palette_defined('(0 "blue", 1 "green", 2 "red")')
-        gplot2.var(j=1, lab_ddS='"Finite second derivative 2S(i) - S(i+1) - S(i-1)"')
-        # shortcut "j" allows to toggle between flux and second derivative
-        gplot2.bind('j "j=(j+1) % 2; set xlabel (j==0? \\"S(i)\\" : lab_ddS) ;repl"')
-        gplot2.xlabel('lab_ddS')
-        gplot2.ylabel('"residuals S_i - S(i)"')
-        gplot2.cblabel('"pixel x_i"')
-        #gplot(pixel_ok, spec_obs_ok, S_mod(pixel_ok, **par), 2*spec_obs_ok-f[pixel_ok-1]-f[pixel_ok+1], 'us 3+j:($2-$3):1 w p pt 7 palette t ""')
-        gplot2(pixel_ok, spec_obs_ok, S_mod(pixel_ok, **par), 2*S_mod(pixel_ok, **par)-S_mod(pixel_ok-1, **par)-S_mod(pixel_ok+1, **par), 'us 3+j:($2-$3):1 w p pt 7 palette t ""')
-        pause(f'lookres {o}')
-
-    if order in lookpar:   
-        sa = tplname is not None
-        sb = sa + deg_norm+1
-        ss = sb + deg_wave+1
-        # error estimation
-        # uncertainty in continuum
-        xl = np.log(np.poly1d(par.wave[::-1])(pixel-xcen))
-        Cg = np.poly1d(parguess.norm[::-1])(pixel-xcen)      # continuum guess
-        Cp = np.poly1d(par.norm[::-1])(pixel-xcen)    # best continuum 
-        X = np.vander(xl, deg_norm+1)[:,::-1].T
-        e_Cp = np.einsum('ji,jk,ki->i', X, e_params[sa:sb,sa:sb], X)**0.5
-        # uncertainty in wavelength solution
-        X = np.vander(xl, deg_wave+1)[:,::-1].T
-        lam_g = np.poly1d(parguess.wave[::-1])(pixel-xcen)
-        lam = np.poly1d(par.wave[::-1])(pixel-xcen)
-        e_lam = np.einsum('ji,jk,ki->i', X, e_params[sb:ss,sb:ss], X)**0.5
-        e_wavesol = np.sum((e_lam/lam*3e8)**-2)**-0.5
-
-        # compare the wavelength solutions
-        #show_model(i, np.poly1d(b[::-1])(i), np.poly1d(par_wave_guess[::-1])(i), res=True)
-        gplot.reset()
-        gplot.multiplot("layout 2,2")
-        gplot.xlabel('"pixel"').ylabel('"k(x2)"')
-        gplot.mxtics().mytics()
-        gplot(f'[{ibeg}:{iend}][0:]', pixel, Cg, Cp, e_Cp, 'w l lc 9 t "guess",  "" us 1:3 w l lc 3, "" us 1:($3-$4):($3+$4) w filledcurves fill fs transparent solid 0.2 lc 3 t "1{/Symbol s}" ')
-        gplot.xlabel('"pixel"').ylabel('"deviation c * ({/Symbol l} / {/Symbol l}_{guess} - 1) [km/s]"')
-        gplot(f'[{ibeg}:{iend}]', pixel, (lam/lam_g-1)*c, ((lam-e_lam)/lam_g-1)*c, ((lam+e_lam)/lam_g-1)*c, 'w l lc 3, "" us 1:3:4 w filledcurves fill fs transparent solid 0.2 lc 3 t "1{/Symbol s}"')
-        gplot.xlabel('"[km/s]"').ylabel('"contribution"')
-        e_s = e_params[ss,ss]**0.5
-        gplot(S_mod.vk, S_mod.IP(S_mod.vk, *parguess.ip), ' lc 9 ps 0.5 t "IP_{guess}", ',
-              S_mod.vk, S_mod.IP(S_mod.vk, *par.ip),
-                        S_mod.IP(S_mod.vk, *[par.ip[0]-e_s, *par.ip[1:]]),
-                        S_mod.IP(S_mod.vk, *[par.ip[0]+e_s, *par.ip[1:]]),
-              'lc 3 ps 0.5 t "IP", "" us 1:3:4 w filledcurves fill fs transparent solid 0.2 lc 3 t "1{/Symbol s}"')
-        gplot.unset('multiplot')
-        pause('lookpar', par.ip)
-
-    return rvo, e_rvo, bjd.jd, berv, par, e_params, prms
-
-
-obsnames = np.array(sorted(glob.glob(obspath)))[nset]
-obsnames = [x for x in obsnames if not any(pat in os.path.basename(x) for pat in nexcl)]
-
-N = len(obsnames)
-if not N: pause('no files: ', obspath)
-
-if targname:
-    targ = Targ(targname, csv=tag+'.targ.csv').sc
-
-orders = np.r_[oset]
-print(orders)
-
-rv = np.nan * np.empty(chunks*len(orders))
-e_rv = np.nan * np.empty(chunks*len(orders))
-
-rvounit = open(tag+'.rvo.dat', 'w')
-parunit = open(tag+'.par.dat', 'w')
-
-# file headers
-colnums = orders if chunks == 1 else [f'{order}-{ch}' for order in orders for ch in range(chunks)]
-
-print('BJD RV e_RV BERV', *map("rv{0} e_rv{0}".format, colnums), 'filename', file=rvounit)
-
-# estimate wavelength range from observation
-pixel, wave0, spec0, err0, flag0, bjd, berv = Spectrum(obsnames[0], order=orders[0])
-pixel, wave1, spec1, err1, flag1, bjd, berv = Spectrum(obsnames[0], order=orders[-1])
-    
-obs_lmin = np.min([wave0[0], wave0[-1], wave1[0], wave1[-1]])
-obs_lmax = np.max([wave0[0], wave0[-1], wave1[0], wave1[-1]])
-
-####  FTS  ####
-# using the supersampled log(wavelength) space with knot index j
-
-if ftsname != 'None':
-    wave_cell, spec_cell, lnwave_j_full, spec_cell_j_full = FTS(ftsname)
-else:
-    # create fake cell spectrum 
-    wave_cell = np.linspace(obs_lmin, obs_lmax, len(pixel)*len(orders)*200)
-    spec_cell = wave_cell*0 + 1
-    u = np.log(wave_cell)
-    lnwave_j_full = np.arange(u[0], u[-1], 200/3e8)
-    spec_cell_j_full = lnwave_j_full*0 + 1 
-
-if nocell:
-    # option nocell will be removed in near future
-    spec_cell = spec_cell*0 + 1
-    spec_cell_j_full = spec_cell_j_full*0 + 1
-
-# mask wavelengths with strong tellurics
-mskatm = lambda x: np.interp(x, *np.genfromtxt(viperdir+'lib/mask_vis1.0.dat').T)
-
-if flagfile:
-    # user created file for removal of selected regions
-    msk = np.genfromtxt(flagfile, names=True, invalid_raise=False, missing_values = {'order':"-"}, filling_values={'order':np.nan}, delimiter=' ').view(np.recarray)
-    
-    msk_o = msk[np.isfinite(msk.order)]		# selected pixel in order
-    msk_l = msk[np.isnan(msk.order)]		# selected wavelength/lambda ranges
+        # clear up the residual directory
+        if os.path.isdir(viperdir+'res') and os.listdir(viperdir+'res') and not (journal and journal.done):
+            os.system('rm -rf '+viperdir+'res/*.dat')
+        os.makedirs('res', exist_ok=True)
+
+        taskkey = lambda task: (task[1], int(task[2]), int(task[3]))   # (obsname, order, chunk)
+        tasks = [(start+i, obsname, o, ch) for i, obsname in enumerate(obsnames) for o in orders for ch in np.arange(chunks)]
+        todo = [task for task in tasks if not (journal and taskkey(task) in journal)]
+        obs = list(dict.fromkeys(task[1] for task in todo))
+        self.barycentric(obs)
+        # serial: read each observation once (and the next ones while fitting)
+        self.reader = Prefetch(self.read_obs, obs, ahead=self.prefetch) if jobs == 1 else None
+        if jobs > 1 and len(obs) >= jobs:
+            # the workers get batches of consecutive observations (about four per worker), which
+            # they read in the same way (see fit_tasks)
+            size = -(-len(obs) // (4*jobs))
+            batch = {obsname: i // size for i, obsname in enumerate(obs)}
+            units = [list(unit) for _, unit in itertools.groupby(todo, key=lambda task: batch[task[1]])]
+        else:
+            # fewer observations than workers: the chunks are spread, each reading its order
+            units = [[task] for task in todo]
+        # expensive tasks first, according to previous runs
+        history = History(self.history)
+        cost = [sum(history.estimate(self.task_kind(task[2])) for task in unit) for unit in units]
+
+        def finished(k, res):
+            # checkpoint as soon as the fits of a unit arrive; the rows are written in task order
+            for task, (result, products, err, runtime, memo) in zip(units[k], res):
+                if runtime:
+                    history.update(self.task_kind(task[2]), runtime)
+                if journal:
+                    journal.add(taskkey(task), result, products, err)
+
+        pending = {taskkey(task) for task in todo}
+        results = itertools.chain.from_iterable(engine.imap(self.fit_tasks, units, jobs=jobs, cost=cost, callback=finished))
+        memo_hits = memo_calls = 0
+
+        for i, obsname in enumerate(obsnames):
+            n = start + i
+            filename = os.path.basename(obsname)
+            print(f"{i+1:3d}/{N}", filename)
+            for i_o, o in enumerate(orders):
+                for ch in np.arange(chunks):
+                    key = taskkey((n, obsname, o, ch))
+                    if key not in pending:
+                        result, products, err = journal[key]
+                    else:
+                        result, products, err, runtime, memo = next(results)
+                        memo_hits, memo_calls = memo_hits + memo[0], memo_calls + memo[1]
+                    for k, v in products.items():
+                        self.spec_all[k][n] = v
+
+                    if err:
+                        if err == 'BdbQuit()':
+                            exit()
+                        print("Order failed due to:", err)
+                        out['params'].append(None)
+                        out['failed'].append((filename, o, ch, err))
+                        rv[i_o*chunks+ch] = e_rv[i_o*chunks+ch] = np.nan
+                        if result and parunit and failed:
+                            # over budget: row flagged as failed
+                            failrows.append((result[2], n+1, o, ch))
+                            if colnames:
+                                print(*failrows.pop(), *['nan nan']*len(colnames), 'nan', 1, file=parunit)
+                        continue
+
+                    rv[i_o*chunks+ch], e_rv[i_o*chunks+ch], bjd, berv, params, e_params, prms = result
+
+                    print(n+1, o, ch, rv[i_o*chunks+ch], e_rv[i_o*chunks+ch])
+                    # just for compability, remove Params(ipB=[]) later !!
+                    if 'ipB' in params: params.pop('ipB')
+                    if not self.deg_bkg: params.pop('bkg', None)
+                    params.rv.value *= 1000.   # convert to m/s -> same unit in .par.dat and .rvo.dat
+                    params.rv.unc *= 1000.
+                    out['params'].append(params)
+
+                    if parunit and not colnames:
+                        colnames = ["".join(map(str,x)) for x in params.flat().keys()]
+                        if headrow:
+                            headrow = False
+                            print('BJD n order chunk', *map("{0} e_{0}".format, colnames), 'prms', *failed, file=parunit)
+                        for row in failrows:
+                            print(*row, *['nan nan']*len(colnames), 'nan', 1, file=parunit)
+                        failrows = []
+
+                    if parunit:
+                        flat_params = [f"{d.value} {d.unc}" for d in params.flat().values()]
+                        print(bjd, n+1, o, ch, *flat_params, prms, *[0]*len(failed), file=parunit)
+
+            if not np.isnan(rv).all():
+                oo = np.isfinite(e_rv)
+                if oo.sum() == 1:
+                    RV = rv[oo][0]
+                    e_RV = e_rv[oo][0]
+                else:
+                    RV = np.nanmean(rv[oo])
+                    e_RV = np.nanstd(rv[oo])/(oo.sum()-1)**0.5
+                print('RV:', RV, e_RV, bjd, berv)
+                out['bjd'][i], out['RV'][i], out['e_RV'][i], out['BERV'][i] = bjd, RV, e_RV, berv
+                out['rv'][i], out['e_rv'][i] = rv, e_rv
+
+                if rvounit:
+                    print(bjd, RV, e_RV, berv, *sum(zip(rv, e_rv), ()), filename, file=rvounit)
+                if parunit:
+                    print(file=parunit)
+
+        if failrows:
+            # no chunk succeeded
+            if headrow:
+                print('BJD n order chunk prms failed', file=parunit)
+            for row in failrows:
+                print(*row, 'nan', 1, file=parunit)
+
+        if memo_calls:
+            print(f'model evaluations: {memo_calls}, reused effective spectra: {memo_hits} ({100*memo_hits/memo_calls:.0f}%)')
+
+        if self.reader:
+            self.reader.close()
+            self.reader = None
+
+        try:
+            history.save()
+        except OSError as e:
+            print('WARNING: runtime history not saved:', e)
+
+        return out
+
+    def create_tpl(self, obsnames=None):
+        '''Combine all telluric corrected spectra to a final template.'''
+        obsnames = self.obsnames if obsnames is None else obsnames
+        spec_all = self.spec_all
+        lookfast, look, lookctpl = self.lookfast, self.look, self.lookctpl
+
+        wave_tpl_new = {}
+        spec_tpl_new = {}
+        err_tpl_new = {}
+        orders_ok = sorted(set([kk[0] for kk in spec_all.keys()]))
+        for order in orders_ok:
+            gplot.reset()
+            gplot.key("title 'order: %s' noenhance" % (order))
+            gplot.xlabel('"Vacuum wavelength [Å]"')
+            gplot.ylabel('"flux"')
+            gplot.yrange("[%g:%g]" % (-1, 1.6))
+            wave_t = np.array(list(spec_all[order, 0].values()))     # wavelength
+            spec_t = np.array(list(spec_all[order, 1].values()))     # data
+            weight_t = np.array(list(spec_all[order, 2].values()))   # weighting
+            weight_t[np.isnan(spec_t)] = 0
+            weight_t[spec_t<0] = 0
+            # weight_t[spec_t>1.15] = np.nanmin(weight_t)/10.
+
+          #  spec_tpl_new[order] = np.nansum(spec_t*weight_t, axis=0) / np.nansum(weight_t, axis=0)
+            #wave_tpl_new[order] = np.nanmean(wave_t, axis=0)
+            wave_tpl_new[order] = wave_t[0]
+
+            if len(spec_t) > 1:
+                # combine several observations to one tpl
+                for nn in range(1, len(spec_t)):
+                    # flag outlier points and spectra
+                    valid = np.isfinite(spec_t[nn])
+                    spec_cubic = CubicSpline(wave_t[nn][valid], spec_t[nn][valid])(wave_t[0])
+                    spec_cubic[valid==0] = np.nan
+                    spec_t[nn] = spec_cubic
+
+                    # weight_cubic = CubicSpline(wave_t[nn][valid], weight_t[nn][valid])(wave_t[0])
+                    # weight_t[nn][valid] = weight_cubic[valid]
+                    weight_t[nn] = np.interp(wave_t[0], wave_t[nn][valid], weight_t[nn][valid])
+                    weight_t[nn][valid==0] = np.nan
+                    weight_t[nn][weight_t[nn]==0] = np.nan
+
+                if self.kapsig_ctpl:
+                    spec_mean = np.nansum(spec_t*weight_t, axis=0) / np.nansum(weight_t, axis=0)
+                    for nn in range(0, len(spec_t)):
+                        weight_t[nn][np.abs(spec_t[nn]-spec_mean)>self.kapsig_ctpl] = np.nan
+
+                spec_tpl_new[order] = np.nansum(spec_t*weight_t, axis=0) / np.nansum(weight_t, axis=0)
+                err_tpl_new[order] = np.nanstd(spec_t, axis=0)
+          
+            else:
+                spec_tpl_new[order] = spec_t[0]
+                err_tpl_new[order] = spec_t[0]*np.nan
 
-    if len(msk_l):
-        msk_w = np.asarray(np.concatenate([msk_l.start, msk_l.end, msk_l.start-0.05, msk_l.end+0.05]))
-        msk_f = np.asarray(np.concatenate([np.ones(2*len(msk_l.start)), np.zeros(2*len(msk_l.start))]))
-    
-        ind = np.argsort(msk_w)
-        msk_w, msk_f = msk_w[ind], msk_f[ind]
-        
+            if (order in lookfast) or (order in look) or (order in lookctpl):
+                gplot(wave_tpl_new[order], spec_tpl_new[order] - 1 , 'w l lc 7 t "combined tpl"')
+                for n in range(len(spec_t)):
+                    gplot+(wave_tpl_new[order], spec_t[n]/np.nanmedian(spec_t[n]), 'w l t "%s"' % (os.path.split(obsnames[n])[1]))          
+                #gplot+(wave_tpl_new[order], np.nanstd(spec_t, axis=0)+1.5, 'w l t ""')
+            if (order in look) or (order in lookctpl):
+                pause()
 
-#### Telluric model ####
-if 'add' in telluric:
-    # read in telluric spectra for wavelength range of the instrument
+        self.Inst.write_fits(wave_tpl_new, spec_tpl_new, err_tpl_new, obsnames, self.tag)
 
-    bands_all = ['vis', 'J', 'H', 'K']
-    wave_band = [0, 9000, 14000, 18500]
-    
-    # select which bands are covered by the observation
-    w0 = obs_lmin - wave_band
-    w1 = obs_lmax - wave_band
-    bands = bands_all[np.argmin(w0[w0 >= 0]): int(np.argmin(w1[w1 >= 0]) + 1)]
-
-    specs_molec_all = defaultdict(list)
-    wave_atm_all = defaultdict(list)
-    molec_sel = molec
-    
-    for band in bands:
 
-        hdu = fits.open(viperdir+'/lib/atmos/stdAtmos_'+band+'.fits')
-        cols = hdu[1].columns.names
-        data = hdu[1].data
+def run(argv=None):
+    '''Run viper from the command line.'''
+    args = parse_args(argv)
+    if args.watch:
+        return watch(args)
 
-        if molec_sel[0] == 'all': molec = cols[1:]
-        
-        # add wavelength shift
-        # synthetic telluric spectra (molecfit) are laboratory wavelengths
-        # shift was determined empirical from several observations                    
-        for i_mol, mol in enumerate(molec):
-            if (mol != 'lambda') and (mol in cols): 
-                specs_molec_all[mol].extend(data[mol])
-                wave_atm_all[mol].extend(data['lambda'] * (1 + (-0.249/3e5)))
-                
-        molec = np.array(list(specs_molec_all.keys()))
-
-# collect all spectra for createtpl function
-spec_all = defaultdict(dict)
-
-####  stellar template  ####
-
-if tplname:
-    print('reading stellar template')
-    wave_tpl, spec_tpl = {}, {}
-    for order in orders:
-        wave_tplo, spec_tplo = Tpl(tplname, order=order, targ=targ)
-        if oversampling:
-            us = np.linspace(np.log(wave_tplo[0]), np.log(wave_tplo[-1]), oversampling*wave_tplo.size)
-            spec_tplo = np.nan_to_num(spec_tplo)
-            fs = CubicSpline(np.log(wave_tplo), spec_tplo)(us)
-            wave_tpl[order], spec_tpl[order] = np.exp(us), fs
-        else:
-            wave_tpl[order], spec_tpl[order] = wave_tplo, spec_tplo
-else:
-    # no template given; model pure iodine
-    wave_tpl, spec_tpl = [wave_cell[[0, -1]]]*200, [np.ones(2)]*200
+    pipe = Pipeline(args)
+    tag, oformat = pipe.tag, pipe.oformat
 
+    rvounit = open(tag+'.rvo.dat', 'w')
+    parunit = open(tag+'.par.dat', 'w')
 
-if createtpl:
-    wave_tplo, spec_tplo = Tpl(obsnames[-1], order=orders[-1], targ=targ)
-    wmax = np.max(wave_tplo)
-else:
-    wmax = np.max(wave_tpl[orders[-1]])
+    # checkpoint of the finished chunks
+    journal = Journal(tag+'.journal', header=pipe.fit_options(), resume=args.resume)
 
-if telluric == 'add' and (wave_cell[-1] < wmax):
-    # extend wavelength range for telluric modelling
-    # iodine ends around order 36 for TLS and OES
-    # at higher orders modelling with telluric lines instead of iodine is possible
+    T = time.time()
+    res = pipe.run(rvounit=rvounit, parunit=parunit, journal=journal)
+    journal.close()
+    summarise_failed(res['failed'])
 
-    wave_cell_ext = np.arange(wave_cell[-1], wmax, wave_cell[-1]-wave_cell[-2])[1:]
-    spec_cell_ext = np.ones_like(wave_cell_ext)
+    if pipe.createtpl:
+        pipe.create_tpl()
 
-    wave_cell = np.append(wave_cell, wave_cell_ext)
-    spec_cell = np.append(spec_cell, spec_cell_ext)
+    rvounit.close()
+    parunit.close()
+    pipe.close()
+    convert_output.convert_data(tag, args, dat='dat' in oformat, fits='fits' in oformat, cpl='cpl' in oformat)
 
-    lnwave_j = np.log(wave_cell)
-    lnwave_j_full = np.arange(lnwave_j[0], lnwave_j[-1], 200/3e8)
-    spec_cell_j_full = np.interp(lnwave_j_full, lnwave_j, spec_cell)
+    N = len(pipe.obsnames)
+    T = time.time() - T
+    Tfmt = lambda t: time.strftime("%Hh%Mm%Ss", time.gmtime(t))
+    print("processing time total:       ", Tfmt(T))
+    print("processing time per spectrum:", Tfmt(T/N))
+    print("processing time per chunk:   ", Tfmt(T/N/pipe.orders.size))
 
-    if not tplname:
-        wave_tpl, spec_tpl = [wave_cell[[0, -1]]]*200, [np.ones(2)]*200
+    if 'cpl' in oformat or 'fits' in oformat:
+        tag += '_rvo_par.fits'
+    else:
+        tag += '.rvo.dat'
 
-T = time.time()
-headrow = True
-for n, obsname in enumerate(obsnames):
-    if n == 0:
-        # clear up the residual directory
-        if os.path.isdir(viperdir+'res') and os.listdir(viperdir+'res'):
-            os.system('rm -rf '+viperdir+'res/*.dat')
-    filename = os.path.basename(obsname)
-    print(f"{n+1:3d}/{N}", filename)
-    for i_o, o in enumerate(orders):
-        for ch in np.arange(chunks):
-            try:
-                gplot.RV2title = lambda x: gplot.key('title noenhanced "%s (n=%s, o=%s%s)"'% (filename, n+1, o, x))
-                gplot.RV2title('')
-        
-                rv[i_o*chunks+ch], e_rv[i_o*chunks+ch], bjd, berv, params, e_params, prms = fit_chunk(o, ch, obsname=obsname, targ=targ)
-
-                print(n+1, o, ch, rv[i_o*chunks+ch], e_rv[i_o*chunks+ch])
-                # just for compability, remove Params(ipB=[]) later !!
-                if 'ipB' in params: params.pop('ipB')
-                if not deg_bkg: params.pop('bkg', None)                       
-                params.rv.value *= 1000.   # convert to m/s -> same unit in .par.dat and .rvo.dat     
-                params.rv.unc *= 1000.
-
-                if headrow:
-                    headrow = False
-                    colnames = ["".join(map(str,x)) for x in params.flat().keys()]
-                    print('BJD n order chunk', *map("{0} e_{0}".format, colnames), 'prms', file=parunit)
-
-                flat_params = [f"{d.value} {d.unc}" for d in params.flat().values()]
-                print(bjd, n+1, o, ch, *flat_params, prms, file=parunit)
-                # store residuals
-                os.system('mkdir -p res; touch res.dat')
-                os.system('mv res.dat res/%03d_%03d.dat' % (n, o))
-
-            except Exception as e:
-                if repr(e) == 'BdbQuit()':
-                    exit()
-                print("Order failed due to:", repr(e))
-
-    if not np.isnan(rv).all():
-        oo = np.isfinite(e_rv)
-        if oo.sum() == 1:
-            RV = rv[oo][0]
-            e_RV = e_rv[oo][0]
-        else:
-            RV = np.nanmean(rv[oo])
-            e_RV = np.nanstd(rv[oo])/(oo.sum()-1)**0.5
-        print('RV:', RV, e_RV, bjd, berv)
-
-        print(bjd, RV, e_RV, berv, *sum(zip(rv, e_rv), ()), filename, file=rvounit)
-        print(file=parunit)
-
-
-if createtpl:
-    # combine all telluric corrected spectra to a final template
-    wave_tpl_new = {}
-    spec_tpl_new = {}
-    err_tpl_new = {}
-    orders_ok = sorted(set([kk[0] for kk in spec_all.keys()]))
-    for order in orders_ok:
-        gplot.reset()
-        gplot.key("title 'order: %s' noenhance" % (order))
-        gplot.xlabel('"Vacuum wavelength [Å]"')
-        gplot.ylabel('"flux"')
-        gplot.yrange("[%g:%g]" % (-1, 1.6))
-        wave_t = np.array(list(spec_all[order, 0].values()))     # wavelength
-        spec_t = np.array(list(spec_all[order, 1].values()))     # data
-        weight_t = np.array(list(spec_all[order, 2].values()))   # weighting
-        weight_t[np.isnan(spec_t)] = 0
-        weight_t[spec_t<0] = 0
-        # weight_t[spec_t>1.15] = np.nanmin(weight_t)/10.
-
-      #  spec_tpl_new[order] = np.nansum(spec_t*weight_t, axis=0) / np.nansum(weight_t, axis=0)
-        #wave_tpl_new[order] = np.nanmean(wave_t, axis=0)
-        wave_tpl_new[order] = wave_t[0]
-
-        if len(spec_t) > 1:
-            # combine several observations to one tpl
-            for nn in range(1, len(spec_t)):
-                # flag outlier points and spectra
-                valid = np.isfinite(spec_t[nn])
-                spec_cubic = CubicSpline(wave_t[nn][valid], spec_t[nn][valid])(wave_t[0])
-                spec_cubic[valid==0] = np.nan
-                spec_t[nn] = spec_cubic
-
-                # weight_cubic = CubicSpline(wave_t[nn][valid], weight_t[nn][valid])(wave_t[0])
-                # weight_t[nn][valid] = weight_cubic[valid]
-                weight_t[nn] = np.interp(wave_t[0], wave_t[nn][valid], weight_t[nn][valid])
-                weight_t[nn][valid==0] = np.nan
-                weight_t[nn][weight_t[nn]==0] = np.nan
-
-            if kapsig_ctpl:
-                spec_mean = np.nansum(spec_t*weight_t, axis=0) / np.nansum(weight_t, axis=0)
-                for nn in range(0, len(spec_t)):
-                    weight_t[nn][np.abs(spec_t[nn]-spec_mean)>kapsig_ctpl] = np.nan
-
-            spec_tpl_new[order] = np.nansum(spec_t*weight_t, axis=0) / np.nansum(weight_t, axis=0)
-            err_tpl_new[order] = np.nanstd(spec_t, axis=0)
-          
-        else:
-            spec_tpl_new[order] = spec_t[0]
-            err_tpl_new[order] = spec_t[0]*np.nan
-
-        if (order in lookfast) or (order in look) or (order in lookctpl):
-            gplot(wave_tpl_new[order], spec_tpl_new[order] - 1 , 'w l lc 7 t "combined tpl"')
-            for n in range(len(spec_t)):
-                gplot+(wave_tpl_new[order], spec_t[n]/np.nanmedian(spec_t[n]), 'w l t "%s"' % (os.path.split(obsnames[n])[1]))          
-            #gplot+(wave_tpl_new[order], np.nanstd(spec_t, axis=0)+1.5, 'w l t ""')
-        if (order in look) or (order in lookctpl):
-            pause()
+    if not pipe.createtpl:
+        vp = vpr.VPR(tag)   # to print info statistic
+        if len(pipe.lookfast) or len(pipe.look):
+            gplot.reset()
+            vp.plot_RV()
+    print(tag, 'done.')
 
-    Inst.write_fits(wave_tpl_new, spec_tpl_new, err_tpl_new, obsnames, tag)
 
-rvounit.close()
-parunit.close()
-convert_output.convert_data(tag, args, dat='dat' in oformat, fits='fits' in oformat, cpl='cpl' in oformat)
+def summarise_failed(failed):
+    '''Print the chunks that exceeded their budget and the other failed chunks.'''
+    budget = [x for x in failed if x[3].startswith('BudgetExceeded')]
+    if budget:
+        print(f'{len(budget)} chunks exceeded the budget (-maxfev, -timeout):')
+        for filename, o, ch, err in budget:
+            print(f'   {filename} order {o} chunk {ch}: {err}')
+    if len(failed) > len(budget):
+        print(f'{len(failed)-len(budget)} chunks failed otherwise.')
 
-T = time.time() - T
-Tfmt = lambda t: time.strftime("%Hh%Mm%Ss", time.gmtime(t))
-print("processing time total:       ", Tfmt(T))
-print("processing time per spectrum:", Tfmt(T/N))
-print("processing time per chunk:   ", Tfmt(T/N/orders.size))
 
-if 'cpl' in oformat or 'fits' in oformat:
-    tag += '_rvo_par.fits'
-else:
-    tag += '.rvo.dat'
+def watch(args):
+    '''
+    Fit new observations as they appear in obspath and append them to the output.
 
-if not createtpl:
-    vpr = vpr.VPR(tag)   # to print info statistic
-    if len(lookfast) or len(look):
-        gplot.reset()
-        vpr.plot_RV()
-print(tag, 'done.')
+    The finished chunks are recorded in the journal. A restarted watch rewrites the output
+    rows of the journaled observations from the journal (rows still buffered at a kill are
+    not lost) and does not fit them again.
+    '''
+    tag, oformat = args.tag, args.oformat
+    stat = {}   # size and modification time at the previous poll
 
-def run():
-    pass
+    def complete(obsnames):
+        # files unchanged since the previous poll, i.e. completely written
+        ok = []
+        for obsname in obsnames:
+            try:
+                st = os.stat(obsname)
+            except FileNotFoundError:
+                # renamed or deleted since the glob (e.g. temporary files)
+                stat.pop(obsname, None)
+                continue
+            st = st.st_size, st.st_mtime_ns
+            if stat.get(obsname) == st:
+                ok.append(obsname)
+            stat[obsname] = st
+        return ok
+
+    print('watching', args.obspath)
+    while not complete(select_obs(args.obspath, args.nset, args.nexcl, args.where, args.inst, args.catalog)):
+        time.sleep(args.watch)
+
+    pipe = Pipeline(args)
+    journal = Journal(tag+'.journal', header=pipe.fit_options(), resume=True)
+    rvounit = open(tag+'.rvo.dat', 'w')
+    parunit = open(tag+'.par.dat', 'w')
+
+    try:
+        # the rows of the journaled observations (missing chunks of an interrupted one are fitted)
+        done = list(dict.fromkeys(task[0] for task in journal.done))
+        if done:
+            pipe.run(done, rvounit=rvounit, parunit=parunit, journal=journal)
+            rvounit.flush()
+            parunit.flush()
+
+        while True:
+            new = [obsname for obsname in complete(select_obs(args.obspath, args.nset, args.nexcl, args.where, args.inst, args.catalog)) if obsname not in done]
+            if not new:
+                time.sleep(args.watch)
+                continue
+
+            pipe.run(new, rvounit=rvounit, parunit=parunit, journal=journal, start=len(done))
+            done += new
+            rvounit.flush()
+            parunit.flush()
+            if 'fits' in oformat or 'cpl' in oformat:
+                # the .dat files are kept for appending
+                convert_output.convert_data(tag, args, dat=True, fits='fits' in oformat, cpl='cpl' in oformat)
+            print(f'{len(done)} observations done. Waiting for new ones.')
+    except KeyboardInterrupt:
+        print('stop watching')
+    finally:
+        journal.close()
+        rvounit.close()
+        parunit.close()
+        pipe.close()
+
+
+if __name__ == "__main__":
+    run()